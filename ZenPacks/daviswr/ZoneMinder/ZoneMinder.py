@@ -0,0 +1,16 @@
+"""ZoneMinder Daemon device"""
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+from . import schema
+
+
+class ZoneMinder(schema.ZoneMinder):
+    """ZoneMinder Daemon device, remodeled on its collector's request"""
+
+    def setRemodel(self, requested):
+        """Remodels in the background. Set by an ObjectMap from the Daemon
+        datasource when ZoneMinder's run state changes, see zmRemodel."""
+        LOG.info('%s: remodeling after run state change', self.id)
+        self.collectDevice(background=True)
@@ -3,18 +3,27 @@
 import logging
 LOG = logging.getLogger('zen.ZoneMinder')
 
-import json
 import re
-import urllib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
 
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmAdapt,
+    zmDb,
+    zmEvents,
+    zmNotify,
+    zmParse,
+    zmRemodel,
+    zmSample,
+    zmSchedule,
+    zmSession,
+    zmTransport,
+    zmUtil
+    )
 
 
 class Daemon(PythonDataSourcePlugin):
@@ -31,20 +40,27 @@ class Daemon(PythonDataSourcePlugin):
 
     @classmethod
     def params(cls, datasource, context):
-        return {
-            'username': context.zZoneMinderUsername,
-            'password': context.zZoneMinderPassword,
-            'hostname': context.zZoneMinderHostname,
-            'port': context.zZoneMinderPort,
-            'path': context.zZoneMinderPath,
-            'ssl': context.zZoneMinderSSL,
-            'base_url': context.zZoneMinderURL,
-            }
+        params = zmUtil.session_params(context)
+        params.update({
+            'sample_interval': context.zZoneMinderSampleInterval,
+            'disk_reconcile': context.zZoneMinderDiskReconcileInterval,
+            'event_server_url': context.zZoneMinderEventServerURL,
+            'adaptive_load': context.zZoneMinderAdaptiveLoad,
+            'adaptive_db': context.zZoneMinderAdaptiveDbUse,
+            'adaptive_stretch': context.zZoneMinderAdaptiveStretch,
+            'cpu_cores': context.zZoneMinderCpuCores,
+            'remodel_interval': context.zZoneMinderRemodelInterval,
+            'modeled': zmRemodel.last_modeled(context),
+            })
+        return params
 
     @inlineCallbacks
     def collect(self, config):
         data = self.new_data()
 
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, config.datasources[0])
+
         for datasource in config.datasources:
             # LOG.debug('%s: parameters\n%s', config.id, datasource.params)
             username = datasource.params['username']
@@ -80,134 +96,153 @@ class Daemon(PythonDataSourcePlugin):
                     base_url
                     )
 
-            login_params = urllib.urlencode({
-                'action': 'login',
-                'view': 'login',
-                'username': username,
-                'password': password,
-                # 1.34+ requires OPT_USE_LEGACY_API_AUTH
-                'stateful': 1,
-                })
-            login_url = '{0}index.php?{1}'.format(base_url, login_params)
-            api_url = '{0}api/'.format(base_url)
-
-            cookies = dict()
-            try:
-                # Attempt login
-                login_response = yield getPage(
-                    login_url,
-                    method='POST',
-                    cookies=cookies
+            transport = zmTransport.get_transport(
+                config.id,
+                '_'.join((datasource.datasource, datasource.component)),
+                capture_dir=datasource.params['capture_dir'],
+                replay_dir=datasource.params['replay_dir'],
+                realtime=datasource.params['replay_realtime'],
+                rate=datasource.params['rate_limit'],
+                burst=datasource.params['rate_burst']
+                )
+            parser = zmParse.Parser(
+                config.id,
+                datasource.params['parse_threshold']
+                )
+            session = zmSession.get_session(
+                config.id,
+                base_url,
+                username,
+                password,
+                cache_dir=datasource.params['cache_dir'],
+                db=zmDb.get_backend(
+                    datasource.params['db_host'],
+                    datasource.params['db_port'],
+                    datasource.params['db_user'],
+                    datasource.params['db_password'],
+                    datasource.params['db_name'],
+                    datasource.params['db_module']
                     )
+                )
+            sampler = zmSample.get_sampler(
+                config.id,
+                session,
+                zmTransport.get_transport(
+                    config.id,
+                    'Sampler',
+                    capture_dir=datasource.params['capture_dir'],
+                    replay_dir=datasource.params['replay_dir'],
+                    realtime=datasource.params['replay_realtime'],
+                    rate=datasource.params['rate_limit'],
+                    burst=datasource.params['rate_burst']
+                    ),
+                parser,
+                datasource.params['sample_interval'],
+                datasource.params['adaptive_stretch']
+                )
+            # Non-essential requests held back while ZoneMinder is loaded
+            governor = zmAdapt.get_governor(session)
+            stretch = datasource.params['adaptive_stretch']
 
-                if 'Invalid username or password' in login_response:
-                    LOG.error(
-                        '%s: ZoneMinder login credentials invalid',
-                        config.id,
-                        )
-                    returnValue(None)
-                elif not cookies:
-                    LOG.error('%s: No cookies received', config.id)
-                    returnValue(None)
-
+            try:
                 output = dict()
 
                 # Console
-                # Session cookies on 1.34 require view=login on action=login
-                # This returns a 302 to the console page
-                # rather than just the console
-                response = yield getPage(
-                    base_url + 'index.php?view=console',
-                    method='GET',
-                    cookies=cookies
-                    )
-
-                # Scrape shared memory utilization from HTML
-                output['devshm'] = zmUtil.scrape_console_shm(response)
-
-                # Scrape DB connection counts from HTML
-                output['db'] = zmUtil.scrape_console_db(response)
-
-                # Scrape total capture bandwidth from HTML
-                output['bandwidth'] = zmUtil.scrape_console_bandwidth(response)
-
-                # Scrape system capturing percentage from HTML
-                output['capturing'] = zmUtil.scrape_console_capturing(response)
+                if governor.allow(
+                        config.id,
+                        '/'.join((datasource.datasource, 'console')),
+                        datasource.cycletime,
+                        stretch
+                        ):
+                    response = yield session.console(transport)
+                    session.set_console_variant(
+                        zmUtil.detect_console_variant(response)
+                        )
 
-                # Daemon status
-                response = yield getPage(
-                    api_url + 'host/daemonCheck.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
+                    # Scrape shared memory utilization, DB connection
+                    # counts, total capture bandwidth, and system capturing
+                    # percentage from HTML
+                    output.update((yield parser.parse(
+                        zmUtil.scrape_console_daemon,
+                        response
+                        )))
 
                 # Run state
-                response = yield getPage(
-                    api_url + 'states.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
+                output.update((yield session.bulk(
+                    transport,
+                    parser,
+                    'states.json'
+                    )))
+
+                # Exact DB connection counts, when reading the database
+                if session.db:
+                    output.setdefault('db', dict()).update(
+                        (yield session.db.connections())
+                        )
 
                 # Host Load
-                response = yield getPage(
-                    api_url + 'host/getLoad.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-                # Versions
-                response = yield getPage(
-                    api_url + 'host/getVersion.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                versions = zmUtil.dissect_versions(json.loads(response))
-
+                output.update((yield session.bulk(
+                    transport,
+                    parser,
+                    'host/getLoad.json'
+                    )))
+
+            except zmSession.LoginError as e:
+                LOG.error('%s: %s', config.id, e)
+                returnValue(None)
             except Exception:
                 LOG.exception('%s: failed to get daemon data', config.id)
                 continue
 
-            # User might not have View access to Events
-            try:
-                # Five-minute event counts
-                response = yield getPage(
-                    api_url + 'events/consoleEvents/300%20second.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-            except Exception:
-                LOG.exception('%s: failed to get event counts', config.id)
+            # Whether this cycle's events, and others' non-essential
+            # requests until the next, are held back
+            load = output.get('load', list())
+            governor.update(
+                config.id,
+                datasource.params['adaptive_load'],
+                datasource.params['adaptive_db'],
+                load=load[0] if load else None,
+                cores=datasource.params['cpu_cores'],
+                db_used=output.get('db', dict()).get('db-used'),
+                db_max=output.get('db', dict()).get('db-max')
+                )
+
+            # Alarms pushed by the Event Notification Server, if used,
+            # are counted as they arrive
+            listener = zmNotify.get_listener(
+                config.id,
+                datasource.params['event_server_url'],
+                username,
+                password
+                )
 
+            # User might not have View access to Events
+            tracker = zmEvents.get_tracker(config.id, session)
+            events = governor.allow(
+                config.id,
+                '/'.join((datasource.datasource, 'events')),
+                datasource.cycletime,
+                stretch
+                )
             try:
-                # Version-specific API calls
-                if (versions['daemon']['major'] >= 1
-                        and versions['daemon']['minor'] >= 32):
-                    # API logout
-                    yield getPage(
-                        api_url + 'host/logout.json',
-                        method='GET',
-                        cookies=cookies
-                        )
-                else:
-                    # Browser-style log out
-                    # Doesn't work with 1.34.21
-                    yield getPage(
-                        base_url + 'index.php?action=logout',
-                        method='POST',
-                        cookies=cookies
+                # Events since the last cycle, those held back being
+                # counted once allowed again
+                if events and (yield tracker.update(
+                        transport,
+                        parser,
+                        datasource.params['disk_reconcile'],
+                        listener
+                        )):
+                    output['events'] = tracker.delta(
+                        '/'.join((config.id, datasource.datasource)),
+                        'daemon'
                         )
             except Exception:
-                LOG.exception('%s: failed to log out', config.id)
+                LOG.exception('%s: failed to get event counts', config.id)
 
             LOG.debug('%s: ZM daemon output:\n%s', config.id, output)
 
             stats = dict()
-            # Daemon status ("result")
-            stats['result'] = output.get('result', '0')
 
             states = output.get('states', list())
             if len(states) > 0:
@@ -216,6 +251,18 @@ class Daemon(PythonDataSourcePlugin):
                         stats['state'] = state['State']['Id']
                         break
 
+            # Remodel to catch anything else a run state change altered.
+            # The MonitorStatus datasource updates monitor functions.
+            remodel = zmRemodel.check(
+                session,
+                config.id,
+                stats.get('state'),
+                datasource.params['remodel_interval'],
+                datasource.params['modeled']
+                )
+            if remodel is not None:
+                data['maps'].append(remodel)
+
             load = output.get('load', list())
             if len(load) >= 3:
                 (stats['load-1'], stats['load-5'], stats['load-15']) = load
@@ -226,20 +273,37 @@ class Daemon(PythonDataSourcePlugin):
                 if metric in output:
                     stats[metric] = output[metric]
 
-            # Event counts ("results", plural)
-            events = output.get('results', list())
-            stats['events'] = 0
-            # "results" will be an empty *list* if no monitors have events
-            if len(events) > 0:
-                for key in events.keys():
-                    stats['events'] += int(events.get(key, 0))
+            # Total bandwidth and capturing percentage sampled during the
+            # cycle from every monitor's status
+            if sampler:
+                stats.update(sampler.rollups(
+                    'daemon',
+                    ['bandwidth', 'capturing'],
+                    datasource.cycletime
+                    ))
+
+            # Time spent parsing on the reactor thread by all plugins
+            stats['parse-blocking'] = zmParse.pop_blocking(config.id) * 1000
+
+            # Event counts
+            if events:
+                stats['events'] = output.get('events', dict()).get(
+                    'events',
+                    0
+                    )
+
+            # Non-essential requests held back by all plugins
+            stats['deferred'] = governor.pop_deferred(config.id)
 
             for datapoint_id in (x.id for x in datasource.points):
                 if datapoint_id not in stats:
                     continue
 
                 try:
-                    if datapoint_id.startswith('load-'):
+                    if (datapoint_id.startswith('load-')
+                            or datapoint_id == 'parse-blocking'
+                            or datapoint_id.startswith('bandwidth-')
+                            or datapoint_id.startswith('capturing-')):
                         value = float(stats.get(datapoint_id))
                     else:
                         value = int(stats.get(datapoint_id))
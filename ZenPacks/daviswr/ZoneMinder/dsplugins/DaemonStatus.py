@@ -0,0 +1,184 @@
+"""Checks whether the ZoneMinder daemon is running using its JSON API"""
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import re
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
+    PythonDataSourcePlugin
+    )
+
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmDb,
+    zmNotify,
+    zmParse,
+    zmSchedule,
+    zmSession,
+    zmTransport,
+    zmUtil
+    )
+
+
+class DaemonStatus(PythonDataSourcePlugin):
+    """ZoneMinder daemon status data source plugin"""
+
+    @classmethod
+    def config_key(cls, datasource, context):
+        return(
+            context.device().id,
+            datasource.getCycleTime(context),
+            context.id,
+            'zoneminder-daemon-status',
+            )
+
+    @classmethod
+    def params(cls, datasource, context):
+        params = zmUtil.session_params(context)
+        params.update({
+            'event_server_url': context.zZoneMinderEventServerURL,
+            'event_server_alarms': context.zZoneMinderEventServerAlarms,
+            'offline_summary': context.zZoneMinderOfflineSummary,
+            })
+        return params
+
+    @inlineCallbacks
+    def collect(self, config):
+        data = self.new_data()
+
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, config.datasources[0])
+
+        for datasource in config.datasources:
+            username = datasource.params['username']
+            password = datasource.params['password']
+            hostname = datasource.params['hostname']
+            port = datasource.params['port']
+            path = datasource.params['path']
+            ssl = datasource.params['ssl']
+            base_url = datasource.params['base_url']
+
+            if not username or not password:
+                LOG.error(
+                    '%s: zZoneMinderUsername or zZoneMinderPassword not set',
+                    config.id
+                    )
+                returnValue(None)
+
+            base_url = zmUtil.generate_zm_url(
+                hostname=hostname or config.id,
+                port=port or 443,
+                path=path or '/zm/',
+                ssl=ssl or True,
+                url=base_url
+                )
+
+            if re.match(zmUtil.url_regex, base_url) is None:
+                LOG.error('%s: %s is not a valid URL', config.id, base_url)
+                returnValue(None)
+
+            transport = zmTransport.get_transport(
+                config.id,
+                '_'.join((datasource.datasource, datasource.component)),
+                capture_dir=datasource.params['capture_dir'],
+                replay_dir=datasource.params['replay_dir'],
+                realtime=datasource.params['replay_realtime'],
+                rate=datasource.params['rate_limit'],
+                burst=datasource.params['rate_burst']
+                )
+            parser = zmParse.Parser(
+                config.id,
+                datasource.params['parse_threshold']
+                )
+            session = zmSession.get_session(
+                config.id,
+                base_url,
+                username,
+                password,
+                cache_dir=datasource.params['cache_dir'],
+                db=zmDb.get_backend(
+                    datasource.params['db_host'],
+                    datasource.params['db_port'],
+                    datasource.params['db_user'],
+                    datasource.params['db_password'],
+                    datasource.params['db_name'],
+                    datasource.params['db_module']
+                    )
+                )
+
+            # Alarms pushed by the Event Notification Server since the
+            # last check, as Zenoss events if wanted
+            listener = zmNotify.get_listener(
+                config.id,
+                datasource.params['event_server_url'],
+                username,
+                password
+                )
+            if listener and datasource.params['event_server_alarms']:
+                for alarm in listener.pop_alarms():
+                    data['events'].append(
+                        zmNotify.alarm_event(config.id, alarm)
+                        )
+
+            try:
+                # Daemon status, shared with other devices using
+                # the same ZoneMinder
+                output = yield session.bulk(
+                    transport,
+                    parser,
+                    'host/daemonCheck.json',
+                    max_age=datasource.cycletime / 2.0
+                    )
+            except zmSession.LoginError as e:
+                LOG.error('%s: %s', config.id, e)
+                returnValue(None)
+            except Exception:
+                LOG.exception('%s: failed to get daemon status', config.id)
+                continue
+
+            LOG.debug('%s: ZM daemon status:\n%s', config.id, output)
+
+            stats = dict()
+            try:
+                stats['result'] = int(output.get('result', 0))
+            except (TypeError, ValueError):
+                pass
+
+            # Monitors offline, not capturing, and disabled across the
+            # device, shared with the MonitorStatus datasource
+            minimum = datasource.params['offline_summary']
+            try:
+                monitors = zmUtil.monitors_by_id((yield session.bulk(
+                    transport,
+                    parser,
+                    'monitors.json',
+                    max_age=datasource.cycletime / 2.0
+                    )))
+                health = zmUtil.bulk_fleet_health(monitors)
+            except Exception:
+                LOG.exception('%s: failed to get monitor counts', config.id)
+            else:
+                stats.update(health)
+                if minimum > 0 and 'monitors-offline' in health:
+                    # Sent only when raised, cleared, or its count changes
+                    # while raised, rather than a clear every cycle
+                    event = zmUtil.fleet_event(config.id, health, minimum)
+                    state_name = 'fleet_offline/{0}'.format(config.id)
+                    sent = event['summary'] if event['severity'] else ''
+                    if session.state.get(state_name) != sent:
+                        data['events'].append(event)
+                        session.set_state(state_name, sent)
+
+            for datapoint_id in (x.id for x in datasource.points):
+                if datapoint_id not in stats:
+                    continue
+
+                dpname = '_'.join((datasource.datasource, datapoint_id))
+                data['values'][datasource.component][dpname] = (
+                    stats[datapoint_id],
+                    'N'
+                    )
+
+        returnValue(data)
@@ -3,18 +3,29 @@
 import logging
 LOG = logging.getLogger('zen.ZoneMinder')
 
-import json
 import re
-import urllib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
 
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmAdapt,
+    zmDb,
+    zmEvents,
+    zmFlap,
+    zmFrame,
+    zmNotify,
+    zmParse,
+    zmSample,
+    zmSchedule,
+    zmSession,
+    zmShm,
+    zmTransport,
+    zmUtil
+    )
 
 
 class Monitor(PythonDataSourcePlugin):
@@ -22,195 +33,272 @@ class Monitor(PythonDataSourcePlugin):
 
     @classmethod
     def config_key(cls, datasource, context):
+        # All of a device's monitors share one config and one console scrape
         return(
             context.device().id,
             datasource.getCycleTime(context),
-            context.id,
             'zoneminder-monitor',
             )
 
     @classmethod
     def params(cls, datasource, context):
-        return {
-            'username': context.zZoneMinderUsername,
-            'password': context.zZoneMinderPassword,
-            'hostname': context.zZoneMinderHostname,
-            'port': context.zZoneMinderPort,
-            'path': context.zZoneMinderPath,
-            'ssl': context.zZoneMinderSSL,
-            'base_url': context.zZoneMinderURL,
-            }
+        params = zmUtil.session_params(context)
+        params.update({
+            'sample_interval': context.zZoneMinderSampleInterval,
+            'disk_reconcile': context.zZoneMinderDiskReconcileInterval,
+            'shm_path': context.zZoneMinderShmPath,
+            'event_server_url': context.zZoneMinderEventServerURL,
+            'flap_samples': context.zZoneMinderFlapSamples,
+            'flap_window': context.zZoneMinderFlapWindow,
+            'offline_summary': context.zZoneMinderOfflineSummary,
+            'offline_suppress': context.zZoneMinderOfflineSuppress,
+            'monitor_health': context.zZoneMinderMonitorHealth,
+            'frame_budget': context.zZoneMinderFrameSampleBudget,
+            'frame_scale': context.zZoneMinderFrameSampleScale,
+            'zms_path': context.zZoneMinderZmsPath,
+            'adaptive_stretch': context.zZoneMinderAdaptiveStretch,
+            'server_url': getattr(context.zmServer(), 'url', None),
+            })
+        return params
 
     @inlineCallbacks
     def collect(self, config):
         data = self.new_data()
+        ds0 = config.datasources[0]
 
-        for datasource in config.datasources:
-            # LOG.debug('%s: parameters\n%s', config.id, datasource.params)
-            username = datasource.params['username']
-            password = datasource.params['password']
-            hostname = datasource.params['hostname']
-            port = datasource.params['port']
-            path = datasource.params['path']
-            ssl = datasource.params['ssl']
-            base_url = datasource.params['base_url']
-            comp_id = datasource.component.replace('zmMonitor', '')
-
-            if not username or not password:
-                LOG.error(
-                    '%s: zZoneMinderUsername or zZoneMinderPassword not set',
-                    config.id
-                    )
-                returnValue(None)
-
-            base_url = zmUtil.generate_zm_url(
-                hostname=hostname or config.id,
-                port=port or 443,
-                path=path or '/zm/',
-                ssl=ssl or True,
-                url=base_url
-                )
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, ds0)
 
-            if re.match(zmUtil.url_regex, base_url) is None:
-                LOG.error('%s: %s is not a valid URL', config.id, base_url)
-                returnValue(None)
-            else:
-                LOG.debug(
-                    '%s: using base ZoneMinder URL %s',
-                    config.id,
-                    base_url
-                    )
+        # LOG.debug('%s: parameters\n%s', config.id, ds0.params)
+        username = ds0.params['username']
+        password = ds0.params['password']
 
-            login_params = urllib.urlencode({
-                'action': 'login',
-                'view': 'login',
-                'username': username,
-                'password': password,
-                # 1.34+ requires OPT_USE_LEGACY_API_AUTH
-                'stateful': 1,
-                })
-            login_url = '{0}index.php?{1}'.format(base_url, login_params)
-            api_url = '{0}api/'.format(base_url)
-            mon_url = 'monitors/daemonStatus/id:{0}/daemon:zmc.json'.format(
-                comp_id
+        if not username or not password:
+            LOG.error(
+                '%s: zZoneMinderUsername or zZoneMinderPassword not set',
+                config.id
                 )
+            returnValue(None)
+
+        base_url = zmUtil.generate_zm_url(
+            hostname=ds0.params['hostname'] or config.id,
+            port=ds0.params['port'] or 443,
+            path=ds0.params['path'] or '/zm/',
+            ssl=ds0.params['ssl'] or True,
+            url=ds0.params['base_url']
+            )
 
-            cookies = dict()
-            try:
-                # Attempt login
-                login_response = yield getPage(
-                    login_url,
-                    method='POST',
-                    cookies=cookies
-                    )
-
-                output = dict()
-
-                if 'Invalid username or password' in login_response:
-                    LOG.error(
-                        '%s: ZoneMinder login credentials invalid',
-                        config.id,
+        if re.match(zmUtil.url_regex, base_url) is None:
+            LOG.error('%s: %s is not a valid URL', config.id, base_url)
+            returnValue(None)
+        else:
+            LOG.debug('%s: using base ZoneMinder URL %s', config.id, base_url)
+
+        transport = zmTransport.get_transport(
+            config.id,
+            ds0.datasource,
+            capture_dir=ds0.params['capture_dir'],
+            replay_dir=ds0.params['replay_dir'],
+            realtime=ds0.params['replay_realtime'],
+            rate=ds0.params['rate_limit'],
+            burst=ds0.params['rate_burst']
+            )
+        parser = zmParse.Parser(config.id, ds0.params['parse_threshold'])
+        session = zmSession.get_session(
+            config.id,
+            base_url,
+            username,
+            password,
+            cache_dir=ds0.params['cache_dir'],
+            db=zmDb.get_backend(
+                ds0.params['db_host'],
+                ds0.params['db_port'],
+                ds0.params['db_user'],
+                ds0.params['db_password'],
+                ds0.params['db_name'],
+                ds0.params['db_module']
+                )
+            )
+        # Live state read from shared memory needs no HTTP
+        shm_path = ds0.params['shm_path']
+        sampler = None if shm_path else zmSample.get_sampler(
+            config.id,
+            session,
+            zmTransport.get_transport(
+                config.id,
+                'Sampler',
+                capture_dir=ds0.params['capture_dir'],
+                replay_dir=ds0.params['replay_dir'],
+                realtime=ds0.params['replay_realtime'],
+                rate=ds0.params['rate_limit'],
+                burst=ds0.params['rate_burst']
+                ),
+            parser,
+            ds0.params['sample_interval'],
+            ds0.params['adaptive_stretch']
+            )
+        # Non-essential requests held back while ZoneMinder is loaded
+        governor = zmAdapt.get_governor(session)
+
+        monitors = dict()
+        console = None
+        try:
+            # Framerates and bandwidth for every monitor
+            if not shm_path:
+                monitors = zmUtil.monitors_by_id((yield session.bulk(
+                    transport,
+                    parser,
+                    'monitors.json'
+                    )))
+
+            # Console, for every monitor's online status, unless reading
+            # shared memory or 1.32+ Monitor_Status from the database
+            if not shm_path and not (
+                    session.db
+                    and (yield session.supports(transport, parser, 1, 32))
+                    ):
+                # 1.32+ monitors.json has it too, for when ZoneMinder is
+                # too loaded to spare rendering the Console
+                if (not (yield session.supports(transport, parser, 1, 32))
+                        or governor.allow(
+                            config.id,
+                            '/'.join((ds0.datasource, 'console')),
+                            ds0.cycletime,
+                            ds0.params['adaptive_stretch']
+                            )):
+                    console = yield session.console(transport)
+                    session.set_console_variant(
+                        zmUtil.detect_console_variant(console)
                         )
-                    returnValue(None)
-                elif not cookies:
-                    LOG.error('%s: No cookies received', config.id)
-                    returnValue(None)
-
-                # Console
-                # Session cookies on 1.34 require view=login on action=login
-                # This returns a 302 to the console page
-                # rather than just the console
-                response = yield getPage(
-                    base_url + 'index.php?view=console',
-                    method='GET',
-                    cookies=cookies
-                    )
-
-                # Scrape monitor online status from HTML
-                output['online'] = zmUtil.scrape_console_monitor(
-                    response,
-                    comp_id
-                    )
 
-                if not output['online']:
-                    LOG.warn(
-                        '%s: %s not found in ZM web console',
+        except zmSession.LoginError as e:
+            LOG.error('%s: %s', config.id, e)
+            returnValue(None)
+        except Exception:
+            LOG.exception('%s: failed to get monitor data', config.id)
+            returnValue(None)
+
+        # User might not have View access to Events
+        tracker = zmEvents.get_tracker(config.id, session)
+        events = False
+        try:
+            # Events since the last cycle. When reading shared memory,
+            # the Daemon datasource's updates are relied on instead.
+            if shm_path:
+                events = tracker.updated > 0
+            # Those held back while loaded are counted once allowed again
+            elif governor.allow(
+                    config.id,
+                    '/'.join((ds0.datasource, 'events')),
+                    ds0.cycletime,
+                    ds0.params['adaptive_stretch']
+                    ):
+                events = yield tracker.update(
+                    transport,
+                    parser,
+                    ds0.params['disk_reconcile'],
+                    zmNotify.get_listener(
                         config.id,
-                        datasource.component
+                        ds0.params['event_server_url'],
+                        username,
+                        password
                         )
-
-                # Monitor enabled
-                response = yield getPage(
-                    api_url + 'monitors/{0}.json'.format(comp_id),
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-                # Monitor process status
-                response = yield getPage(
-                    api_url + mon_url,
-                    method='GET',
-                    cookies=cookies
                     )
-                output.update(json.loads(response))
-
-                # Versions
-                response = yield getPage(
-                    api_url + 'host/getVersion.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                versions = zmUtil.dissect_versions(json.loads(response))
-
-            except Exception:
-                LOG.exception('%s: failed to get monitor data', config.id)
-                continue
+        except Exception:
+            LOG.exception('%s: failed to get event counts', config.id)
 
-            # User might not have View access to Events
+        # One frame from each of a few monitors in turn, to catch streams
+        # that stay connected while serving a stalled frame
+        frames = dict()
+        if ds0.params['frame_budget'] > 0:
             try:
-                # Five-minute event counts
-                response = yield getPage(
-                    api_url + 'events/consoleEvents/300%20second.json',
-                    method='GET',
-                    cookies=cookies
+                frames = yield zmFrame.get_sampler(config.id).sample(
+                    session,
+                    transport,
+                    parser,
+                    dict(
+                        (x.component.replace('zmMonitor', ''),
+                         x.params['server_url'] or base_url)
+                        for x in config.datasources
+                        if zmUtil.bulk_monitor_streaming(monitors.get(
+                            x.component.replace('zmMonitor', '')
+                            ))
+                        ),
+                    ds0.params['zms_path'] or 'cgi-bin/nph-zms',
+                    ds0.params['frame_budget'],
+                    ds0.params['frame_scale'] or 100
                     )
-                output.update(json.loads(response))
+            except zmSession.LoginError as e:
+                LOG.error('%s: %s', config.id, e)
             except Exception:
-                LOG.exception('%s: failed to get event counts', config.id)
+                LOG.exception('%s: failed to sample frames', config.id)
+
+        # Online changes only reported once they've held a while,
+        # and not at all while the DaemonStatus datasource's summary
+        # event covers a mass outage, if wanted
+        damper = zmFlap.get_damper(
+            config.id,
+            ds0.params['flap_samples'],
+            ds0.params['flap_window']
+            )
+        hold = ds0.params['offline_suppress'] and zmUtil.fleet_offline(
+            zmUtil.bulk_fleet_health(monitors),
+            ds0.params['offline_summary']
+            )
 
+        # Every monitor's online status from one pass over the Console
+        console_online = dict()
+        if console is not None and not shm_path:
             try:
-                # Version-specific API calls
-                if (versions['daemon']['major'] >= 1
-                        and versions['daemon']['minor'] >= 32):
-                    # API logout
-                    yield getPage(
-                        api_url + 'host/logout.json',
-                        method='GET',
-                        cookies=cookies
-                        )
-                else:
-                    # Browser-style log out
-                    # Doesn't work with 1.34.21
-                    yield getPage(
-                        base_url + 'index.php?action=logout',
-                        method='POST',
-                        cookies=cookies
-                        )
+                console_online = yield parser.parse(
+                    zmUtil.scrape_console_monitors,
+                    console,
+                    session.console_variant
+                    )
             except Exception:
-                LOG.exception('%s: failed to log out', config.id)
-
-            LOG.debug('%s: ZM monitor output:\n%s', config.id, output)
+                LOG.exception('%s: failed to scrape ZM web console', config.id)
 
+        for datasource in config.datasources:
+            comp_id = datasource.component.replace('zmMonitor', '')
             stats = dict()
 
-            if 'online' in output:
-                stats['online'] = output['online']
+            item = monitors.get(comp_id, dict())
+            monitor = item.get('Monitor', dict())
+
+            if shm_path:
+                # Online status, alarm state, time since the last frame,
+                # and on 1.34+ framerates
+                stats.update(zmShm.monitor_stats(
+                    zmShm.read(shm_path, comp_id)
+                    ))
+                # Unknown if the segment's layout isn't recognized
+                online = stats.pop('online', None)
+            elif console is None:
+                online = zmUtil.bulk_monitor_online(monitors.get(comp_id))
+            else:
+                online = console_online.get(comp_id, '')
 
-            monitor = output.get('monitor', dict()).get('Monitor', dict())
+            if online == '':
+                LOG.warn(
+                    '%s: %s not found in ZM web console',
+                    config.id,
+                    datasource.component
+                    )
+            elif online is not None:
+                stats['online'] = damper.update(
+                    (comp_id, 'online'),
+                    online,
+                    hold=hold
+                    )
 
-            if len(monitor) > 0:
-                stats['enabled'] = monitor.get('Enabled', '0')
+            # Status and enabled, at this slower rate, when MonitorStatus
+            # reports their composite health instead
+            if ds0.params['monitor_health'] and monitor:
+                stats['enabled'] = 1 if monitor.get('Enabled') == '1' else 0
+                if 'Monitor_Status' in item:
+                    status = item.get('Monitor_Status') or dict()
+                    stats['status'] = 1 if status.get('Status') == 'Connected' \
+                        else 0
 
             # 1.30 Framerates
             if 'CaptureFPS' in monitor:
@@ -219,23 +307,44 @@ class Monitor(PythonDataSourcePlugin):
                 stats['AnalysisFPS'] = monitor['AnalysisFPS']
 
             # 1.32 Monitor Status
-            stats.update(output.get('monitor', dict()).get(
-                'Monitor_Status',
-                dict()
-                ))
-
-            # 1.30
-            stats['status'] = 1 if output.get('status') else 0
-            # 1.32
-            stats['status'] = 1 if stats.get('Status', '') == 'Connected' \
-                else 0
-
-            events = output.get('results', list())
-            # "results" will be an empty *list* if no monitors have events
-            if len(events) > 0:
-                stats['events'] = int(events.get(comp_id, 0))
-            else:
-                stats['events'] = 0
+            stats.update(item.get('Monitor_Status') or dict())
+
+            # Sampled frame fetch time and how long it's been unchanged
+            stats.update(frames.get(comp_id, dict()))
+
+            # Framerates and bandwidth sampled during the cycle
+            if sampler:
+                stats.update(sampler.rollups(
+                    comp_id,
+                    ['CaptureFPS', 'AnalysisFPS', 'CaptureBandwidth'],
+                    datasource.cycletime
+                    ))
+
+            # Event counts, alarm frames, and seconds recorded
+            if events:
+                stats.update(tracker.delta(
+                    '/'.join((config.id, datasource.datasource)),
+                    comp_id
+                    ))
+
+            # Disk space used by events, in total and on the monitor's
+            # current storage volume
+            if events and ds0.params['disk_reconcile']:
+                (usage, approximate) = tracker.disk_usage(comp_id)
+                stats['event-disk'] = sum(usage.values())
+                stats['event-disk-approximate'] = 1 if approximate else 0
+                if monitor:
+                    stats['event-disk-volume'] = usage.get(
+                        str(monitor.get('StorageId') or 0),
+                        0
+                        )
+
+            LOG.debug(
+                '%s: ZM monitor %s output:\n%s',
+                config.id,
+                comp_id,
+                stats
+                )
 
             for datapoint_id in (x.id for x in datasource.points):
                 if datapoint_id not in stats:
@@ -0,0 +1,255 @@
+"""Checks ZoneMinder monitor processes using one bulk JSON API call"""
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import re
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from Products.DataCollector.plugins.DataMaps import ObjectMap
+
+from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
+    PythonDataSourcePlugin
+    )
+
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmDb,
+    zmFlap,
+    zmParse,
+    zmSchedule,
+    zmSession,
+    zmTransport,
+    zmUtil
+    )
+
+# Seconds to wait for ZenHub to apply a monitor's new Function and
+# Enabled, seen in the datasource's parameters, before sending it again
+CONFIRM_TIMEOUT = 900
+
+# Function and Enabled sent to ZenHub and not yet seen applied,
+# by (device ID, monitor ID): (values, when sent)
+unconfirmed = dict()
+
+
+class MonitorStatus(PythonDataSourcePlugin):
+    """ZoneMinder monitor status data source plugin"""
+
+    @classmethod
+    def config_key(cls, datasource, context):
+        # All of a device's monitors share one config and one request
+        return(
+            context.device().id,
+            datasource.getCycleTime(context),
+            'zoneminder-monitor-status',
+            )
+
+    @classmethod
+    def params(cls, datasource, context):
+        params = zmUtil.session_params(context)
+        params.update({
+            'flap_samples': context.zZoneMinderFlapSamples,
+            'flap_window': context.zZoneMinderFlapWindow,
+            'offline_summary': context.zZoneMinderOfflineSummary,
+            'offline_suppress': context.zZoneMinderOfflineSuppress,
+            'monitor_health': context.zZoneMinderMonitorHealth,
+            # As modeled, telling which changes ZenHub has applied
+            'modeled_function': {
+                'Function': context.Function,
+                'Enabled': context.Enabled,
+                },
+            })
+        return params
+
+    @inlineCallbacks
+    def collect(self, config):
+        data = self.new_data()
+        ds0 = config.datasources[0]
+
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, ds0)
+
+        username = ds0.params['username']
+        password = ds0.params['password']
+
+        if not username or not password:
+            LOG.error(
+                '%s: zZoneMinderUsername or zZoneMinderPassword not set',
+                config.id
+                )
+            returnValue(None)
+
+        base_url = zmUtil.generate_zm_url(
+            hostname=ds0.params['hostname'] or config.id,
+            port=ds0.params['port'] or 443,
+            path=ds0.params['path'] or '/zm/',
+            ssl=ds0.params['ssl'] or True,
+            url=ds0.params['base_url']
+            )
+
+        if re.match(zmUtil.url_regex, base_url) is None:
+            LOG.error('%s: %s is not a valid URL', config.id, base_url)
+            returnValue(None)
+
+        transport = zmTransport.get_transport(
+            config.id,
+            ds0.datasource,
+            capture_dir=ds0.params['capture_dir'],
+            replay_dir=ds0.params['replay_dir'],
+            realtime=ds0.params['replay_realtime'],
+            rate=ds0.params['rate_limit'],
+            burst=ds0.params['rate_burst']
+            )
+        parser = zmParse.Parser(config.id, ds0.params['parse_threshold'])
+        session = zmSession.get_session(
+            config.id,
+            base_url,
+            username,
+            password,
+            cache_dir=ds0.params['cache_dir'],
+            db=zmDb.get_backend(
+                ds0.params['db_host'],
+                ds0.params['db_port'],
+                ds0.params['db_user'],
+                ds0.params['db_password'],
+                ds0.params['db_name'],
+                ds0.params['db_module']
+                )
+            )
+
+        try:
+            # Enabled, and on 1.32+ process status, for every monitor
+            monitors = zmUtil.monitors_by_id((yield session.bulk(
+                transport,
+                parser,
+                'monitors.json',
+                max_age=ds0.cycletime / 2.0
+                )))
+            bulk_status = yield session.supports(transport, parser, 1, 32)
+        except zmSession.LoginError as e:
+            LOG.error('%s: %s', config.id, e)
+            returnValue(None)
+        except Exception:
+            LOG.exception('%s: failed to get monitor status', config.id)
+            returnValue(None)
+
+        # Functions and Enabled changed from those modeled, such as by a
+        # run state change, are updated together in one batch by ZenHub.
+        now = time.time()
+        for datasource in config.datasources:
+            comp_id = datasource.component.replace('zmMonitor', '')
+            if comp_id not in monitors:
+                continue
+            current = zmUtil.bulk_monitor_function(monitors[comp_id])
+            key = (config.id, comp_id)
+            if current == datasource.params['modeled_function']:
+                unconfirmed.pop(key, None)
+                continue
+            (sent, when) = unconfirmed.get(key, (None, 0))
+            if sent == current and now - when < CONFIRM_TIMEOUT:
+                continue
+            data['maps'].append(ObjectMap(
+                modname='ZenPacks.daviswr.ZoneMinder.ZMMonitor',
+                compname='zoneMinder/ZoneMinder/zmMonitors/{0}'.format(
+                    datasource.component
+                    ),
+                data=current
+                ))
+            unconfirmed[key] = (current, now)
+        if data['maps']:
+            LOG.debug(
+                '%s: updating %s monitors\' functions',
+                config.id,
+                len(data['maps'])
+                )
+
+        # Status changes only reported once they've held a while
+        damper = zmFlap.get_damper(
+            config.id,
+            ds0.params['flap_samples'],
+            ds0.params['flap_window']
+            )
+        # and not at all while the DaemonStatus datasource's summary
+        # event covers a mass outage, if wanted
+        hold = ds0.params['offline_suppress'] and zmUtil.fleet_offline(
+            zmUtil.bulk_fleet_health(monitors),
+            ds0.params['offline_summary']
+            )
+
+        for datasource in config.datasources:
+            comp_id = datasource.component.replace('zmMonitor', '')
+            item = monitors.get(comp_id)
+            if item is None:
+                LOG.warn(
+                    '%s: %s not found in monitors.json',
+                    config.id,
+                    datasource.component
+                    )
+                continue
+
+            stats = dict()
+            stats['enabled'] = item.get('Monitor', dict()).get('Enabled', '0')
+
+            if bulk_status:
+                # 1.32
+                status = item.get('Monitor_Status') or dict()
+                stats['status'] = 1 if status.get('Status') == 'Connected' \
+                    else 0
+            else:
+                # 1.30 monitors.json has no process status
+                try:
+                    response = yield session.api(
+                        transport,
+                        'monitors/daemonStatus/id:{0}/daemon:zmc.json'.format(
+                            comp_id
+                            )
+                        )
+                    status = yield parser.loads(response)
+                    stats['status'] = 1 if status.get('status') else 0
+                except Exception:
+                    LOG.exception(
+                        '%s: failed to get %s status',
+                        config.id,
+                        datasource.component
+                        )
+
+            # One composite value in place of status and enabled,
+            # which the Monitor datasource reports instead
+            if ds0.params['monitor_health']:
+                stats = {'health': zmUtil.bulk_monitor_health(
+                    item,
+                    None if bulk_status else stats.get('status')
+                    )}
+
+            for key in ['status', 'enabled', 'health']:
+                if key in stats:
+                    stats[key] = damper.update(
+                        (comp_id, key),
+                        int(stats[key]),
+                        hold=hold
+                        )
+            stats['flaps'] = damper.flaps(
+                (comp_id, 'health' if 'health' in stats else 'status')
+                )
+
+            LOG.debug(
+                '%s: ZM monitor %s status:\n%s',
+                config.id,
+                comp_id,
+                stats
+                )
+
+            for datapoint_id in (x.id for x in datasource.points):
+                if datapoint_id not in stats:
+                    continue
+
+                try:
+                    value = int(stats.get(datapoint_id))
+                except (TypeError, ValueError):
+                    continue
+
+                dpname = '_'.join((datasource.datasource, datapoint_id))
+                data['values'][datasource.component][dpname] = (value, 'N')
+
+        returnValue(data)
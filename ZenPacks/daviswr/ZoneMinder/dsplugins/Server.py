@@ -0,0 +1,285 @@
+"""Monitors ZoneMinder recording servers using each one's own JSON API"""
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import re
+
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
+
+from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
+    PythonDataSourcePlugin
+    )
+
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmDb,
+    zmParse,
+    zmSchedule,
+    zmSession,
+    zmTransport,
+    zmUtil
+    )
+
+
+class Server(PythonDataSourcePlugin):
+    """ZoneMinder server data source plugin"""
+
+    @classmethod
+    def config_key(cls, datasource, context):
+        # All of a device's servers share a config, to be collected at once
+        return(
+            context.device().id,
+            datasource.getCycleTime(context),
+            'zoneminder-server',
+            )
+
+    @classmethod
+    def params(cls, datasource, context):
+        params = zmUtil.session_params(context)
+        params.update({
+            'server_url': context.url,
+            })
+        return params
+
+    @inlineCallbacks
+    def collect(self, config):
+        data = self.new_data()
+
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, config.datasources[0])
+
+        # Every server's load and memory, as recorded by zmstats,
+        # from one request to the device
+        resources = yield self.collect_resources(
+            config,
+            config.datasources[0]
+            )
+
+        # Servers are asked about themselves in parallel, so one slow
+        # server doesn't hold up the rest
+        results = yield DeferredList(
+            [self.collect_server(
+                config,
+                datasource,
+                resources.get(datasource.component, dict())
+                ) for datasource in config.datasources],
+            consumeErrors=True
+            )
+
+        for (datasource, (success, stats)) in zip(config.datasources,
+                                                  results):
+            if not success:
+                LOG.error(
+                    '%s: failed to get %s data: %s',
+                    config.id,
+                    datasource.component,
+                    stats.getErrorMessage()
+                    )
+                continue
+
+            for datapoint_id in (x.id for x in datasource.points):
+                if datapoint_id not in stats:
+                    continue
+
+                try:
+                    if (datapoint_id.startswith('load-')
+                            or datapoint_id.endswith('-percent')):
+                        value = float(stats.get(datapoint_id))
+                    else:
+                        value = int(stats.get(datapoint_id))
+                except (TypeError, ValueError):
+                    continue
+
+                dpname = '_'.join((datasource.datasource, datapoint_id))
+                data['values'][datasource.component][dpname] = (value, 'N')
+
+        returnValue(data)
+
+    @inlineCallbacks
+    def collect_resources(self, config, datasource):
+        """ Returns a deferred dict of servers.json resource stats
+            by component ID
+        """
+        username = datasource.params['username']
+        password = datasource.params['password']
+        hostname = datasource.params['hostname']
+        port = datasource.params['port']
+        path = datasource.params['path']
+        ssl = datasource.params['ssl']
+        base_url = datasource.params['base_url']
+
+        if not username or not password:
+            returnValue(dict())
+
+        base_url = zmUtil.generate_zm_url(
+            hostname=hostname or config.id,
+            port=port or 443,
+            path=path or '/zm/',
+            ssl=ssl or True,
+            url=base_url
+            )
+
+        if re.match(zmUtil.url_regex, base_url) is None:
+            LOG.error('%s: %s is not a valid URL', config.id, base_url)
+            returnValue(dict())
+
+        transport = zmTransport.get_transport(
+            config.id,
+            datasource.datasource,
+            capture_dir=datasource.params['capture_dir'],
+            replay_dir=datasource.params['replay_dir'],
+            realtime=datasource.params['replay_realtime'],
+            rate=datasource.params['rate_limit'],
+            burst=datasource.params['rate_burst']
+            )
+        parser = zmParse.Parser(
+            config.id,
+            datasource.params['parse_threshold']
+            )
+        session = zmSession.get_session(
+            config.id,
+            base_url,
+            username,
+            password,
+            cache_dir=datasource.params['cache_dir'],
+            db=zmDb.get_backend(
+                datasource.params['db_host'],
+                datasource.params['db_port'],
+                datasource.params['db_user'],
+                datasource.params['db_password'],
+                datasource.params['db_name'],
+                datasource.params['db_module']
+                )
+            )
+
+        output = dict()
+        try:
+            servers = yield session.bulk(transport, parser, 'servers.json')
+        except zmSession.LoginError as e:
+            LOG.error('%s: %s', config.id, e)
+            returnValue(output)
+        except Exception:
+            LOG.exception('%s: failed to get server list', config.id)
+            returnValue(output)
+
+        for item in servers.get('servers', list()):
+            server = item.get('Server', dict())
+            if server.get('Id'):
+                output['zmServer{0}'.format(server['Id'])] = \
+                    zmUtil.server_resources(server)
+
+        LOG.debug('%s: ZM server resources:\n%s', config.id, output)
+
+        returnValue(output)
+
+    @inlineCallbacks
+    def collect_server(self, config, datasource, resources):
+        """ Returns a deferred dict of one server's stats, starting
+            from its servers.json resources
+        """
+        # LOG.debug('%s: parameters\n%s', config.id, datasource.params)
+        username = datasource.params['username']
+        password = datasource.params['password']
+        base_url = datasource.params['server_url']
+
+        if not username or not password:
+            LOG.error(
+                '%s: zZoneMinderUsername or zZoneMinderPassword not set',
+                config.id
+                )
+            returnValue(dict())
+
+        if re.match(zmUtil.url_regex, base_url or '') is None:
+            LOG.error(
+                '%s: %s URL %s is not valid',
+                config.id,
+                datasource.component,
+                base_url
+                )
+            returnValue(dict())
+        else:
+            LOG.debug(
+                '%s: using %s ZoneMinder URL %s',
+                config.id,
+                datasource.component,
+                base_url
+                )
+
+        transport = zmTransport.get_transport(
+            config.id,
+            '_'.join((datasource.datasource, datasource.component)),
+            capture_dir=datasource.params['capture_dir'],
+            replay_dir=datasource.params['replay_dir'],
+            realtime=datasource.params['replay_realtime'],
+            rate=datasource.params['rate_limit'],
+            burst=datasource.params['rate_burst']
+            )
+        parser = zmParse.Parser(
+            config.id,
+            datasource.params['parse_threshold']
+            )
+        # Each server has its own login, shared with the device's
+        # only if it is also the API host
+        session = zmSession.get_session(
+            '/'.join((config.id, datasource.component)),
+            base_url,
+            username,
+            password,
+            cache_dir=datasource.params['cache_dir'],
+            db=zmDb.get_backend(
+                datasource.params['db_host'],
+                datasource.params['db_port'],
+                datasource.params['db_user'],
+                datasource.params['db_password'],
+                datasource.params['db_name'],
+                datasource.params['db_module']
+                )
+            )
+
+        output = dict(resources)
+        try:
+            # Daemon status
+            output['status'] = (yield session.bulk(
+                transport,
+                parser,
+                'host/daemonCheck.json'
+                )).get('result')
+
+            # Host Load
+            # Unnecessary when zmstats records it, though that's only
+            # the 1-minute average
+            if 'load-1' not in output:
+                load = (yield session.bulk(
+                    transport,
+                    parser,
+                    'host/getLoad.json'
+                    )).get('load', list())
+                if len(load) >= 3:
+                    (output['load-1'],
+                     output['load-5'],
+                     output['load-15']) = load
+
+            # Console, for shared memory utilization
+            response = yield session.console(transport)
+            output['devshm'] = yield parser.parse(
+                zmUtil.scrape_console_shm,
+                response
+                )
+
+        except zmSession.LoginError as e:
+            LOG.error('%s: %s: %s', config.id, datasource.component, e)
+        except Exception:
+            LOG.exception(
+                '%s: failed to get %s data',
+                config.id,
+                datasource.component
+                )
+
+        LOG.debug(
+            '%s: ZM %s output:\n%s',
+            config.id,
+            datasource.component,
+            output
+            )
+
+        returnValue(output)
@@ -0,0 +1,94 @@
+"""Probes ZoneMinder monitors' camera sources directly"""
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
+    PythonDataSourcePlugin
+    )
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmProbe, zmSchedule, zmUtil
+
+
+class SourceProbe(PythonDataSourcePlugin):
+    """ZoneMinder monitor source probe data source plugin"""
+
+    @classmethod
+    def config_key(cls, datasource, context):
+        # All of a device's monitors share a config, to be probed at once
+        return(
+            context.device().id,
+            datasource.getCycleTime(context),
+            'zoneminder-probe',
+            )
+
+    @classmethod
+    def params(cls, datasource, context):
+        params = zmUtil.schedule_params(context)
+        params.update({
+            'source_probe': context.zZoneMinderSourceProbe,
+            'probe_concurrency': context.zZoneMinderSourceProbeConcurrency,
+            'probe_rate': context.zZoneMinderSourceProbeRate,
+            'probe_timeout': context.zZoneMinderSourceProbeTimeout,
+            'source': {
+                'Host': getattr(context, 'Host', ''),
+                'Port': getattr(context, 'Port', None),
+                'Protocol': getattr(context, 'Protocol', ''),
+                'Path': getattr(context, 'Path', ''),
+                },
+            })
+        return params
+
+    @inlineCallbacks
+    def collect(self, config):
+        data = self.new_data()
+        ds0 = config.datasources[0]
+
+        mode = (ds0.params['source_probe'] or '').strip().lower()
+        if not mode:
+            returnValue(data)
+        elif mode not in (zmProbe.MODE_TCP, zmProbe.MODE_RTSP):
+            LOG.error(
+                '%s: zZoneMinderSourceProbe %s is not tcp or rtsp',
+                config.id,
+                mode
+                )
+            returnValue(data)
+
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, ds0)
+
+        # Every camera from one task, rather than one per monitor
+        results = yield zmProbe.probe_sources(
+            dict((datasource.component, datasource.params['source'])
+                 for datasource in config.datasources),
+            mode,
+            ds0.params['probe_concurrency'] or 1,
+            ds0.params['probe_rate'] or 0,
+            ds0.params['probe_timeout'] or 5
+            )
+
+        for datasource in config.datasources:
+            stats = results.get(datasource.component)
+            if stats is None:
+                # No network source, such as a local device or file
+                continue
+
+            LOG.debug(
+                '%s: ZM %s source probe output:\n%s',
+                config.id,
+                datasource.component,
+                stats
+                )
+
+            for datapoint_id in (x.id for x in datasource.points):
+                if datapoint_id not in stats:
+                    continue
+
+                value = stats.get(datapoint_id)
+                dpname = '_'.join((datasource.datasource, datapoint_id))
+                data['values'][datasource.component][dpname] = (value, 'N')
+
+        returnValue(data)
@@ -3,18 +3,23 @@
 import logging
 LOG = logging.getLogger('zen.ZoneMinder')
 
-import json
 import re
-import urllib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
 
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmAdapt,
+    zmDb,
+    zmParse,
+    zmSchedule,
+    zmSession,
+    zmTransport,
+    zmUtil
+    )
 
 
 class Storage(PythonDataSourcePlugin):
@@ -31,20 +36,19 @@ class Storage(PythonDataSourcePlugin):
 
     @classmethod
     def params(cls, datasource, context):
-        return {
-            'username': context.zZoneMinderUsername,
-            'password': context.zZoneMinderPassword,
-            'hostname': context.zZoneMinderHostname,
-            'port': context.zZoneMinderPort,
-            'path': context.zZoneMinderPath,
-            'ssl': context.zZoneMinderSSL,
-            'base_url': context.zZoneMinderURL,
-            }
+        params = zmUtil.session_params(context)
+        params.update({
+            'adaptive_stretch': context.zZoneMinderAdaptiveStretch,
+            })
+        return params
 
     @inlineCallbacks
     def collect(self, config):
         data = self.new_data()
 
+        # Spread devices' collection across the cycle
+        yield zmSchedule.stagger(config.id, config.datasources[0])
+
         for datasource in config.datasources:
             # LOG.debug('%s: parameters\n%s', config.id, datasource.params)
             username = datasource.params['username']
@@ -81,48 +85,53 @@ class Storage(PythonDataSourcePlugin):
                     base_url
                     )
 
-            login_params = urllib.urlencode({
-                'action': 'login',
-                'view': 'login',
-                'username': username,
-                'password': password,
-                # 1.34+ requires OPT_USE_LEGACY_API_AUTH
-                'stateful': 1,
-                })
-            login_url = '{0}index.php?{1}'.format(base_url, login_params)
-            api_url = '{0}api/'.format(base_url)
-
-            cookies = dict()
-            try:
-                # Attempt login
-                login_response = yield getPage(
-                    login_url,
-                    method='POST',
-                    cookies=cookies
+            transport = zmTransport.get_transport(
+                config.id,
+                '_'.join((datasource.datasource, datasource.component)),
+                capture_dir=datasource.params['capture_dir'],
+                replay_dir=datasource.params['replay_dir'],
+                realtime=datasource.params['replay_realtime'],
+                rate=datasource.params['rate_limit'],
+                burst=datasource.params['rate_burst']
+                )
+            parser = zmParse.Parser(
+                config.id,
+                datasource.params['parse_threshold']
+                )
+            session = zmSession.get_session(
+                config.id,
+                base_url,
+                username,
+                password,
+                cache_dir=datasource.params['cache_dir'],
+                db=zmDb.get_backend(
+                    datasource.params['db_host'],
+                    datasource.params['db_port'],
+                    datasource.params['db_user'],
+                    datasource.params['db_password'],
+                    datasource.params['db_name'],
+                    datasource.params['db_module']
                     )
+                )
 
-                if 'Invalid username or password' in login_response:
-                    LOG.error(
-                        '%s: ZoneMinder login credentials invalid',
-                        config.id,
-                        )
-                    returnValue(None)
-                elif not cookies:
-                    LOG.error('%s: No cookies received', config.id)
-                    returnValue(None)
+            # Non-essential, so held back while ZoneMinder is loaded
+            if not zmAdapt.get_governor(session).allow(
+                    config.id,
+                    '/'.join((datasource.datasource, datasource.component)),
+                    datasource.cycletime,
+                    datasource.params['adaptive_stretch']
+                    ):
+                continue
 
+            try:
                 # Console
-                # Session cookies on 1.34 require view=login on action=login
-                # This returns a 302 to the console page
-                # rather than just the console
-                response = yield getPage(
-                    '{0}index.php?view=console'.format(base_url),
-                    method='GET',
-                    cookies=cookies
-                    )
+                response = yield session.console(transport)
 
                 # Scrape storage info from HTML
-                volumes = zmUtil.scrape_console_volumes(response)
+                volumes = yield parser.parse(
+                    zmUtil.scrape_console_volumes,
+                    response
+                    )
 
                 if comp_id not in volumes:
                     LOG.warn(
@@ -131,42 +140,20 @@ class Storage(PythonDataSourcePlugin):
                         datasource.component
                         )
 
-                # Versions
-                response = yield getPage(
-                    api_url + 'host/getVersion.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                versions = zmUtil.dissect_versions(json.loads(response))
-
                 storage = list()
                 # 1.32+ required for storage.json
-                if (versions['daemon']['major'] >= 1
-                        and versions['daemon']['minor'] >= 32):
+                if (yield session.supports(transport, parser, 1, 32)):
                     # Storage
-                    response = yield getPage(
-                        api_url + 'storage.json',
-                        method='GET',
-                        cookies=cookies
-                        )
-                    storage = json.loads(response).get('storage', list())
-
-                    # API logout
-                    yield getPage(
-                        api_url + 'host/logout.json',
-                        method='GET',
-                        cookies=cookies
-                        )
-
-                else:
-                    # Browser-style log out
-                    # Doesn't work with 1.34.21
-                    yield getPage(
-                        base_url + 'index.php?action=logout',
-                        method='POST',
-                        cookies=cookies
-                        )
-            except Exception, e:
+                    storage = (yield session.bulk(
+                        transport,
+                        parser,
+                        'storage.json'
+                        )).get('storage', list())
+
+            except zmSession.LoginError as e:
+                LOG.error('%s: %s', config.id, e)
+                returnValue(None)
+            except Exception:
                 LOG.exception('%s: failed to get store data', config.id)
                 continue
 
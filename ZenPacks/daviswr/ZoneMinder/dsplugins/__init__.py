@@ -1,3 +1,7 @@
 from Daemon import Daemon
+from DaemonStatus import DaemonStatus
 from Monitor import Monitor
+from MonitorStatus import MonitorStatus
+from Server import Server
+from SourceProbe import SourceProbe
 from Storage import Storage
@@ -0,0 +1,104 @@
+""" Polls non-essential endpoints less often while ZoneMinder is loaded """
+
+import logging
+import time
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmSession
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Full polling resumes once load and database connection use are back
+# under this fraction of their limits, so it doesn't flap at a limit
+RECOVERY = 0.8
+
+# Governors by session key, as devices sharing a session share a host
+governors = dict()
+
+
+def get_governor(session):
+    """ Returns the governor for a session's ZoneMinder host """
+    governor = governors.get(session.key)
+    if governor is None:
+        governor = governors[session.key] = Governor()
+    return governor
+
+
+def released(device_id, session, idle):
+    """ Forgets the governor of a session no device uses any more """
+    if session is not None:
+        governors.pop(session.key, None)
+
+
+zmSession.add_release_observer(released)
+
+
+class Governor(object):
+    """ Decides from the host's load whether non-essential requests,
+        such as events, storage, and the Console page, are held back
+    """
+
+    def __init__(self):
+        # Latest load-1 per core, and percentage of database connections
+        # in use, either of which may not have been read yet
+        self.load = None
+        self.db = None
+        self.loaded = False
+        # (device ID, name): when last allowed
+        self.allowed = dict()
+        # Device ID: requests held back since last reported
+        self.deferred = dict()
+
+    def update(self, device_id, load_limit, db_limit, load=None, cores=1,
+               db_used=None, db_max=None):
+        """ Records the host's load-1 and database connection counts,
+            keeping the last of any not given, and decides whether it is
+            loaded. Limits of 0 disable their check. Returns whether loaded.
+        """
+        if load is not None:
+            self.load = float(load) / max(int(cores or 1), 1)
+        # Counts not found on the Console page are blank
+        if db_used not in (None, '') and db_max:
+            self.db = 100.0 * float(db_used) / float(db_max)
+
+        pressure = max([0] + [
+            value / limit
+            for (value, limit) in ((self.load, load_limit),
+                                   (self.db, db_limit))
+            if value is not None and limit > 0
+            ])
+        loaded = pressure >= (RECOVERY if self.loaded else 1)
+        if loaded != self.loaded:
+            LOG.info(
+                '%s: ZoneMinder %s, %s non-essential polling '
+                '(load-1 per core %s, %s%% database connections)',
+                device_id,
+                'loaded' if loaded else 'recovered',
+                'deferring' if loaded else 'resuming',
+                'unknown' if self.load is None else round(self.load, 2),
+                'unknown' if self.db is None else int(self.db)
+                )
+        self.loaded = loaded
+        return loaded
+
+    def allow(self, device_id, name, interval, stretch, now=None):
+        """ Returns whether a device may make a non-essential request,
+            normally polled every interval seconds. While loaded, it is
+            only allowed every stretch intervals, and counted otherwise.
+        """
+        now = now or time.time()
+        key = (device_id, name)
+        last = self.allowed.get(key)
+        # Half an interval's slack, for collection jitter
+        if (self.loaded and last is not None
+                and now - last < interval * (max(stretch, 1) - 0.5)):
+            self.deferred[device_id] = self.deferred.get(device_id, 0) + 1
+            LOG.debug('%s: deferring %s while loaded', device_id, name)
+            return False
+        self.allowed[key] = now
+        return True
+
+    def pop_deferred(self, device_id):
+        """ Returns how many of a device's requests were held back since
+            last asked, resetting the count
+        """
+        return self.deferred.pop(device_id, 0)
@@ -0,0 +1,333 @@
+""" Runs the ZoneMinder modeler and datasource plugins outside Zenoss """
+
+import argparse
+import getpass
+import importlib
+import logging
+import os
+import pprint
+import sys
+import time
+import urlparse
+
+import yaml
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmTransport
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+YAML_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    'zenpack.yaml'
+    )
+
+
+class Stub(object):
+    """ Stand-in for a device, component, datasource, or datapoint """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '<{0}>'.format(getattr(self, 'id', self.__class__.__name__))
+
+
+class Timer(object):
+    """ Tracks the wall-clock and request time of each collection step """
+
+    def __init__(self):
+        self.steps = list()
+        self.requests = list()
+        zmTransport.add_observer(self.observe)
+
+    def observe(self, method, url, elapsed, size, message):
+        """ zmTransport request observer """
+        self.requests.append((method, url, elapsed, size, message))
+
+    @inlineCallbacks
+    def time(self, name, func, *args, **kwargs):
+        """ Calls a function and records how long it and its requests took """
+        first_request = len(self.requests)
+        started = time.time()
+        result = yield func(*args, **kwargs)
+        elapsed = time.time() - started
+        requests = self.requests[first_request:]
+        self.steps.append((name, elapsed, requests))
+        print_requests(requests)
+        print('{0}: {1:.3f}s total, {2:.3f}s in {3} requests'.format(
+            name,
+            elapsed,
+            sum(request[2] for request in requests),
+            len(requests)
+            ))
+        returnValue(result)
+
+
+def print_requests(requests):
+    """ Prints per-request timings """
+    for (method, url, elapsed, size, message) in requests:
+        print('  {0:8.3f}s {1:>9} {2:4} {3}{4}'.format(
+            elapsed,
+            size,
+            method,
+            url,
+            ' ({0})'.format(message) if message else ''
+            ))
+
+
+def load_zenpack_yaml():
+    """ Returns zProperty defaults and Python datasources by target class """
+    with open(YAML_PATH) as yaml_file:
+        spec = yaml.safe_load(yaml_file)
+
+    # Zenoss' own defaults for zProperties declared without one
+    type_defaults = {
+        'boolean': False,
+        'int': 0,
+        'float': 0.0,
+        'lines': list(),
+        'list': list(),
+        }
+
+    properties = dict()
+    for (name, prop) in spec.get('zProperties', dict()).items():
+        if name != 'DEFAULTS':
+            properties[name] = prop.get(
+                'default',
+                type_defaults.get(prop.get('type'), '')
+                )
+
+    datasources = dict()
+    templates = spec['device_classes']['/']['templates']
+    for template in templates.values():
+        target = template.get('targetPythonClass')
+        for (ds_name, ds) in template.get('datasources', dict()).items():
+            if ds.get('type') != 'Python':
+                continue
+            datasources.setdefault(target, list()).append(Stub(
+                id=ds_name,
+                plugin_classname=ds['plugin_classname'],
+                cycletime=int(ds.get('cycletime', 300)),
+                points=[Stub(id=dp) for dp in ds.get('datapoints', dict())],
+                ))
+            datasources[target][-1].getCycleTime = (
+                lambda context, ds=datasources[target][-1]: ds.cycletime
+                )
+
+    return (properties, datasources)
+
+
+def import_class(classname):
+    """ Imports a class by its dotted name """
+    (module_name, class_name) = classname.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def components_from_maps(maps):
+    """ Returns component IDs and attributes by class from modeler maps """
+    components = dict()
+    for rm in maps or list():
+        for om in getattr(rm, 'maps', list()):
+            components.setdefault(rm.modname, list()).append(om)
+    return components
+
+
+@inlineCallbacks
+def run(options):
+    """ Models the device, then runs each datasource plugin against it """
+    from ZenPacks.daviswr.ZoneMinder.modeler.plugins.daviswr.python.ZoneMinder import ZoneMinder  # noqa
+
+    (properties, datasources) = load_zenpack_yaml()
+    properties.update({
+        'zZoneMinderUsername': options.username,
+        'zZoneMinderPassword': options.password,
+        'zZoneMinderURL': options.url,
+        'zZoneMinderCaptureDir': options.capture_dir,
+        'zZoneMinderReplayDir': options.replay_dir,
+        'zZoneMinderReplayRealtime': options.realtime,
+        'zZoneMinderCacheDir': options.cache_dir,
+        'zZoneMinderShmPath': options.shm_path,
+        'zZoneMinderEventServerURL': options.event_server,
+        'zZoneMinderEventServerAlarms': options.event_server_alarms,
+        # Only one device, so collect immediately
+        'zZoneMinderCollectionSpread': 0,
+        'zZoneMinderStartupRamp': 0,
+        })
+    # Database options left unset keep their zProperty defaults
+    for (name, value) in [
+            ('zZoneMinderDbHost', options.db_host),
+            ('zZoneMinderDbPort', options.db_port),
+            ('zZoneMinderDbUser', options.db_user),
+            ('zZoneMinderDbPassword', os.environ.get('ZM_DB_PASSWORD')),
+            ('zZoneMinderDbName', options.db_name),
+            ('zZoneMinderDbModule', options.db_module),
+            ]:
+        if value is not None:
+            properties[name] = value
+
+    device_id = options.device or urlparse.urlparse(options.url).hostname
+    device = Stub(id=device_id, manageIp=device_id, **properties)
+    timer = Timer()
+
+    # Modeling
+    modeler = ZoneMinder()
+    results = yield timer.time(
+        'Modeler collect',
+        modeler.collect,
+        device,
+        LOG
+        )
+    if not results:
+        print('Modeling failed')
+        return
+    started = time.time()
+    maps = modeler.process(device, results, LOG)
+    print('Modeler process: {0:.3f}s'.format(time.time() - started))
+    for rm in maps:
+        print(rm)
+        for om in rm.maps:
+            print('  {0}'.format(om))
+
+    # Collection
+    # Datasources are grouped into configs by config_key, as zenpython does
+    components = components_from_maps(maps)
+    by_id = dict(
+        (om.id, Stub(**om.__dict__))
+        for target_components in components.values()
+        for om in target_components
+        )
+    configs = list()
+    grouped = dict()
+    for (target, target_datasources) in sorted(datasources.items()):
+        for ds in target_datasources:
+            plugin_class = import_class(ds.plugin_classname)
+            for om in components.get(target, list()):
+                context_properties = dict(properties)
+                context_properties.update(om.__dict__)
+                context = Stub(**context_properties)
+                context.device = lambda: device
+                # Unlinked unless the modeler links it
+                context.zmServer = lambda: None
+                # Relationships set by the modeler, such as zmServer
+                for (name, value) in om.__dict__.items():
+                    if name.startswith('set_'):
+                        setattr(
+                            context,
+                            name[len('set_'):],
+                            lambda related=by_id.get(value): related
+                            )
+                key = plugin_class.config_key(ds, context)
+                if key not in grouped:
+                    grouped[key] = Stub(
+                        id=device_id,
+                        manageIp=device_id,
+                        datasources=list(),
+                        )
+                    configs.append((ds.id, plugin_class, grouped[key]))
+                grouped[key].datasources.append(Stub(
+                    datasource=ds.id,
+                    component=om.id,
+                    points=ds.points,
+                    cycletime=ds.cycletime,
+                    params=plugin_class.params(ds, context),
+                    ))
+
+    for cycle in range(options.cycles):
+        if cycle and options.interval:
+            yield deferLater(reactor, options.interval, lambda: None)
+        for (ds_id, plugin_class, config) in configs:
+            plugin = plugin_class()
+            data = yield timer.time(
+                '{0} {1} cycle {2}'.format(
+                    ds_id,
+                    ','.join(ds.component for ds in config.datasources),
+                    cycle + 1
+                    ),
+                plugin.collect,
+                config
+                )
+            pprint.pprint(data)
+
+    total_requests = sum(request[2] for request in timer.requests)
+    total_steps = sum(step[1] for step in timer.steps)
+    # Time outside requests was spent in the collector itself,
+    # including rate limiting
+    print('Total: {0:.3f}s, {1:.3f}s in {2} requests, {3:.3f}s other'.format(
+        total_steps,
+        total_requests,
+        len(timer.requests),
+        total_steps - total_requests
+        ))
+
+
+def main():
+    """ Console entry point """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('url', help='ZoneMinder base URL, ending in /')
+    parser.add_argument('-u', '--username', required=True)
+    parser.add_argument(
+        '-p', '--password',
+        default=os.environ.get('ZM_PASSWORD'),
+        help='Defaults to $ZM_PASSWORD, prompted for if not set'
+        )
+    parser.add_argument('-d', '--device', help='Device ID to report as')
+    parser.add_argument(
+        '-n', '--cycles',
+        type=int,
+        default=1,
+        help='Collection cycles to run after modeling'
+        )
+    parser.add_argument(
+        '-i', '--interval',
+        type=float,
+        default=0,
+        help='Seconds to wait between collection cycles'
+        )
+    parser.add_argument('--cache-dir', help='zZoneMinderCacheDir')
+    parser.add_argument('--capture-dir', help='zZoneMinderCaptureDir')
+    parser.add_argument('--replay-dir', help='zZoneMinderReplayDir')
+    parser.add_argument('--shm-path', help='zZoneMinderShmPath')
+    parser.add_argument('--event-server', help='zZoneMinderEventServerURL')
+    parser.add_argument(
+        '--event-server-alarms',
+        action='store_true',
+        help='zZoneMinderEventServerAlarms'
+        )
+    parser.add_argument('--db-host', help='zZoneMinderDbHost')
+    parser.add_argument('--db-port', type=int, help='zZoneMinderDbPort')
+    parser.add_argument('--db-user', help='zZoneMinderDbUser')
+    parser.add_argument('--db-name', help='zZoneMinderDbName')
+    parser.add_argument('--db-module', help='zZoneMinderDbModule')
+    parser.add_argument(
+        '--realtime',
+        action='store_true',
+        help='zZoneMinderReplayRealtime'
+        )
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args()
+
+    if not options.password:
+        options.password = getpass.getpass()
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=max(logging.DEBUG, logging.WARNING - 10 * options.verbose),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+        )
+
+    def finished(result):
+        if reactor.running:
+            reactor.stop()
+        return result
+
+    def start():
+        d = run(options)
+        d.addErrback(lambda failure: LOG.error(failure.getTraceback()))
+        d.addBoth(finished)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
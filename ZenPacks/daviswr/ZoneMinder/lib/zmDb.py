@@ -0,0 +1,240 @@
+""" Reads ZoneMinder's MySQL database directly rather than via its API """
+
+import datetime
+import decimal
+import importlib
+import logging
+
+from twisted.enterprise import adbapi
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# DB-API modules tried in order when zZoneMinderDbModule isn't set
+MODULES = ['MySQLdb', 'pymysql']
+POOL_MIN = 1
+POOL_MAX = 3
+CONNECT_TIMEOUT = 10
+
+# connect() keyword names for password, database, and connect timeout by
+# module. Others get the DB-API 2.0 suggested names and no timeout.
+CONNECT_ARGS = {
+    'MySQLdb': ('passwd', 'db', 'connect_timeout'),
+    'pymysql': ('password', 'database', 'connect_timeout'),
+    'mysql.connector': ('password', 'database', 'connection_timeout'),
+    }
+DEFAULT_CONNECT_ARGS = ('password', 'database', None)
+
+# API paths answered from the database, and the Backend methods to do so
+PATHS = {
+    'configs.json': 'configs',
+    'controls.json': 'controls',
+    'monitors.json': 'monitors',
+    'servers.json': 'servers',
+    'states.json': 'states',
+    'storage.json': 'storage',
+    }
+
+# Events columns used by zmEvents, when the schema has them
+EVENT_COLUMNS = [
+    'Id',
+    'MonitorId',
+    'StartTime',
+    'EndTime',
+    'AlarmFrames',
+    'Length',
+    'StorageId',
+    'DiskSpace',
+    ]
+
+# Backends by connection parameters, shared by every device using them
+backends = dict()
+
+
+def find_module(name=None):
+    """ Returns the name of an importable DB-API module, None if none are """
+    for module_name in [name] if name else MODULES:
+        try:
+            importlib.import_module(module_name)
+            return module_name
+        except ImportError:
+            continue
+    return None
+
+
+def get_backend(host, port, user, password, name, module=None):
+    """ Returns the shared backend for a database, None if not configured
+        or no DB-API module is available
+    """
+    if not host:
+        return None
+
+    key = (host, int(port or 3306), user, password, name, module)
+    backend = backends.get(key)
+    if backend is None:
+        module_name = find_module(module)
+        if module_name is None:
+            LOG.error(
+                'zZoneMinderDbHost is set but %s could not be imported',
+                module or ' or '.join(MODULES)
+                )
+            return None
+        backend = backends[key] = Backend(
+            module_name,
+            host,
+            int(port or 3306),
+            user,
+            password,
+            name
+            )
+    return backend
+
+
+def connect_kwargs(module_name, host, port, user, password, name):
+    """ Returns keyword arguments for a DB-API module's connect() """
+    (password_arg, name_arg, timeout_arg) = CONNECT_ARGS.get(
+        module_name,
+        DEFAULT_CONNECT_ARGS
+        )
+    kwargs = {
+        'host': host,
+        'port': port,
+        'user': user,
+        password_arg: password,
+        name_arg: name,
+        }
+    if timeout_arg:
+        kwargs[timeout_arg] = CONNECT_TIMEOUT
+    return kwargs
+
+
+def api_value(value):
+    """ Returns a column value as the API would encode it """
+    if value is None:
+        return None
+    elif isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, (decimal.Decimal, float, int, long)):
+        return str(value)
+    elif isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def api_rows(cursor_description, rows):
+    """ Returns rows as dicts of API-encoded values """
+    columns = [column[0] for column in cursor_description]
+    return [
+        dict(zip(columns, [api_value(value) for value in row]))
+        for row in rows
+        ]
+
+
+class Backend(object):
+    """ A connection pool to one ZoneMinder database """
+
+    def __init__(self, module_name, host, port, user, password, name):
+        self.name = '{0}@{1}:{2}/{3}'.format(user, host, port, name)
+        # Its settings, telling apart sessions using different databases
+        self.key = (module_name, host, port, user, password, name)
+        kwargs = connect_kwargs(module_name, host, port, user, password, name)
+        kwargs.update({
+            'cp_min': POOL_MIN,
+            'cp_max': POOL_MAX,
+            'cp_reconnect': True,
+            'cp_noisy': False,
+            })
+        self.pool = adbapi.ConnectionPool(module_name, **kwargs)
+        # Events table columns, looked up once
+        self.event_columns = None
+
+    def select(self, query, args=None):
+        """ Returns a deferred list of rows as dicts """
+        def interaction(cursor):
+            cursor.execute(query, args)
+            return api_rows(cursor.description, cursor.fetchall())
+        return self.pool.runInteraction(interaction)
+
+    @inlineCallbacks
+    def configs(self):
+        """ configs.json """
+        rows = yield self.select('SELECT Name, Value FROM Config')
+        returnValue({'configs': [{'Config': row} for row in rows]})
+
+    @inlineCallbacks
+    def controls(self):
+        """ controls.json """
+        rows = yield self.select('SELECT Id, Name, Type FROM Controls')
+        returnValue({'controls': [{'Control': row} for row in rows]})
+
+    @inlineCallbacks
+    def monitors(self):
+        """ monitors.json, with Monitor_Status on 1.32+ """
+        rows = yield self.select('SELECT * FROM Monitors ORDER BY Sequence')
+        monitors = [{'Monitor': row} for row in rows]
+        try:
+            statuses = yield self.select('SELECT * FROM Monitor_Status')
+        except Exception:
+            # 1.30 has no Monitor_Status table
+            returnValue({'monitors': monitors})
+        by_id = dict((row['MonitorId'], row) for row in statuses)
+        for item in monitors:
+            # None, as from the API, for a monitor zmc hasn't run
+            item['Monitor_Status'] = by_id.get(item['Monitor']['Id'])
+        returnValue({'monitors': monitors})
+
+    @inlineCallbacks
+    def states(self):
+        """ states.json """
+        rows = yield self.select('SELECT * FROM States')
+        returnValue({'states': [{'State': row} for row in rows]})
+
+    @inlineCallbacks
+    def servers(self):
+        """ servers.json """
+        rows = yield self.select('SELECT * FROM Servers')
+        returnValue({'servers': [{'Server': row} for row in rows]})
+
+    @inlineCallbacks
+    def storage(self):
+        """ storage.json """
+        rows = yield self.select('SELECT * FROM Storage')
+        returnValue({'storage': [{'Storage': row} for row in rows]})
+
+    @inlineCallbacks
+    def connections(self):
+        """ Returns database connections used and allowed, as scraped
+            from the Console page
+        """
+        used = yield self.select("SHOW GLOBAL STATUS LIKE 'Threads_connected'")
+        allowed = yield self.select("SHOW VARIABLES LIKE 'max_connections'")
+        output = dict()
+        if used:
+            output['db-used'] = int(used[0]['Value'])
+        if allowed:
+            output['db-max'] = int(allowed[0]['Value'])
+        returnValue(output)
+
+    @inlineCallbacks
+    def events(self, where, args, order, limit, offset=0):
+        """ Returns events like events/index.json, with pagination """
+        if self.event_columns is None:
+            columns = yield self.select('SHOW COLUMNS FROM Events')
+            present = set(row['Field'] for row in columns)
+            self.event_columns = [
+                column for column in EVENT_COLUMNS if column in present
+                ]
+        # Fetch one extra to know whether there's another page
+        rows = yield self.select(
+            'SELECT {0} FROM Events WHERE {1} ORDER BY {2} '
+            'LIMIT %s OFFSET %s'.format(
+                ', '.join(self.event_columns),
+                where,
+                order
+                ),
+            tuple(args) + (limit + 1, offset)
+            )
+        returnValue({
+            'events': [{'Event': row} for row in rows[:limit]],
+            'pagination': {'nextPage': len(rows) > limit},
+            })
@@ -0,0 +1,430 @@
+""" Incremental ZoneMinder event accounting by high-water mark """
+
+import logging
+import time
+
+from twisted.internet.defer import (
+    Deferred,
+    inlineCallbacks,
+    returnValue,
+    succeed
+    )
+from twisted.python.failure import Failure
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmSession
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Events requested per page, and pages per query per update. Any
+# backlog beyond this is picked up by the following updates.
+PAGE_SIZE = 100
+MAX_PAGES = 20
+# Updates within this many seconds of the last are shared
+MIN_INTERVAL = 30
+# In-progress events followed until they end, oldest dropped first
+MAX_OPEN = 1000
+# Hours between recounts of every event's disk space, correcting for
+# deleted events
+RECONCILE_INTERVAL = 24
+
+# Trackers by session key, shared by every device using the session
+trackers = dict()
+
+
+def get_tracker(device_id, session):
+    """ Returns the event tracker for a device's session. Its consumers
+        should be named for the device, as other devices may share it.
+    """
+    tracker = trackers.get(session.key)
+    if tracker is None or tracker.session is not session:
+        tracker = trackers[session.key] = Tracker(device_id, session)
+    return tracker
+
+
+def released(device_id, session, idle):
+    """ Forgets the tracker of a session no device uses any more """
+    tracker = trackers.get(session.key) if session is not None else None
+    if tracker is not None and tracker.session is session:
+        del trackers[session.key]
+
+
+zmSession.add_release_observer(released)
+
+
+def new_query(since, page):
+    """ Returns the API path and database query for a page of events
+        newer than an ID
+    """
+    return (
+        'events/index/Id%20>:{0}.json'
+        '?sort=Id&direction=asc&limit={1}&page={2}'.format(
+            since,
+            PAGE_SIZE,
+            page
+            ),
+        ('Id > %s', (since,), 'Id', PAGE_SIZE, (page - 1) * PAGE_SIZE),
+        )
+
+
+def ended_query(first, last, ended, page):
+    """ Returns the API path and database query for a page of events
+        in an ID range that ended at or after a time
+    """
+    return (
+        'events/index/Id%20>=:{0}/Id%20<=:{1}/EndTime%20>=:{2}.json'
+        '?sort=EndTime&direction=asc&limit={3}&page={4}'.format(
+            first,
+            last,
+            ended.replace(' ', '%20'),
+            PAGE_SIZE,
+            page
+            ),
+        (
+            'Id >= %s AND Id <= %s AND EndTime >= %s',
+            (first, last, ended),
+            'EndTime, Id',
+            PAGE_SIZE,
+            (page - 1) * PAGE_SIZE,
+            ),
+        )
+
+
+def reconcile_query(after, last):
+    """ Returns the API path and database query for the next events
+        up to an ID
+    """
+    return (
+        'events/index/Id%20>:{0}/Id%20<=:{1}.json'
+        '?sort=Id&direction=asc&limit={2}&page=1'.format(
+            after,
+            last,
+            PAGE_SIZE
+            ),
+        ('Id > %s AND Id <= %s', (after, last), 'Id', PAGE_SIZE, 0),
+        )
+
+
+# Newest event, where counting starts from
+LATEST_QUERY = (
+    'events/index.json?sort=Id&direction=desc&limit=1',
+    ('1 = 1', (), 'Id DESC', 1, 0),
+    )
+
+
+def disk_key(monitor_id, storage_id):
+    """ Returns the disk usage key for a monitor's events on a volume """
+    return '{0}:{1}'.format(monitor_id, storage_id)
+
+
+def event_fields(item):
+    """ Returns the fields used from an events/index.json entry """
+    event = item.get('Event', dict())
+    output = {
+        'id': int(event['Id']),
+        'monitor': str(event.get('MonitorId', '')),
+        'start': event.get('StartTime') or '',
+        'end': event.get('EndTime') or '',
+        # 1.30 has neither StorageId nor DiskSpace
+        'storage': str(event.get('StorageId') or 0),
+        }
+    for (key, name, cast) in [
+            ('alarm_frames', 'AlarmFrames', int),
+            ('length', 'Length', float),
+            ('disk', 'DiskSpace', int),
+            ]:
+        try:
+            output[key] = cast(event.get(name) or 0)
+        except ValueError:
+            output[key] = cast(0)
+    return output
+
+
+class Tracker(object):
+    """ Counts a device's events without rescanning the Events table """
+
+    def __init__(self, device_id, session):
+        self.device_id = device_id
+        self.session = session
+        # Highest event ID seen, resumed from the session cache
+        self.hwm = session.state.get('events_hwm')
+        # High-water mark counting started from. Events after it have
+        # been counted as they ended.
+        self.origin = session.state.get('events_origin')
+        # ID: StartTime of events seen before they ended
+        self.open = dict(
+            (int(event_id), start)
+            for (event_id, start) in session.state.get('events_open', list())
+            )
+        # Latest EndTime seen while looking for open events to end,
+        # in ZoneMinder's local time
+        self.ended = session.state.get('events_ended')
+        # disk_key(): bytes used by ended events, valid once reconciled
+        self.disk = session.state.get('events_disk', dict())
+        self.reconciled = session.state.get('events_reconciled', 0)
+        # Reconciliation in progress, if any
+        self.scan = session.state.get('events_scan')
+        # Monitor ID or 'daemon': cumulative counter name: value
+        self.counters = dict()
+        # Consumer name: counters when it last read them
+        self.cursors = dict()
+        # IDs of events counted from alarms pushed by the Event
+        # Notification Server, not to be counted again when queried
+        self.pushed = set()
+        self.updated = 0
+        self.waiting = list()
+
+    def update(self, transport, parser, reconcile=RECONCILE_INTERVAL,
+               listener=None):
+        """ Fetches events newer than the high-water mark and those that
+            have ended, and continues any disk space reconciliation due
+            every reconcile hours. Alarms pushed to a zmNotify.Listener
+            are counted first, the query catching any events it missed.
+            Returns a deferred True, or False if events aren't viewable.
+        """
+        if listener is not None:
+            self.push(listener.pop_pushed())
+        if time.time() - self.updated < MIN_INTERVAL:
+            return succeed(True)
+
+        d = Deferred()
+        self.waiting.append(d)
+        if len(self.waiting) == 1:
+            self._update(transport, parser, reconcile, listener).addBoth(
+                self._updated
+                )
+        return d
+
+    def _updated(self, result):
+        if not isinstance(result, Failure):
+            self.updated = time.time()
+        (waiting, self.waiting) = (self.waiting, list())
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    @inlineCallbacks
+    def _update(self, transport, parser, reconcile, listener):
+        if self.hwm is None:
+            # Start from the newest event rather than counting history
+            result = yield self.query(transport, parser, LATEST_QUERY)
+            if result is None:
+                returnValue(False)
+            events = result.get('events', list())
+            self.hwm = event_fields(events[0])['id'] if events else 0
+            self.origin = self.hwm
+            self.persist()
+            LOG.debug('%s: events start after %s', self.device_id, self.hwm)
+            returnValue(True)
+
+        # New events, including those without an alarm, such as from
+        # Record and Mocord monitors, which the Event Notification Server
+        # doesn't push
+        since = self.hwm
+        for page in range(1, MAX_PAGES + 1):
+            result = yield self.query(
+                transport,
+                parser,
+                new_query(since, page)
+                )
+            if result is None:
+                returnValue(False)
+            for item in result.get('events', list()):
+                self.account(event_fields(item))
+            if not result.get('pagination', dict()).get('nextPage'):
+                break
+        # Any pushed but not found by now were deleted
+        self.pushed = set(x for x in self.pushed if x > self.hwm)
+
+        # Events seen in progress that have since ended. Ordered by
+        # EndTime so a partial update resumes where it left off.
+        if self.open:
+            ended = self.ended or min(self.open.values())
+            for page in range(1, MAX_PAGES + 1):
+                result = yield self.query(
+                    transport,
+                    parser,
+                    ended_query(min(self.open), self.hwm, ended, page)
+                    )
+                if result is None:
+                    returnValue(False)
+                for item in result.get('events', list()):
+                    fields = event_fields(item)
+                    self.account(fields)
+                    self.ended = max(self.ended or '', fields['end'])
+                if (not self.open
+                        or not result.get('pagination', dict()).get(
+                            'nextPage'
+                            )):
+                    break
+
+        if reconcile and (self.scan is not None
+                          or time.time() - self.reconciled
+                          > reconcile * 3600):
+            yield self.reconcile(transport, parser)
+
+        self.persist()
+        returnValue(True)
+
+    @inlineCallbacks
+    def query(self, transport, parser, query):
+        """ Returns a deferred parsed events query, None if not viewable.
+            query is an API path and the equivalent zmDb.Backend.events()
+            arguments.
+        """
+        (path, sql) = query
+        if self.session.db:
+            returnValue((yield self.session.db.events(*sql)))
+        response = yield self.session.optional(transport, 'events', path)
+        if response is None:
+            returnValue(None)
+        # Decoded row by row, keeping only the fields event_fields() uses
+        returnValue((yield parser.decode(path, response)))
+
+    @inlineCallbacks
+    def reconcile(self, transport, parser):
+        """ Recounts disk space of events up to the high-water mark,
+            a limited number of pages per update
+        """
+        if self.scan is None:
+            LOG.debug('%s: reconciling event disk space', self.device_id)
+            # Events in progress now are left to account() to count when
+            # they end. What it counts during the scan is kept in "since"
+            # to add to the scan's totals.
+            self.scan = {
+                'hwm': self.hwm,
+                'cursor': 0,
+                'open': sorted(self.open),
+                'totals': dict(),
+                'since': dict(),
+                }
+            if not self.reconciled and self.origin is not None:
+                # The first recount only needs events from before counting
+                # started, as everything since is in self.disk already
+                self.scan['hwm'] = self.origin
+                self.scan['since'] = dict(self.disk)
+
+        scan = self.scan
+        skip = set(scan['open'])
+        for page in range(MAX_PAGES):
+            result = yield self.query(
+                transport,
+                parser,
+                reconcile_query(scan['cursor'], scan['hwm'])
+                )
+            if result is None:
+                return
+
+            for item in result.get('events', list()):
+                fields = event_fields(item)
+                scan['cursor'] = max(scan['cursor'], fields['id'])
+                if fields['end'] and fields['id'] not in skip:
+                    key = disk_key(fields['monitor'], fields['storage'])
+                    scan['totals'][key] = (scan['totals'].get(key, 0)
+                                           + fields['disk'])
+
+            if not result.get('pagination', dict()).get('nextPage'):
+                disk = dict(scan['totals'])
+                for (key, value) in scan['since'].items():
+                    disk[key] = disk.get(key, 0) + value
+                self.disk = disk
+                self.reconciled = time.time()
+                self.scan = None
+                LOG.debug('%s: event disk space reconciled', self.device_id)
+                return
+
+    def persist(self):
+        """ Saves progress to the session cache """
+        self.session.set_states({
+            'events_hwm': self.hwm,
+            'events_origin': self.origin,
+            'events_open': sorted(self.open.items()),
+            'events_ended': self.ended,
+            'events_disk': self.disk,
+            'events_reconciled': self.reconciled,
+            'events_scan': self.scan,
+            })
+
+    def push(self, alarms):
+        """ Counts new events from alarms pushed by the Event Notification
+            Server, leaving the rest of their accounting to the query
+        """
+        for alarm in alarms:
+            try:
+                event_id = int(alarm.get('EventId'))
+            except (TypeError, ValueError):
+                continue
+            if (self.hwm is None or event_id <= self.hwm
+                    or event_id in self.pushed):
+                continue
+            self.pushed.add(event_id)
+            self.add(str(alarm.get('MonitorId', '')), 'events', 1)
+
+    def account(self, fields):
+        """ Adds an event to the counters """
+        event_id = fields['id']
+        monitor_id = fields['monitor']
+        new = event_id > self.hwm
+        if new:
+            self.hwm = event_id
+            if event_id in self.pushed:
+                self.pushed.discard(event_id)
+            else:
+                self.add(monitor_id, 'events', 1)
+
+        if not fields['end']:
+            if new:
+                self.open[event_id] = fields['start']
+                if len(self.open) > MAX_OPEN:
+                    del self.open[min(self.open)]
+        elif new or event_id in self.open:
+            # Totals are final once an event has ended
+            self.open.pop(event_id, None)
+            self.add(monitor_id, 'alarm-frames', fields['alarm_frames'])
+            self.add(monitor_id, 'event-seconds', fields['length'])
+            key = disk_key(monitor_id, fields['storage'])
+            self.disk[key] = self.disk.get(key, 0) + fields['disk']
+            if self.scan is not None:
+                self.scan['since'][key] = (self.scan['since'].get(key, 0)
+                                           + fields['disk'])
+
+    def add(self, monitor_id, name, value):
+        for key in (monitor_id, 'daemon'):
+            counters = self.counters.setdefault(key, dict())
+            counters[name] = counters.get(name, 0) + value
+
+    def delta(self, consumer, key):
+        """ Returns a monitor's, or the 'daemon' total's, counters
+            accrued since the consumer last asked
+        """
+        current = dict(self.counters.get(key, dict()))
+        cursor = self.cursors.setdefault(consumer, dict())
+        last = cursor.get(key, dict())
+        cursor[key] = current
+        output = {'events': 0, 'alarm-frames': 0, 'event-seconds': 0.0}
+        for name in output:
+            output[name] += current.get(name, 0) - last.get(name, 0)
+        return output
+
+    def disk_usage(self, monitor_id):
+        """ Returns bytes used by a monitor's events by storage ID, and
+            whether that is approximate. Until first reconciled, it is
+            that of events ended since counting began plus those from
+            before recounted so far, which can take days on a large Events
+            table.
+        """
+        disk = self.disk
+        approximate = not self.reconciled
+        if approximate and self.scan is not None:
+            # The scan's totals and what was counted since it started
+            # don't overlap, as when it finishes
+            disk = dict(self.scan['since'])
+            for (key, value) in self.scan['totals'].items():
+                disk[key] = disk.get(key, 0) + value
+        output = dict()
+        for (key, value) in disk.items():
+            (key_monitor, storage_id) = key.split(':', 1)
+            if key_monitor == monitor_id:
+                output[storage_id] = value
+        return (output, approximate)
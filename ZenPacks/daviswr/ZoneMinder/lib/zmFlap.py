@@ -0,0 +1,84 @@
+""" Damps monitor status values flapping between collection cycles """
+
+import collections
+import time
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmSession
+
+# Samples kept per value, however long the window
+MAX_HISTORY = 100
+
+# Dampers by device ID
+dampers = dict()
+
+
+def get_damper(device_id, samples, window):
+    """ Returns a device's damper, reconfigured if its zProperties changed """
+    damper = dampers.get(device_id)
+    if damper is None:
+        damper = dampers[device_id] = Damper()
+    damper.configure(samples, window)
+    return damper
+
+
+def released(device_id, session, idle):
+    """ Forgets the damper of a device gone idle, likely removed """
+    if idle:
+        dampers.pop(device_id, None)
+
+
+zmSession.add_release_observer(released)
+
+
+class Damper(object):
+    """ Reports a new value only once it has held for several samples """
+
+    def __init__(self):
+        # Key: deque of (time, value), within the window
+        # unless needed to make up the samples
+        self.history = dict()
+        # Key: value last reported
+        self.steady = dict()
+        self.samples = 1
+        self.window = 0
+
+    def configure(self, samples, window):
+        self.samples = max(1, int(samples or 1))
+        self.window = max(0, int(window or 0))
+
+    def update(self, key, value, now=None, hold=False):
+        """ Records a sample. Returns the value to report, which only
+            changes once the last samples in a row agree, and not at all
+            while held.
+        """
+        now = now or time.time()
+        history = self.history.get(key)
+        if history is None:
+            history = self.history[key] = collections.deque(
+                maxlen=MAX_HISTORY
+                )
+        history.append((now, value))
+        # Samples outside the window are kept while needed to make up
+        # the samples, so a short window can't stop changes being reported
+        while (len(history) > self.samples and self.window
+               and now - history[0][0] > self.window):
+            history.popleft()
+
+        recent = [sample for (_, sample) in history][-self.samples:]
+        if (key not in self.steady
+                or (not hold and len(recent) == self.samples
+                    and all(sample == value for sample in recent))):
+            self.steady[key] = value
+        return self.steady[key]
+
+    def flaps(self, key, now=None):
+        """ Returns how many times a value changed within the window """
+        now = now or time.time()
+        values = [
+            sample for (when, sample) in self.history.get(key, list())
+            if not self.window or now - when <= self.window
+            ]
+        return sum(
+            1 for (before, after) in zip(values, values[1:])
+            if before != after
+            )
@@ -0,0 +1,164 @@
+""" Samples single frames from a few monitors' streams each cycle """
+
+import hashlib
+import logging
+import time
+import urllib
+import urlparse
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmSession
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Stream credentials are reused this long. ZoneMinder's default
+# ZM_AUTH_HASH_TTL is 2 hours.
+CREDENTIALS_LIFETIME = 1800
+# JPEG start of image marker, anything else being an error from zms
+JPEG_MAGIC = '\xff\xd8'
+
+# Samplers by device ID
+samplers = dict()
+
+
+def get_sampler(device_id):
+    """ Returns a device's frame sampler """
+    sampler = samplers.get(device_id)
+    if sampler is None:
+        sampler = samplers[device_id] = FrameSampler(device_id)
+    return sampler
+
+
+def released(device_id, session, idle):
+    """ Forgets the sampler of a device gone idle, likely removed """
+    if idle:
+        samplers.pop(device_id, None)
+
+
+zmSession.add_release_observer(released)
+
+
+def generate_zms_url(base_url, zms_path, monitor_id, scale, credentials):
+    """ Returns the URL of one scaled-down frame from a monitor """
+    params = urllib.urlencode([
+        ('mode', 'single'),
+        ('monitor', monitor_id),
+        ('scale', scale),
+        ])
+    if credentials:
+        params = '&'.join((params, credentials))
+    return '{0}?{1}'.format(urlparse.urljoin(base_url, zms_path), params)
+
+
+class FrameSampler(object):
+    """ Rotates through a device's monitors, a few per cycle """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        # Monitor ID sampled last, so the next cycle starts after it
+        self.last = None
+        # Query string appended to zms URLs, and when it was fetched
+        self.credentials = None
+        self.credentials_fetched = 0
+        # Monitor ID: (frame digest, when first sampled)
+        self.frames = dict()
+
+    def choose(self, monitor_ids, budget):
+        """ Returns the next budget monitor IDs in turn """
+        monitor_ids = sorted(monitor_ids, key=int)
+        if budget >= len(monitor_ids):
+            return monitor_ids
+        start = 0
+        if self.last is not None:
+            start = sum(1 for x in monitor_ids if int(x) <= int(self.last))
+        chosen = (monitor_ids[start:] + monitor_ids[:start])[:budget]
+        if chosen:
+            self.last = chosen[-1]
+        return chosen
+
+    @inlineCallbacks
+    def get_credentials(self, session, transport, parser):
+        """ Returns the query string authenticating zms requests """
+        if (self.credentials is None
+                or time.time() - self.credentials_fetched
+                > CREDENTIALS_LIFETIME):
+            response = yield session.api(
+                transport,
+                'host/getCredentials.json'
+                )
+            result = yield parser.loads(response)
+            credentials = result.get('credentials') or ''
+            # Plain user/pass authentication leaves the password off
+            if str(result.get('append_password')) in ('1', 'True', 'true'):
+                credentials += urllib.quote(session.password, safe='')
+            self.credentials = credentials
+            self.credentials_fetched = time.time()
+        returnValue(self.credentials)
+
+    @inlineCallbacks
+    def sample(self, session, transport, parser, base_urls, zms_path, budget,
+               scale):
+        """ Fetches one frame from each of the next budget monitors.
+            base_urls are the base URLs of the servers streaming them,
+            by monitor ID. Returns a deferred dict of stats by monitor ID.
+        """
+        output = dict()
+        chosen = self.choose(base_urls.keys(), budget)
+        if not chosen:
+            returnValue(output)
+
+        credentials = yield self.get_credentials(session, transport, parser)
+
+        # One at a time, so sampling never adds more than one request
+        # at once to the box
+        for monitor_id in chosen:
+            url = generate_zms_url(
+                base_urls[monitor_id],
+                zms_path,
+                monitor_id,
+                scale,
+                credentials
+                )
+            try:
+                (elapsed, response) = yield transport.getTimedPage(
+                    url,
+                    cookies=dict(session.cookies)
+                    )
+            except Exception as e:
+                LOG.debug(
+                    '%s: failed to sample monitor %s frame: %s',
+                    self.device_id,
+                    monitor_id,
+                    e
+                    )
+                continue
+
+            if not response.startswith(JPEG_MAGIC):
+                # Likely refused credentials, so fetch them again next time
+                LOG.warn(
+                    '%s: monitor %s stream did not return a frame',
+                    self.device_id,
+                    monitor_id
+                    )
+                self.credentials = None
+                continue
+
+            output[monitor_id] = {'frame-latency': elapsed * 1000}
+            age = self.age(monitor_id, response, time.time())
+            if age is not None:
+                output[monitor_id]['frame-age'] = age
+
+        LOG.debug('%s: sampled frames:\n%s', self.device_id, output)
+        returnValue(output)
+
+    def age(self, monitor_id, frame, now):
+        """ Returns how long a monitor has served the same frame, 0 if it
+            changed since last sampled, None if not sampled before
+        """
+        digest = hashlib.sha1(frame).hexdigest()
+        (previous, since) = self.frames.get(monitor_id, (None, now))
+        if digest != previous:
+            self.frames[monitor_id] = (digest, now)
+            return None if previous is None else 0
+        return now - since
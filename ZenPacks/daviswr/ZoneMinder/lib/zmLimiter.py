@@ -0,0 +1,83 @@
+""" Per-host request rate limiting for ZoneMinder web servers """
+
+import collections
+import logging
+import time
+import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Token buckets by lower-case hostname, shared by every plugin
+# running in this process
+limiters = dict()
+
+
+def get_limiter(url, rate, burst):
+    """ Returns the shared limiter for a URL's host, None if unlimited """
+    host = (urlparse.urlparse(url).hostname or '').lower()
+    if not host or not rate or rate <= 0:
+        return None
+
+    limiter = limiters.get(host)
+    if limiter is None:
+        limiter = limiters[host] = TokenBucket(rate, burst)
+    else:
+        # Most recently configured zProperties win
+        limiter.configure(rate, burst)
+    return limiter
+
+
+class TokenBucket(object):
+    """ Allows rate requests per second, in bursts of up to burst """
+
+    def __init__(self, rate, burst):
+        self.waiting = collections.deque()
+        self.call = None
+        self.configure(rate, burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def configure(self, rate, burst):
+        """ Sets the rate and burst size """
+        self.rate = float(rate)
+        self.burst = max(float(burst or 0), 1.0)
+
+    def acquire(self):
+        """ Returns a deferred that fires when a request may be sent """
+        self.refill()
+        if not self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            return succeed(None)
+
+        d = Deferred()
+        self.waiting.append(d)
+        self.schedule()
+        return d
+
+    def refill(self):
+        """ Adds the tokens accrued since the last refill """
+        now = time.time()
+        self.tokens = min(
+            self.tokens + (now - self.updated) * self.rate,
+            self.burst
+            )
+        self.updated = now
+
+    def schedule(self):
+        """ Arranges for waiting requests to be released """
+        if self.call is None or not self.call.active():
+            delay = max((1 - self.tokens) / self.rate, 0)
+            self.call = reactor.callLater(delay, self.release)
+
+    def release(self):
+        """ Releases as many waiting requests as there are tokens """
+        self.call = None
+        self.refill()
+        while self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            self.waiting.popleft().callback(None)
+        if self.waiting:
+            self.schedule()
@@ -0,0 +1,353 @@
+""" Listens for alarms pushed by the zmeventnotification server """
+
+import base64
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmSession
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Seconds between reconnection attempts, backing off to MAX_DELAY
+INITIAL_DELAY = 5
+MAX_DELAY = 600
+# Seconds between pings. The connection is dropped if nothing arrives
+# for twice this long, so a silent server is never mistaken for a
+# quiet one.
+KEEPALIVE = 60
+# Alarm event IDs remembered, so each is reported once
+MAX_SEEN = 1000
+# Alarms waiting to become Zenoss events, oldest dropped first
+MAX_PENDING = 100
+# Alarms waiting to be counted, more than a cycle's worth
+MAX_PUSHED = 1000
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# Listeners by device ID
+listeners = dict()
+
+
+def get_listener(device_id, url, username, password):
+    """ Returns a device's connected or connecting listener,
+        None if url isn't set
+    """
+    listener = listeners.get(device_id)
+    if listener is not None and (listener.url, listener.username,
+                                 listener.password) != (url, username,
+                                                        password):
+        listener.stop()
+        del listeners[device_id]
+        listener = None
+
+    if not url:
+        return None
+    if listener is None:
+        listener = listeners[device_id] = Listener(
+            device_id,
+            url,
+            username,
+            password
+            )
+        listener.start()
+    return listener
+
+
+def released(device_id, session, idle):
+    """ Stops the listener of a device gone idle, likely removed """
+    listener = listeners.pop(device_id, None) if idle else None
+    if listener is not None:
+        listener.stop()
+
+
+zmSession.add_release_observer(released)
+
+
+def alarm_event(device_id, alarm):
+    """ Returns a Zenoss event for an alarm pushed by the server """
+    monitor_id = str(alarm.get('MonitorId', ''))
+    return {
+        'device': device_id,
+        'component': 'zmMonitor{0}'.format(monitor_id),
+        'eventClass': '/App/ZoneMinder',
+        'eventKey': 'ZoneMinder-Alarm',
+        'severity': 2,
+        'summary': 'ZM monitor {0} alarm: {1}'.format(
+            alarm.get('Name') or monitor_id,
+            alarm.get('Cause') or 'unknown cause'
+            ),
+        'zmEventId': str(alarm.get('EventId', '')),
+        }
+
+
+def encode_frame(opcode, payload):
+    """ Returns a masked client websocket frame """
+    header = chr(0x80 | opcode)
+    length = len(payload)
+    if length < 126:
+        header += chr(0x80 | length)
+    elif length < 65536:
+        header += chr(0x80 | 126) + struct.pack('!H', length)
+    else:
+        header += chr(0x80 | 127) + struct.pack('!Q', length)
+    mask = os.urandom(4)
+    masked = ''.join(
+        chr(ord(char) ^ ord(mask[index % 4]))
+        for (index, char) in enumerate(payload)
+        )
+    return header + mask + masked
+
+
+def decode_frame(data):
+    """ Returns (fin, opcode, payload, bytes used) for the frame at the
+        start of data, None if it's incomplete
+    """
+    if len(data) < 2:
+        return None
+    (first, second) = (ord(data[0]), ord(data[1]))
+    length = second & 0x7F
+    offset = 2
+    if length == 126:
+        if len(data) < 4:
+            return None
+        length = struct.unpack('!H', data[2:4])[0]
+        offset = 4
+    elif length == 127:
+        if len(data) < 10:
+            return None
+        length = struct.unpack('!Q', data[2:10])[0]
+        offset = 10
+    mask = None
+    if second & 0x80:
+        mask = data[offset:offset + 4]
+        offset += 4
+    if len(data) < offset + length:
+        return None
+    payload = data[offset:offset + length]
+    if mask:
+        payload = ''.join(
+            chr(ord(char) ^ ord(mask[index % 4]))
+            for (index, char) in enumerate(payload)
+            )
+    return (bool(first & 0x80), first & 0x0F, payload, offset + length)
+
+
+class WebSocketProtocol(Protocol):
+    """ A minimal websocket client delivering text messages as JSON """
+
+    def __init__(self):
+        self.buffer = ''
+        self.upgraded = False
+        self.fragments = list()
+        self.key = base64.b64encode(os.urandom(16))
+        self.received = 0
+        self.keepalive = LoopingCall(self.ping)
+
+    def connectionMade(self):
+        url = urlparse.urlparse(self.factory.listener.url)
+        self.transport.write(
+            'GET {0} HTTP/1.1\r\n'
+            'Host: {1}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: {2}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            '\r\n'.format(url.path or '/', url.netloc, self.key)
+            )
+
+    def connectionLost(self, reason):
+        if self.keepalive.running:
+            self.keepalive.stop()
+        self.factory.listener.disconnected(reason)
+
+    def dataReceived(self, data):
+        self.received = time.time()
+        self.buffer += data
+        if not self.upgraded:
+            if '\r\n\r\n' not in self.buffer:
+                return
+            (headers, self.buffer) = self.buffer.split('\r\n\r\n', 1)
+            accept = base64.b64encode(
+                hashlib.sha1(self.key + WEBSOCKET_GUID).digest()
+                )
+            if ' 101 ' not in headers.split('\r\n')[0] or accept not in headers:
+                LOG.error(
+                    '%s: Event Notification Server refused websocket: %s',
+                    self.factory.listener.device_id,
+                    headers.split('\r\n')[0]
+                    )
+                self.transport.loseConnection()
+                return
+            self.upgraded = True
+            self.keepalive.start(KEEPALIVE, now=False)
+            self.factory.listener.opened(self)
+
+        while True:
+            frame = decode_frame(self.buffer)
+            if frame is None:
+                break
+            (fin, opcode, payload, used) = frame
+            self.buffer = self.buffer[used:]
+            if opcode == OPCODE_PING:
+                self.transport.write(encode_frame(OPCODE_PONG, payload))
+            elif opcode == OPCODE_CLOSE:
+                self.transport.write(encode_frame(OPCODE_CLOSE, payload[:2]))
+                self.transport.loseConnection()
+            elif opcode in (OPCODE_TEXT, OPCODE_CONTINUATION):
+                self.fragments.append(payload)
+                if fin:
+                    message = ''.join(self.fragments)
+                    self.fragments = list()
+                    try:
+                        message = json.loads(message)
+                    except ValueError:
+                        LOG.debug('Ignoring non-JSON message %r', message)
+                        continue
+                    self.factory.listener.received(message)
+
+    def send(self, message):
+        """ Sends a message as JSON text """
+        self.transport.write(encode_frame(OPCODE_TEXT, json.dumps(message)))
+
+    def ping(self):
+        if time.time() - self.received > 2 * KEEPALIVE:
+            LOG.info(
+                '%s: Event Notification Server stopped responding',
+                self.factory.listener.device_id
+                )
+            self.transport.abortConnection()
+        else:
+            self.transport.write(encode_frame(OPCODE_PING, ''))
+
+
+class ListenerFactory(ReconnectingClientFactory):
+    """ Reconnects to the Event Notification Server with backoff """
+
+    protocol = WebSocketProtocol
+    initialDelay = INITIAL_DELAY
+    maxDelay = MAX_DELAY
+    noisy = False
+
+    def __init__(self, listener):
+        self.listener = listener
+
+
+class Listener(object):
+    """ A device's connection to the Event Notification Server """
+
+    def __init__(self, device_id, url, username, password):
+        self.device_id = device_id
+        self.url = url
+        self.username = username
+        self.password = password
+        self.factory = ListenerFactory(self)
+        self.connector = None
+        self.protocol = None
+        # When authenticated, 0 while not
+        self.connected_since = 0
+        # Event IDs already reported
+        self.seen = collections.OrderedDict()
+        # Alarms waiting to become Zenoss events
+        self.pending = collections.deque(maxlen=MAX_PENDING)
+        # Alarms waiting to be counted by a zmEvents.Tracker
+        self.pushed = collections.deque(maxlen=MAX_PUSHED)
+
+    def start(self):
+        url = urlparse.urlparse(self.url)
+        if url.scheme == 'wss':
+            # Certificates aren't verified, as with the API's HTTPS
+            from twisted.internet import ssl
+            self.connector = reactor.connectSSL(
+                url.hostname,
+                url.port or 443,
+                self.factory,
+                ssl.ClientContextFactory()
+                )
+        else:
+            self.connector = reactor.connectTCP(
+                url.hostname,
+                url.port or 80,
+                self.factory
+                )
+
+    def stop(self):
+        self.factory.stopTrying()
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def opened(self, protocol):
+        self.protocol = protocol
+        protocol.send({
+            'event': 'auth',
+            'data': {'user': self.username, 'password': self.password},
+            })
+
+    def disconnected(self, reason):
+        if self.connected_since:
+            LOG.info(
+                '%s: disconnected from Event Notification Server: %s',
+                self.device_id,
+                reason.getErrorMessage()
+                )
+        self.connected_since = 0
+        self.protocol = None
+
+    def received(self, message):
+        event = message.get('event')
+        if event == 'auth':
+            if message.get('status') == 'Success':
+                LOG.info(
+                    '%s: connected to Event Notification Server',
+                    self.device_id
+                    )
+                self.connected_since = time.time()
+                self.factory.resetDelay()
+            else:
+                # Retrying won't help until the credentials change
+                LOG.error(
+                    '%s: Event Notification Server refused login: %s',
+                    self.device_id,
+                    message.get('reason')
+                    )
+                self.stop()
+        elif event == 'alarm':
+            for alarm in message.get('events', list()):
+                self.alarm(alarm)
+
+    def alarm(self, alarm):
+        event_id = str(alarm.get('EventId', ''))
+        if event_id in self.seen:
+            return
+        self.seen[event_id] = True
+        if len(self.seen) > MAX_SEEN:
+            self.seen.popitem(last=False)
+        self.pending.append(alarm)
+        self.pushed.append(alarm)
+        LOG.debug('%s: alarm %s', self.device_id, alarm)
+
+    def pop_alarms(self):
+        """ Returns alarms received since last called """
+        alarms = list(self.pending)
+        self.pending.clear()
+        return alarms
+
+    def pop_pushed(self):
+        """ Returns alarms received since last counted """
+        alarms = list(self.pushed)
+        self.pushed.clear()
+        return alarms
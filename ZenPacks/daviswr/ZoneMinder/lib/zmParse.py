@@ -0,0 +1,229 @@
+""" Parses ZoneMinder responses, in a thread pool when they are large """
+
+import json
+import logging
+import re
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import fail, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Responses smaller than this many bytes are parsed on the reactor thread
+THRESHOLD = 65536
+POOL_SIZE = 4
+
+# Fields kept from each row of large listings, by API path prefix:
+# the listing's key, and the fields kept of each of a row's models.
+# Other models are dropped, and None keeps all of a model's fields.
+ROW_FIELDS = [
+    ('monitors.json', 'monitors', {
+        'Monitor': frozenset([
+            'Id',
+            'Sequence',
+            'Name',
+            'ServerId',
+            'StorageId',
+            'Type',
+            'Function',
+            'Enabled',
+            'Protocol',
+            'Method',
+            'Host',
+            'Port',
+            'Path',
+            'Width',
+            'Height',
+            'Colours',
+            'Controllable',
+            'ControlId',
+            'MaxFPS',
+            'AlarmMaxFPS',
+            'CaptureFPS',
+            'AnalysisFPS',
+            'CaptureBandwidth',
+            ]),
+        'Monitor_Status': None,
+        }),
+    ('events/index', 'events', {
+        'Event': frozenset([
+            'Id',
+            'MonitorId',
+            'StorageId',
+            'StartTime',
+            'EndTime',
+            'Length',
+            'AlarmFrames',
+            'DiskSpace',
+            ]),
+        }),
+    ]
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+_pool = None
+
+# Seconds spent parsing and scraping on the reactor thread, by device ID,
+# since last read with pop_blocking(). Thread pool parses aren't counted.
+blocking = dict()
+
+
+def get_pool():
+    """ Returns the shared parser thread pool, starting it if needed """
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(0, POOL_SIZE, 'zen.ZoneMinder.parse')
+        _pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', _pool.stop)
+    return _pool
+
+
+def pop_blocking(device_id):
+    """ Returns and resets the reactor time a device's parsing has used """
+    return blocking.pop(device_id, 0.0)
+
+
+def row_fields(path):
+    """ Returns the listing key and fields kept for an API path,
+        None if all of its response is kept
+    """
+    for (prefix, key, fields) in ROW_FIELDS:
+        if path.startswith(prefix):
+            return (key, fields)
+    return None
+
+
+def prune_row(row, fields):
+    """ Returns a listing row with only the given models' fields """
+    if not isinstance(row, dict):
+        return row
+    output = dict()
+    for (model, value) in row.items():
+        if model not in fields:
+            continue
+        if fields[model] is not None and isinstance(value, dict):
+            value = dict(
+                (name, field) for (name, field) in value.items()
+                if name in fields[model]
+                )
+        output[model] = value
+    return output
+
+
+def prune(path, result):
+    """ Returns an already decoded response with only the fields kept
+        for its API path
+    """
+    rows = row_fields(path)
+    if rows is None or not isinstance(result, dict):
+        return result
+    (key, fields) = rows
+    output = dict(result)
+    if isinstance(output.get(key), list):
+        output[key] = [prune_row(row, fields) for row in output[key]]
+    return output
+
+
+def decode_rows(text, key, fields):
+    """ Decodes a JSON object like json.loads, but decodes the array
+        under key one row at a time, keeping only fields of each. Only
+        one whole row is held at once, rather than the whole listing.
+    """
+    index = _skip(text, 0)
+    if text[index:index + 1] != '{':
+        raise ValueError('Expecting object at char {0}'.format(index))
+    output = dict()
+    index = _skip(text, index + 1)
+    char = text[index:index + 1]
+    if char == '}':
+        index = _skip(text, index + 1)
+    while char != '}':
+        (name, index) = _decoder.raw_decode(text, index)
+        index = _skip(text, index)
+        if text[index:index + 1] != ':':
+            raise ValueError('Expecting : delimiter at char {0}'.format(
+                index
+                ))
+        index = _skip(text, index + 1)
+        if name == key and text[index:index + 1] == '[':
+            (output[name], index) = _decode_array(text, index, fields)
+        else:
+            (output[name], index) = _decoder.raw_decode(text, index)
+        index = _skip(text, index)
+        char = text[index:index + 1]
+        if char not in (',', '}'):
+            raise ValueError('Expecting , delimiter at char {0}'.format(
+                index
+                ))
+        index = _skip(text, index + 1)
+    if index != len(text):
+        raise ValueError('Extra data at char {0}'.format(index))
+    return output
+
+
+def _decode_array(text, index, fields):
+    rows = list()
+    index = _skip(text, index + 1)
+    if text[index:index + 1] == ']':
+        return (rows, index + 1)
+    while True:
+        (row, index) = _decoder.raw_decode(text, index)
+        rows.append(prune_row(row, fields))
+        index = _skip(text, index)
+        char = text[index:index + 1]
+        if char == ']':
+            return (rows, index + 1)
+        elif char != ',':
+            raise ValueError('Expecting , delimiter at char {0}'.format(
+                index
+                ))
+        index = _skip(text, index + 1)
+
+
+def _skip(text, index):
+    return _whitespace.match(text, index).end()
+
+
+class Parser(object):
+    """ Parses responses for one device """
+
+    def __init__(self, device_id, threshold=None):
+        self.device_id = device_id
+        self.threshold = THRESHOLD if threshold is None else threshold
+
+    def parse(self, func, text, *args):
+        """ Calls func(text, *args). Returns a deferred result. """
+        if len(text) >= self.threshold:
+            LOG.debug(
+                '%s: parsing %s bytes with %s in thread pool',
+                self.device_id,
+                len(text),
+                func.__name__
+                )
+            return deferToThreadPool(reactor, get_pool(), func, text, *args)
+
+        started = time.time()
+        try:
+            result = succeed(func(text, *args))
+        except Exception:
+            result = fail()
+        blocking[self.device_id] = (blocking.get(self.device_id, 0.0)
+                                    + time.time() - started)
+        return result
+
+    def loads(self, text):
+        """ Decodes JSON. Returns a deferred result. """
+        return self.parse(json.loads, text)
+
+    def decode(self, path, text):
+        """ Decodes an API path's JSON response, keeping only the fields
+            used of large listings. Returns a deferred result.
+        """
+        rows = row_fields(path)
+        if rows is None:
+            return self.loads(text)
+        return self.parse(decode_rows, text, *rows)
@@ -0,0 +1,191 @@
+""" Probes monitors' camera sources from the collector """
+
+import logging
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred,
+    DeferredList,
+    DeferredSemaphore,
+    succeed
+    )
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import ClientFactory, Protocol
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmLimiter
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Source port by protocol, if the monitor doesn't have one
+PORTS = {
+    'HTTP': 80,
+    'HTTPS': 443,
+    'RTSP': 554,
+    }
+
+# zZoneMinderSourceProbe modes
+MODE_TCP = 'tcp'
+MODE_RTSP = 'rtsp'
+
+
+class ProbeProtocol(Protocol):
+    """ Connects, sends an optional request, and waits for a line """
+
+    def connectionMade(self):
+        self.factory.connected = time.time()
+        if self.factory.request is None:
+            self.factory.succeed()
+            self.transport.loseConnection()
+        else:
+            self.transport.write(self.factory.request)
+
+    def dataReceived(self, data):
+        self.factory.buffer += data
+        if '\r\n' in self.factory.buffer:
+            self.factory.succeed(self.factory.buffer.split('\r\n', 1)[0])
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.fail(reason)
+
+
+class ProbeFactory(ClientFactory):
+    """ Fires its deferred with (seconds to connect, first response line,
+        seconds from connecting to the response)
+    """
+
+    protocol = ProbeProtocol
+    noisy = False
+
+    def __init__(self, request=None):
+        self.request = request
+        self.buffer = ''
+        self.started = None
+        self.connected = None
+        self.deferred = Deferred()
+
+    def startedConnecting(self, connector):
+        self.started = time.time()
+
+    def succeed(self, line=None):
+        if not self.deferred.called:
+            self.deferred.callback((
+                self.connected - self.started,
+                line,
+                None if line is None else time.time() - self.connected
+                ))
+
+    def fail(self, reason):
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.fail(reason)
+
+
+def options_request(url):
+    """ Returns an RTSP OPTIONS request for a URL """
+    return 'OPTIONS {0} RTSP/1.0\r\nCSeq: 1\r\n\r\n'.format(url)
+
+
+def probe(host, port, request=None, timeout=5):
+    """ Returns a deferred (seconds to connect, first response line,
+        seconds from connecting to the response) for a TCP connection to
+        a host, sending request if given. The host name is looked up
+        first, outside the connection time but within the timeout.
+    """
+    factory = ProbeFactory(request)
+    connectors = list()
+
+    def resolved(address):
+        if not factory.deferred.called:
+            connectors.append(reactor.connectTCP(
+                address,
+                port,
+                factory,
+                timeout=timeout
+                ))
+
+    def expired():
+        factory.fail(TimeoutError(string='no response'))
+        for connector in connectors:
+            connector.disconnect()
+
+    call = reactor.callLater(timeout, expired)
+    reactor.resolve(host, timeout=(timeout,)).addCallbacks(
+        resolved,
+        factory.fail
+        )
+
+    def finished(result):
+        if call.active():
+            call.cancel()
+        return result
+
+    factory.deferred.addBoth(finished)
+    return factory.deferred
+
+
+def source_target(source, mode):
+    """ Returns (host, port, request) to probe a monitor's modeled source,
+        None if it has no network source
+    """
+    host = source.get('Host')
+    protocol = (source.get('Protocol') or '').upper()
+    try:
+        port = int(source.get('Port') or 0) or PORTS.get(protocol)
+    except ValueError:
+        port = None
+    if not host or not port:
+        return None
+
+    request = None
+    if mode == MODE_RTSP and protocol == 'RTSP':
+        url = source.get('Path') or ''
+        if not url.startswith('rtsp://'):
+            url = 'rtsp://{0}:{1}/'.format(host, port)
+        request = options_request(url)
+    return (host, port, request)
+
+
+def probe_sources(sources, mode, concurrency, rate, timeout):
+    """ Probes monitors' sources, at most concurrency at once and rate
+        per second. Returns a deferred dict of stats by key of sources.
+    """
+    semaphore = DeferredSemaphore(max(1, concurrency))
+    limiter = zmLimiter.TokenBucket(rate, concurrency) if rate > 0 else None
+    keys = list()
+    deferreds = list()
+
+    def run(target):
+        d = limiter.acquire() if limiter else succeed(None)
+        d.addCallback(lambda _: probe(*target, timeout=timeout))
+        return d
+
+    for (key, source) in sources.items():
+        target = source_target(source, mode)
+        if target is None:
+            continue
+        keys.append(key)
+        deferreds.append(semaphore.run(run, target))
+
+    def collected(results):
+        output = dict()
+        for (key, (success, result)) in zip(keys, results):
+            if success:
+                (elapsed, line, response) = result
+                output[key] = {'reachable': 1, 'latency': elapsed * 1000}
+                if response is not None:
+                    output[key]['response-latency'] = response * 1000
+                if line and line.startswith('RTSP/'):
+                    try:
+                        output[key]['rtsp-status'] = int(line.split()[1])
+                    except (IndexError, ValueError):
+                        pass
+            else:
+                LOG.debug('%s source probe failed: %s', key, result.value)
+                output[key] = {'reachable': 0}
+        return output
+
+    return DeferredList(deferreds, consumeErrors=True).addCallback(collected)
@@ -0,0 +1,59 @@
+""" Coalesces remodels requested when ZoneMinder's run state changes """
+
+import logging
+import time
+
+from Products.DataCollector.plugins.DataMaps import ObjectMap
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+
+def last_modeled(device):
+    """ Returns when the device was last modeled, in seconds since the
+        epoch, 0 if unknown
+    """
+    try:
+        collected = device.getSnmpLastCollection()
+        if collected:
+            return collected.timeTime()
+    except Exception:
+        LOG.debug('%s: no last collection time', device.id)
+    return 0
+
+
+def check(session, device_id, run_state, interval, modeled=0):
+    """ Returns an ObjectMap asking zenhub to remodel the device once its
+        run state has changed, None otherwise. Remodels are at most once
+        per interval seconds, 0 never, counting from the device's last
+        model. Changes within the interval are merged into one remodel
+        on the first check after it ends.
+    """
+    if run_state is None:
+        return None
+
+    # Kept per device, as other devices may share the session
+    state_name = 'run_state/{0}'.format(device_id)
+    state = dict(session.state.get(state_name, dict()))
+    previous = state.get('run_state')
+    state['run_state'] = run_state
+    if previous is not None and previous != run_state:
+        state['pending'] = True
+
+    remodel = None
+    if not interval or interval <= 0:
+        state['pending'] = False
+    elif state.get('pending'):
+        now = time.time()
+        wait = max(state.get('requested', 0), modeled) + interval - now
+        if wait <= 0:
+            LOG.info('%s: run state changed, remodeling', device_id)
+            state['pending'] = False
+            state['requested'] = now
+            # Applied by zenhub, see ZoneMinder.setRemodel()
+            remodel = ObjectMap({'setRemodel': now})
+        elif previous != run_state:
+            LOG.info('%s: run state changed, delaying remodel %.0fs',
+                     device_id, wait)
+
+    session.set_state(state_name, state)
+    return remodel
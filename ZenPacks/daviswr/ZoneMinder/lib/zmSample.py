@@ -0,0 +1,193 @@
+""" Samples ZoneMinder monitor rates between collection cycles """
+
+import collections
+import logging
+import math
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmAdapt, zmSession, zmUtil
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Samples kept per series, enough for a 300s cycle at 5s intervals
+# with room to spare
+BUFFER_SIZE = 128
+# Samplers not read from in this many rollup windows are stopped,
+# as their device has been removed or its sampling disabled
+IDLE_WINDOWS = 3
+
+# Samplers by session key, shared by every device using the session
+samplers = dict()
+
+
+def get_sampler(device_id, session, transport, parser, interval, stretch=1):
+    """ Returns the running sampler for a device's session,
+        None if sampling is disabled. While ZoneMinder is loaded, samples
+        are only taken every stretch intervals, see zmAdapt.
+    """
+    sampler = samplers.get(session.key)
+    if not interval or interval <= 0:
+        # Left to stop when idle if other devices may still read it
+        if sampler and session.devices == set([device_id]):
+            sampler.stop()
+        return None
+
+    if sampler is None or not sampler.running():
+        sampler = samplers[session.key] = Sampler(device_id, session.key)
+    # Most recently configured session and interval win
+    sampler.configure(session, transport, parser, interval, stretch)
+    return sampler
+
+
+def released(device_id, session, idle):
+    """ Stops the sampler of a session no device uses any more """
+    if session is not None and session.key in samplers:
+        samplers[session.key].stop()
+
+
+zmSession.add_release_observer(released)
+
+
+def summarize(values):
+    """ Returns min, avg, max, and population stddev of values """
+    if not values:
+        return dict()
+    count = float(len(values))
+    avg = sum(values) / count
+    return {
+        'min': min(values),
+        'avg': avg,
+        'max': max(values),
+        'stddev': math.sqrt(sum((x - avg) ** 2 for x in values) / count),
+        }
+
+
+class Sampler(object):
+    """ Polls bulk monitor status and keeps recent samples in memory """
+
+    def __init__(self, device_id, key):
+        self.device_id = device_id
+        self.key = key
+        self.session = None
+        self.transport = None
+        self.parser = None
+        self.interval = 0
+        self.stretch = 1
+        # Whether a sample's request is in flight
+        self.polling = False
+        # (monitor ID or 'daemon', rate name): deque of (timestamp, value)
+        self.series = dict()
+        # When and over how many seconds rollups were last read
+        self.last_read = time.time()
+        self.window = 300
+        self.loop = LoopingCall(self.sample)
+
+    def configure(self, session, transport, parser, interval, stretch=1):
+        """ Sets what to sample with and how often """
+        (self.session, self.transport, self.parser, self.stretch) = (
+            session,
+            transport,
+            parser,
+            stretch
+            )
+        if interval != self.interval:
+            self.interval = interval
+            # A new LoopingCall, as one restarted while its sample is in
+            # flight would be rescheduled by that sample too. The new loop
+            # waits an interval rather than overlap it.
+            if self.loop.running:
+                self.loop.stop()
+            loop = self.loop = LoopingCall(self.sample)
+            loop.start(
+                interval,
+                now=not self.polling
+                ).addErrback(self.failed, loop)
+
+    def running(self):
+        """ Returns whether the sampler is polling """
+        return self.loop.running
+
+    def stop(self):
+        """ Stops polling """
+        if self.loop.running:
+            self.loop.stop()
+        if samplers.get(self.key) is self:
+            del samplers[self.key]
+
+    def failed(self, failure, loop):
+        LOG.error('%s: sampler stopped: %s', self.device_id, failure)
+        # A replaced loop's failure leaves its replacement running
+        if loop is self.loop:
+            self.stop()
+
+    @inlineCallbacks
+    def sample(self):
+        """ Records one sample of every monitor's rates """
+        if time.time() - self.last_read > IDLE_WINDOWS * self.window:
+            LOG.debug('%s: sampler no longer read, stopping', self.device_id)
+            self.stop()
+            return
+        elif self.polling:
+            return
+        # Non-essential, so taken less often while ZoneMinder is loaded
+        elif not zmAdapt.get_governor(self.session).allow(
+                self.device_id,
+                'Sampler',
+                self.interval,
+                self.stretch
+                ):
+            return
+
+        self.polling = True
+        try:
+            monitors = yield self.session.bulk(
+                self.transport,
+                self.parser,
+                'monitors.json',
+                max_age=self.interval / 2.0
+                )
+        except Exception as e:
+            # Logged by the datasources when it persists
+            LOG.debug('%s: sample failed: %s', self.device_id, e)
+            return
+        finally:
+            self.polling = False
+
+        now = time.time()
+        by_id = zmUtil.monitors_by_id(monitors)
+        for (monitor_id, item) in by_id.items():
+            rates = zmUtil.bulk_monitor_rates(item)
+            for (name, value) in rates.items():
+                self.record(monitor_id, name, now, value)
+        for (name, value) in zmUtil.bulk_daemon_rates(by_id).items():
+            self.record('daemon', name, now, value)
+
+    def record(self, key, name, timestamp, value):
+        series = self.series.get((key, name))
+        if series is None:
+            series = self.series[(key, name)] = collections.deque(
+                maxlen=BUFFER_SIZE
+                )
+        series.append((timestamp, value))
+
+    def rollup(self, key, name, window):
+        """ Returns min/avg/max/stddev of the last window seconds """
+        self.last_read = time.time()
+        self.window = window
+        since = self.last_read - window
+        return summarize([
+            value
+            for (timestamp, value) in self.series.get((key, name), list())
+            if timestamp >= since
+            ])
+
+    def rollups(self, key, names, window):
+        """ Returns rollups as datapoint IDs such as CaptureFPS-max """
+        output = dict()
+        for name in names:
+            for (stat, value) in self.rollup(key, name, window).items():
+                output['{0}-{1}'.format(name, stat)] = value
+        return output
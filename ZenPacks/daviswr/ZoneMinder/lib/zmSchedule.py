@@ -0,0 +1,68 @@
+""" Spreads ZoneMinder collection across the collection cycle """
+
+import hashlib
+import logging
+import random
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.task import deferLater
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Collection must finish before the next cycle starts, so offsets are
+# kept to this percentage of the cycle
+MAX_SPREAD = 80
+
+# Earliest time each device may first collect, for the startup ramp
+ramp_slots = dict()
+_ramp_next = 0.0
+
+
+def phase_offset(device_id, cycletime, spread):
+    """ Returns a device's deterministic offset into the cycle in seconds """
+    window = cycletime * min(max(spread, 0), MAX_SPREAD) / 100.0
+    digest = hashlib.md5(device_id.encode('utf-8')).hexdigest()
+    return window * int(digest[:8], 16) / float(0xffffffff)
+
+
+def ramp_delay(device_id, ramp):
+    """ Returns how long a device must wait for its startup ramp slot """
+    global _ramp_next
+    now = time.time()
+    if device_id not in ramp_slots:
+        # Admit at most "ramp" devices per second after startup
+        slot = max(now, _ramp_next)
+        _ramp_next = slot + 1.0 / ramp
+        ramp_slots[device_id] = slot
+    return max(ramp_slots[device_id] - now, 0.0)
+
+
+def collection_delay(device_id, cycletime, spread=50, jitter=0, ramp=0):
+    """ Returns seconds to wait before collecting from a device """
+    window = cycletime * min(max(spread, 0), MAX_SPREAD) / 100.0
+    delay = phase_offset(device_id, cycletime, spread)
+    if jitter:
+        delay = min(max(delay + random.uniform(-jitter, jitter), 0), window)
+    if ramp > 0:
+        delay = max(
+            delay,
+            min(ramp_delay(device_id, ramp), cycletime * MAX_SPREAD / 100.0)
+            )
+    return delay
+
+
+def stagger(device_id, datasource):
+    """ Returns a deferred that fires when a device's turn comes up """
+    delay = collection_delay(
+        device_id,
+        datasource.cycletime,
+        datasource.params.get('spread') or 0,
+        datasource.params.get('jitter') or 0,
+        datasource.params.get('ramp') or 0
+        )
+    if delay <= 0:
+        return succeed(None)
+    LOG.debug('%s: delaying collection %.1fs', device_id, delay)
+    return deferLater(reactor, delay, lambda: None)
@@ -0,0 +1,578 @@
+""" ZoneMinder login sessions, reused across cycles and restarts """
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import urllib
+import urlparse
+
+from twisted.internet.defer import (
+    Deferred,
+    inlineCallbacks,
+    returnValue,
+    succeed
+    )
+from twisted.python.failure import Failure
+from twisted.web import error
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmDb, zmParse, zmUtil
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# ZoneMinder's default ZM_COOKIE_LIFETIME is 3600 seconds.
+# Sessions are validated lazily, so this only avoids needless 401s.
+SESSION_LIFETIME = 3000
+# How long versions and capabilities are trusted before rechecking
+CAPABILITY_LIFETIME = 3600
+CACHE_VERSION = 1
+# How long a bulk API response is shared between datasources
+BULK_LIFETIME = 30
+# Devices that haven't asked for their session in this long are taken to
+# have been removed, and what they used is let go
+IDLE_LIFETIME = 3 * 3600
+# Keys digests in cache file names, so they don't reveal credentials
+SECRET_FILE = 'secret'
+
+# Ports left out of URLs by default, so they don't distinguish sessions
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+    }
+
+# Sessions by session_key(), shared by every device pointing at the
+# same ZoneMinder with the same login
+sessions = dict()
+# Each device's session key, to let go of sessions no longer used
+device_keys = dict()
+# When each device last asked for its session
+device_seen = dict()
+# Per-install secrets by cache directory
+secrets = dict()
+# Called with the device ID, its session if no other device uses it,
+# and whether the device has gone idle, whenever a device is released
+release_observers = list()
+
+
+class LoginError(Exception):
+    """ ZoneMinder refused the credentials """
+
+
+def default_cache_dir():
+    """ Returns the collector's working directory for session caches """
+    try:
+        from Products.ZenUtils.Utils import zenPath
+        return zenPath('var', 'zoneminder')
+    except ImportError:
+        return os.path.join(os.getcwd(), 'zoneminder')
+
+
+def install_secret(cache_dir):
+    """ Returns the random secret kept in the cache directory, created on
+        first use. A secret only for this process is used if it can't be
+        kept.
+    """
+    secret = secrets.get(cache_dir)
+    if secret:
+        return secret
+
+    path = os.path.join(cache_dir, SECRET_FILE)
+    for attempt in range(2):
+        try:
+            with open(path) as secret_file:
+                secret = secret_file.read().strip()
+        except (IOError, OSError):
+            secret = None
+        if secret or attempt:
+            break
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            # Another process creating it first is read on the next attempt
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            secret = os.urandom(32).encode('hex')
+            with os.fdopen(fd, 'w') as secret_file:
+                secret_file.write(secret)
+            break
+        except (IOError, OSError) as e:
+            secret = None
+            LOG.debug('Could not create %s: %s', path, e)
+
+    if not secret:
+        LOG.warn('Could not keep a secret in %s, session caches will not '
+                 'be reused after a restart', cache_dir)
+        secret = os.urandom(32).encode('hex')
+    secrets[cache_dir] = secret
+    return secret
+
+
+def session_key(base_url, username, password, secret, db=None):
+    """ Returns a normalized base URL and keyed digest of the credentials
+        and any database's settings, the same for every device pointing
+        at one ZoneMinder the same way
+    """
+    url = urlparse.urlsplit(base_url)
+    scheme = url.scheme.lower()
+    port = url.port or DEFAULT_PORTS.get(scheme)
+    path = url.path if url.path.endswith('/') else url.path + '/'
+    key = '{0}://{1}{2}{3}#{4}'.format(
+        scheme,
+        (url.hostname or '').lower(),
+        '' if port == DEFAULT_PORTS.get(scheme) else ':{0}'.format(port),
+        path,
+        keyed_digest(secret, '\0'.join((username or '', password or '')))
+        )
+    if db is not None:
+        key += '#' + keyed_digest(secret, repr(db.key))
+    return key
+
+
+def keyed_digest(secret, text):
+    """ Returns a short hex HMAC of text """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hmac.new(str(secret), text, hashlib.sha256).hexdigest()[:16]
+
+
+def get_session(device_id, base_url, username, password, cache_dir=None,
+                db=None):
+    """ Returns the session for a device, loading its cache. Devices
+        pointing at the same ZoneMinder with the same login and database
+        share one session, and with it its login and bulk responses.
+        db is a zmDb.Backend to read instead of the API where possible.
+    """
+    now = time.time()
+    for (other, seen) in device_seen.items():
+        if other != device_id and now - seen > IDLE_LIFETIME:
+            LOG.info('%s: idle, releasing its ZoneMinder session', other)
+            release(other, idle=True)
+
+    cache_dir = cache_dir or default_cache_dir()
+    key = session_key(
+        base_url,
+        username,
+        password,
+        install_secret(cache_dir),
+        db
+        )
+    previous = device_keys.get(device_id)
+    if previous is not None and previous != key:
+        release(device_id)
+    device_keys[device_id] = key
+
+    session = sessions.get(key)
+    if session is None:
+        session = Session(
+            device_id,
+            key,
+            base_url,
+            username,
+            password,
+            cache_dir,
+            db
+            )
+        session.load()
+        sessions[key] = session
+    elif device_id not in session.devices:
+        LOG.info(
+            '%s: sharing ZoneMinder session with %s',
+            device_id,
+            ', '.join(sorted(session.devices))
+            )
+    session.devices.add(device_id)
+    device_seen[device_id] = now
+    return session
+
+
+def release(device_id, idle=False):
+    """ Stops a device sharing its session, forgetting the session
+        once no device uses it. Observers also let go of the device's
+        own listeners and samplers when it has gone idle.
+    """
+    key = device_keys.pop(device_id, None)
+    if idle:
+        device_seen.pop(device_id, None)
+    session = sessions.get(key)
+    if session is not None:
+        session.devices.discard(device_id)
+        if not session.devices:
+            del sessions[key]
+        else:
+            session = None
+    for observer in list(release_observers):
+        try:
+            observer(device_id, session, idle)
+        except Exception:
+            LOG.exception('Release observer %r failed', observer)
+
+
+def add_release_observer(observer):
+    """ Registers a callable to be told about every released device """
+    if observer not in release_observers:
+        release_observers.append(observer)
+
+
+class Session(object):
+    """ A ZoneMinder login shared by all of a device's collection """
+
+    def __init__(self, device_id, key, base_url, username, password,
+                 cache_dir, db=None):
+        # The first device to use the session, as named in logs
+        self.device_id = device_id
+        # Every device using it
+        self.devices = set([device_id])
+        self.key = key
+        self.base_url = base_url
+        self.api_url = '{0}api/'.format(base_url)
+        self.username = username
+        self.password = password
+        # Named for the ZoneMinder rather than the device, since
+        # several devices may share it
+        self.cache_path = os.path.join(
+            cache_dir,
+            '{0}-{1}.json'.format(
+                urlparse.urlsplit(base_url).hostname or 'zoneminder',
+                keyed_digest(install_secret(cache_dir), key)
+                )
+            )
+        # Where caches were kept when sessions were per device
+        self.legacy_cache_path = os.path.join(
+            cache_dir,
+            '{0}.json'.format(device_id.replace(os.sep, '_'))
+            )
+        self.cookies = dict()
+        self.expires = 0
+        # Bumped on every login so stale failures don't force another
+        self.generation = 0
+        self.waiting = list()
+        # getVersion.json response and when it was fetched
+        self.version = dict()
+        self.version_checked = 0
+        # Capability name: (value, when checked)
+        self.capabilities = dict()
+        # Which of zmUtil.console_variants the Console page uses
+        self.console_variant = ''
+        # Response name: digest of last response
+        self.fingerprints = dict()
+        # Other libraries' progress, such as event high-water marks
+        self.state = dict()
+        # API path or other name: (when fetched, parsed response),
+        # kept in memory only
+        self.responses = dict()
+        # API path or other name: deferreds waiting on its request
+        self.fetching = dict()
+        # zmDb.Backend, if reading the database directly. Part of the
+        # key, so only devices configured with it share it.
+        self.db = db
+
+    def load(self):
+        """ Restores state cached by an earlier process, if still relevant """
+        cache = None
+        for path in (self.cache_path, self.legacy_cache_path):
+            try:
+                with open(path) as cache_file:
+                    cache = json.load(cache_file)
+                break
+            except (IOError, OSError, ValueError):
+                continue
+        if cache is None:
+            return
+
+        if (cache.get('cache_version') != CACHE_VERSION
+                or cache.get('base_url') != self.base_url
+                or cache.get('username') != self.username):
+            LOG.debug('%s: ignoring stale session cache', self.device_id)
+            return
+
+        self.cookies = cache.get('cookies', dict())
+        self.expires = cache.get('expires', 0)
+        self.version = cache.get('version', dict())
+        self.version_checked = cache.get('version_checked', 0)
+        self.capabilities = dict(
+            (name, tuple(value))
+            for (name, value) in cache.get('capabilities', dict()).items()
+            )
+        self.console_variant = cache.get('console_variant', '')
+        self.fingerprints = cache.get('fingerprints', dict())
+        self.state = cache.get('state', dict())
+        LOG.debug('%s: loaded session cache', self.device_id)
+
+    def save(self):
+        """ Caches state for the next process to start """
+        cache = {
+            'cache_version': CACHE_VERSION,
+            'base_url': self.base_url,
+            'username': self.username,
+            'cookies': self.cookies,
+            'expires': self.expires,
+            'version': self.version,
+            'version_checked': self.version_checked,
+            'capabilities': self.capabilities,
+            'console_variant': self.console_variant,
+            'fingerprints': self.fingerprints,
+            'state': self.state,
+            }
+        temp_path = self.cache_path + '.tmp'
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            # Session cookies are credentials
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.rename(temp_path, self.cache_path)
+        except (IOError, OSError):
+            LOG.exception('%s: failed to save session cache', self.device_id)
+
+    def logged_in(self):
+        """ Returns whether the session is believed to be valid """
+        return bool(self.cookies) and self.expires > time.time()
+
+    def login(self, transport):
+        """ Logs in unless already logged in. Returns a deferred. """
+        if self.logged_in():
+            return succeed(None)
+
+        # Concurrent callers all wait on the one login
+        d = Deferred()
+        self.waiting.append(d)
+        if len(self.waiting) == 1:
+            self._login(transport).addBoth(self._logged_in)
+        return d
+
+    def _logged_in(self, result):
+        (waiting, self.waiting) = (self.waiting, list())
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+
+    @inlineCallbacks
+    def _login(self, transport):
+        login_params = urllib.urlencode({
+            'action': 'login',
+            'view': 'login',
+            'username': self.username,
+            'password': self.password,
+            # 1.34+ requires OPT_USE_LEGACY_API_AUTH
+            'stateful': 1,
+            })
+        login_url = '{0}index.php?{1}'.format(self.base_url, login_params)
+
+        cookies = dict()
+        response = yield transport.getPage(
+            login_url,
+            method='POST',
+            cookies=cookies
+            )
+
+        if 'Invalid username or password' in response:
+            raise LoginError('ZoneMinder login credentials invalid')
+        elif not cookies:
+            raise LoginError('No cookies received')
+
+        LOG.debug('%s: logged in to ZoneMinder', self.device_id)
+        self.cookies = cookies
+        self.expires = time.time() + SESSION_LIFETIME
+        self.generation += 1
+        self.save()
+
+    def invalidate(self, generation):
+        """ Forgets the session if it hasn't been replaced since failing """
+        if generation == self.generation:
+            self.cookies = dict()
+            self.expires = 0
+
+    @inlineCallbacks
+    def get(self, transport, url, method='GET'):
+        """ Requests a URL, logging in again once if the session expired """
+        for attempt in range(2):
+            yield self.login(transport)
+            generation = self.generation
+            try:
+                response = yield transport.getPage(
+                    url,
+                    method=method,
+                    cookies=self.cookies
+                    )
+            except error.Error as e:
+                if str(e.status) == '401' and attempt == 0:
+                    LOG.debug('%s: session expired', self.device_id)
+                    self.invalidate(generation)
+                    continue
+                raise
+
+            if zmUtil.is_login_page(response) and attempt == 0:
+                LOG.debug('%s: session expired', self.device_id)
+                self.invalidate(generation)
+                continue
+
+            returnValue(response)
+
+    def api(self, transport, path):
+        """ Requests an API path. Returns a deferred body. """
+        return self.get(transport, self.api_url + path)
+
+    def console(self, transport, max_age=BULK_LIFETIME):
+        """ Requests the Console page, shared with other datasources and
+            devices requesting it within max_age seconds.
+            Returns a deferred body.
+        """
+        # Session cookies on 1.34 require view=login on action=login
+        # This returns a 302 to the console page
+        # rather than just the console
+        return self.shared(
+            'console',
+            max_age,
+            self.get,
+            transport,
+            '{0}index.php?view=console'.format(self.base_url)
+            )
+
+    def bulk(self, transport, parser, path, max_age=BULK_LIFETIME):
+        """ Returns a deferred parsed API response, shared with other
+            datasources and devices requesting it within max_age seconds.
+            The result must not be modified.
+        """
+        return self.shared(path, max_age, self.fetch, transport, parser, path)
+
+    def shared(self, name, max_age, func, *args):
+        """ Returns a deferred result of func(*args), shared with other
+            callers of the same name within max_age seconds, and with
+            those waiting on it meanwhile
+        """
+        (fetched, result) = self.responses.get(name, (0, None))
+        if result is not None and time.time() - fetched <= max_age:
+            return succeed(result)
+
+        d = Deferred()
+        waiting = self.fetching.setdefault(name, list())
+        waiting.append(d)
+        if len(waiting) == 1:
+            self._shared(name, func, *args).addBoth(self._fetched, name)
+        return d
+
+    @inlineCallbacks
+    def fetch(self, transport, parser, path):
+        """ Returns a deferred parsed API response, read from the database
+            instead if there is one that can answer it. Large listings
+            keep only the fields in zmParse.ROW_FIELDS.
+        """
+        method = zmDb.PATHS.get(path) if self.db else None
+        if method:
+            try:
+                result = yield getattr(self.db, method)()
+            except Exception as e:
+                LOG.warn(
+                    '%s: falling back to API for %s: %s',
+                    self.device_id,
+                    path,
+                    e
+                    )
+            else:
+                returnValue(zmParse.prune(path, result))
+        response = yield self.api(transport, path)
+        returnValue((yield parser.decode(path, response)))
+
+    @inlineCallbacks
+    def _shared(self, name, func, *args):
+        result = yield func(*args)
+        self.responses[name] = (time.time(), result)
+        returnValue(result)
+
+    def _fetched(self, result, name):
+        for d in self.fetching.pop(name, list()):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    @inlineCallbacks
+    def get_versions(self, transport, parser, refresh=False):
+        """ Returns getVersion.json's response, refreshed when old """
+        if (refresh
+                or not self.version
+                or time.time() - self.version_checked > CAPABILITY_LIFETIME):
+            response = yield self.api(transport, 'host/getVersion.json')
+            self.version = yield parser.loads(response)
+            self.version_checked = time.time()
+            self.save()
+        returnValue(self.version)
+
+    @inlineCallbacks
+    def supports(self, transport, parser, major, minor):
+        """ Returns whether ZoneMinder is at least a given version """
+        versions = zmUtil.dissect_versions(
+            (yield self.get_versions(transport, parser))
+            )
+        returnValue(
+            (int(versions['daemon']['major']), int(versions['daemon']['minor']))
+            >= (major, minor)
+            )
+
+    @inlineCallbacks
+    def optional(self, transport, capability, path):
+        """ Requests an API path the user may not be permitted to view.
+            Returns a deferred body, or None if not permitted.
+        """
+        if not self.capable(capability):
+            returnValue(None)
+        try:
+            response = yield self.api(transport, path)
+        except error.Error as e:
+            if str(e.status) not in ('401', '403'):
+                raise
+            LOG.info(
+                '%s: not permitted to view %s',
+                self.device_id,
+                capability
+                )
+            self.set_capability(capability, False)
+            returnValue(None)
+        self.set_capability(capability, True)
+        returnValue(response)
+
+    def capable(self, name):
+        """ Returns False if a capability was recently found missing """
+        (value, checked) = self.capabilities.get(name, (True, 0))
+        return value or time.time() - checked > CAPABILITY_LIFETIME
+
+    def set_capability(self, name, value):
+        """ Records whether ZoneMinder allowed something """
+        if self.capabilities.get(name, (None, 0))[0] != value:
+            self.capabilities[name] = (value, time.time())
+            self.save()
+
+    def set_console_variant(self, variant):
+        """ Records the Console page layout """
+        if variant and variant != self.console_variant:
+            self.console_variant = variant
+            self.save()
+
+    def set_state(self, name, value):
+        """ Records a library's progress to be resumed after a restart """
+        self.set_states({name: value})
+
+    def set_states(self, values):
+        """ Records several set_state() values with one save """
+        changed = False
+        for (name, value) in values.items():
+            if self.state.get(name) != value:
+                self.state[name] = value
+                changed = True
+        if changed:
+            self.save()
+
+    def fingerprint(self, name, text):
+        """ Records a response's digest. Returns whether it changed. """
+        digest = hashlib.sha1(text).hexdigest()
+        if self.fingerprints.get(name) == digest:
+            return False
+        self.fingerprints[name] = digest
+        self.save()
+        return True
@@ -0,0 +1,142 @@
+""" Reads monitors' live state from ZoneMinder's shared memory """
+
+import logging
+import mmap
+import os
+import struct
+import time
+
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Each monitor's segment, written by its zmc process
+FILENAME = 'zm.mmap.{0}'
+
+# SharedData struct layouts from zm_monitor.h, keyed by the struct's
+# own size field, as field name: (offset, struct format). Other sizes
+# aren't decoded, as no offsets can be trusted.
+# Little-endian, with time_t padded to 64 bits on every architecture.
+LAYOUTS = {
+    # 1.30
+    344: {
+        'state': (12, 'I'),
+        'last_event': (16, 'I'),
+        'valid': (48, 'B'),
+        'active': (49, 'B'),
+        'signal': (50, 'B'),
+        'startup_time': (64, 'q'),
+        'last_write_time': (72, 'q'),
+        'last_read_time': (80, 'q'),
+        },
+    # 1.32
+    608: {
+        'state': (12, 'I'),
+        'last_event': (16, 'Q'),
+        'valid': (52, 'B'),
+        'active': (53, 'B'),
+        'signal': (54, 'B'),
+        'startup_time': (64, 'q'),
+        'zmc_heartbeat_time': (72, 'q'),
+        'last_write_time': (80, 'q'),
+        'last_read_time': (88, 'q'),
+        },
+    # 1.34+, which also publishes framerates
+    760: {
+        'state': (12, 'I'),
+        'capture_fps': (16, 'd'),
+        'analysis_fps': (24, 'd'),
+        'last_event': (32, 'Q'),
+        'valid': (68, 'B'),
+        'active': (69, 'B'),
+        'signal': (70, 'B'),
+        'startup_time': (88, 'q'),
+        'zmc_heartbeat_time': (96, 'q'),
+        'last_write_time': (104, 'q'),
+        'last_read_time': (112, 'q'),
+        },
+    }
+
+
+def layout_extent(layout):
+    """ Returns the bytes needed to decode a layout's fields """
+    return max(
+        offset + struct.calcsize(fmt)
+        for (offset, fmt) in layout.values()
+        )
+
+
+# Bytes read from each segment, enough for the largest layout
+READ_SIZE = max(layout_extent(layout) for layout in LAYOUTS.values())
+
+# Sizes already logged as unrecognized
+unknown_sizes = set()
+
+
+def segment_path(shm_path, monitor_id):
+    """ Returns the path of a monitor's shared memory segment """
+    return os.path.join(shm_path, FILENAME.format(monitor_id))
+
+
+def decode(data):
+    """ Decodes SharedData from the start of a segment.
+        Returns a dict, or None if the layout isn't recognized.
+    """
+    if len(data) < 4:
+        return None
+    size = struct.unpack_from('<I', data, 0)[0]
+    layout = LAYOUTS.get(size)
+    if layout is None or len(data) < layout_extent(layout):
+        if size not in unknown_sizes:
+            unknown_sizes.add(size)
+            LOG.warn('Unrecognized ZoneMinder SharedData size %s', size)
+        return None
+
+    output = {'size': size}
+    for (name, (offset, fmt)) in layout.items():
+        output[name] = struct.unpack_from('<' + fmt, data, offset)[0]
+    return output
+
+
+def read(shm_path, monitor_id):
+    """ Returns a monitor's decoded SharedData, None if its segment
+        doesn't exist, or an empty dict if it isn't recognized
+    """
+    path = segment_path(shm_path, monitor_id)
+    try:
+        with open(path, 'rb') as segment:
+            length = min(os.fstat(segment.fileno()).st_size, READ_SIZE)
+            if length < 4:
+                return dict()
+            mapped = mmap.mmap(
+                segment.fileno(),
+                length,
+                access=mmap.ACCESS_READ
+                )
+            try:
+                return decode(mapped[:length]) or dict()
+            finally:
+                mapped.close()
+    except (IOError, OSError) as e:
+        LOG.debug('Unable to read %s: %s', path, e)
+        return None
+
+
+def monitor_stats(shared, now=None):
+    """ Returns Monitor datapoints from decoded SharedData """
+    if shared is None:
+        # No segment, so zmc isn't running
+        return {'online': 0}
+    elif not shared:
+        # Unrecognized layout, so nothing is known rather than guessed
+        return dict()
+
+    now = now or time.time()
+    output = {
+        'online': 1 if shared['valid'] and shared['signal'] else 0,
+        'alarm-state': shared['state'],
+        }
+    if shared['last_write_time'] > 0:
+        output['write-age'] = max(0, now - shared['last_write_time'])
+    if 'capture_fps' in shared:
+        output['CaptureFPS'] = shared['capture_fps']
+        output['AnalysisFPS'] = shared['analysis_fps']
+    return output
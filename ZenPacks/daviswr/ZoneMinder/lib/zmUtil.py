@@ -1,9 +1,29 @@
 """ A library of ZoneMinder-related functions """
 
+import collections
 import re
+import urlparse
 
 url_regex = r'^https?:\/\/\S+:?\d*\/?\S*\/$'
 
+# Console page monitor ID prefixes, in detection order,
+# and the offset from that line to the monitor's source status
+console_variants = collections.OrderedDict([
+    # 1.30
+    ('zmWatch', 2),
+    # 1.34
+    ('zmMonitor', 0),
+    # 1.32
+    ('monitor_id-', 9),
+    ])
+
+login_form_regex = r'<form[^>]+name="loginForm"|name="action"\s+value="login"'
+
+# Monitor health bits, 0 when healthy
+HEALTH_DISABLED = 1
+HEALTH_OFFLINE = 2
+HEALTH_NOT_CAPTURING = 4
+
 
 def dissect_versions(versions):
     """ Dissects version JSON returned by the API """
@@ -62,6 +82,252 @@ def generate_zm_url(hostname=None,
     return url
 
 
+def generate_server_url(server, base_url):
+    """ Returns a servers.json server's own base URL, anything
+        it doesn't specify taken from the API host's base URL
+    """
+    base = urlparse.urlparse(base_url)
+    hostname = server.get('Hostname') or server.get('Name')
+    if not hostname:
+        return base_url
+    protocol = (server.get('Protocol') or base.scheme).lower()
+    port = str(server.get('Port') or '')
+    if port in ['', '0']:
+        # Only the API host's port if it's the same protocol
+        port = str(base.port or '') if protocol == base.scheme else ''
+    path = server.get('PathToIndex') or base.path
+    if path.endswith('.php'):
+        path = path.rsplit('/', 1)[0]
+    if not path.startswith('/'):
+        path = '/' + path
+    if not path.endswith('/'):
+        path = path + '/'
+    return '{0}://{1}{2}{3}'.format(
+        protocol,
+        hostname,
+        ':' + port if port else '',
+        path
+        )
+
+
+def schedule_params(context):
+    """ Returns the datasource parameters zmSchedule.stagger() reads """
+    return {
+        'spread': context.zZoneMinderCollectionSpread,
+        'jitter': context.zZoneMinderCollectionJitter,
+        'ramp': context.zZoneMinderStartupRamp,
+        }
+
+
+def session_params(context):
+    """ Returns the datasource parameters for connecting to ZoneMinder,
+        shared by every datasource polling its API
+    """
+    params = schedule_params(context)
+    params.update({
+        'username': context.zZoneMinderUsername,
+        'password': context.zZoneMinderPassword,
+        'hostname': context.zZoneMinderHostname,
+        'port': context.zZoneMinderPort,
+        'path': context.zZoneMinderPath,
+        'ssl': context.zZoneMinderSSL,
+        'base_url': context.zZoneMinderURL,
+        'capture_dir': context.zZoneMinderCaptureDir,
+        'replay_dir': context.zZoneMinderReplayDir,
+        'replay_realtime': context.zZoneMinderReplayRealtime,
+        'parse_threshold': context.zZoneMinderParseThreshold,
+        'rate_limit': context.zZoneMinderRateLimit,
+        'rate_burst': context.zZoneMinderRateBurst,
+        'cache_dir': context.zZoneMinderCacheDir,
+        'db_host': context.zZoneMinderDbHost,
+        'db_port': context.zZoneMinderDbPort,
+        'db_user': context.zZoneMinderDbUser,
+        'db_password': context.zZoneMinderDbPassword,
+        'db_name': context.zZoneMinderDbName,
+        'db_module': context.zZoneMinderDbModule,
+        })
+    return params
+
+
+def server_resources(server):
+    """ Returns a server's load and memory from a servers.json entry,
+        as maintained by zmstats on 1.34+
+    """
+    output = dict()
+    try:
+        output['load-1'] = float(server['CpuLoad'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    for (prefix, key) in [('mem', 'Mem'), ('swap', 'Swap')]:
+        try:
+            total = int(server['Total' + key])
+            free = int(server['Free' + key])
+        except (KeyError, TypeError, ValueError):
+            continue
+        output[prefix + '-total'] = total
+        output[prefix + '-free'] = free
+        if total > 0:
+            output[prefix + '-percent'] = 100.0 * (total - free) / total
+    return output
+
+
+def bulk_daemon_rates(monitors):
+    """ Returns daemon-wide rates from monitors.json's monitors by ID """
+    bandwidth = 0.0
+    active = 0
+    capturing = 0
+    for item in monitors.values():
+        monitor = item.get('Monitor', dict())
+        if monitor.get('Function', 'None') == 'None':
+            continue
+        active += 1
+        status = item.get('Monitor_Status') or dict()
+        if status.get('Status') == 'Connected':
+            capturing += 1
+        try:
+            bandwidth += float(status.get('CaptureBandwidth') or 0)
+        except ValueError:
+            pass
+
+    output = {'bandwidth': bandwidth}
+    if active > 0:
+        output['capturing'] = 100.0 * capturing / active
+    return output
+
+
+def bulk_monitor_rates(item):
+    """ Returns a monitor's rates from a monitors.json entry """
+    # 1.32+ Monitor_Status, 1.30 Monitor
+    status = item.get('Monitor_Status') or item.get('Monitor', dict())
+    output = dict()
+    for key in ['CaptureFPS', 'AnalysisFPS', 'CaptureBandwidth']:
+        try:
+            output[key] = float(status[key])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return output
+
+
+def bulk_monitor_online(item):
+    """ Returns a monitor's online status as scraped from the Console page,
+        from a 1.32+ monitors.json entry
+    """
+    online_map = {
+        'Connected': 1,
+        'Running': 2,
+        'Signal': 2,
+        }
+    if item is None:
+        return ''
+    status = item.get('Monitor_Status') or dict()
+    return online_map.get(status.get('Status'), 0)
+
+
+def bulk_monitor_function(item):
+    """ Returns a monitor's modeled Function and Enabled
+        from a monitors.json entry
+    """
+    monitor = item.get('Monitor', dict())
+    return {
+        'Function': monitor.get('Function'),
+        'Enabled': monitor.get('Enabled', '0') == '1',
+        }
+
+
+def bulk_monitor_streaming(item):
+    """ Returns whether a monitor from a monitors.json entry should have
+        frames to stream, True if there's no entry to tell
+    """
+    if item is None:
+        return True
+    monitor = item.get('Monitor', dict())
+    return monitor.get('Enabled') == '1' and monitor.get('Function') not in (
+        None,
+        'None'
+        )
+
+
+def bulk_monitor_health(item, status=None):
+    """ Returns a monitor's health bits from a monitors.json entry.
+        status is whether zmc is running, for 1.30's lack of
+        Monitor_Status.
+    """
+    monitor = item.get('Monitor', dict())
+    health = 0
+    if monitor.get('Enabled', '0') != '1':
+        health |= HEALTH_DISABLED
+    if monitor.get('Function', 'None') == 'None':
+        # Not meant to be capturing
+        return health | HEALTH_DISABLED
+    if 'Monitor_Status' in item:
+        state = (item.get('Monitor_Status') or dict()).get('Status')
+        if state != 'Connected':
+            health |= HEALTH_OFFLINE
+            # zmc isn't even running
+            if state != 'Running':
+                health |= HEALTH_NOT_CAPTURING
+    elif status is not None and not status:
+        health |= HEALTH_OFFLINE | HEALTH_NOT_CAPTURING
+    return health
+
+
+def bulk_fleet_health(monitors):
+    """ Returns device-wide monitor counts from monitors.json's
+        monitors by ID. Offline and not capturing counts need the
+        Monitor_Status of 1.32+.
+    """
+    statuses = any('Monitor_Status' in item for item in monitors.values())
+    output = {
+        'monitors-total': len(monitors),
+        'monitors-disabled': 0,
+        }
+    if statuses:
+        output['monitors-offline'] = 0
+        output['monitors-not-capturing'] = 0
+    for item in monitors.values():
+        if item.get('Monitor', dict()).get('Enabled', '0') != '1':
+            output['monitors-disabled'] += 1
+        if statuses:
+            health = bulk_monitor_health(item)
+            if health & HEALTH_OFFLINE:
+                output['monitors-offline'] += 1
+            if health & HEALTH_NOT_CAPTURING:
+                output['monitors-not-capturing'] += 1
+    return output
+
+
+def fleet_offline(health, minimum):
+    """ Returns whether enough monitors are offline to summarize """
+    return 0 < minimum <= health.get('monitors-offline', 0)
+
+
+def fleet_event(device_id, health, minimum):
+    """ Returns an event summarizing offline monitors, cleared while
+        fewer than minimum are offline
+    """
+    return {
+        'device': device_id,
+        'component': 'ZoneMinder',
+        'eventClass': '/App/ZoneMinder',
+        'eventKey': 'ZoneMinder-Offline',
+        'severity': 3 if fleet_offline(health, minimum) else 0,
+        'summary': '{0}/{1} monitors offline'.format(
+            health.get('monitors-offline', 0),
+            health.get('monitors-total', 0)
+            ),
+        }
+
+
+def monitors_by_id(monitors):
+    """ Returns monitors.json's monitors keyed by ID """
+    output = dict()
+    for item in monitors.get('monitors', list()):
+        monitor_id = item.get('Monitor', dict()).get('Id')
+        if monitor_id:
+            output[str(monitor_id)] = item
+    return output
+
+
 def scrape_console_bandwidth(html):
     """ Scrapes total capture bandwidth from Console page HTML """
     bandwidth_regex = r'<td class="colFunction">(\S+)B\/s'
@@ -95,6 +361,16 @@ def scrape_console_capturing(html):
     return float(capturing_match.groups()[0]) if capturing_match else ''
 
 
+def scrape_console_daemon(html):
+    """ Scrapes daemon-wide metrics from Console page HTML """
+    return {
+        'devshm': scrape_console_shm(html),
+        'db': scrape_console_db(html),
+        'bandwidth': scrape_console_bandwidth(html),
+        'capturing': scrape_console_capturing(html),
+        }
+
+
 def scrape_console_db(html):
     """ Scrapes DB connection count from Console page HTML """
     db_regex = r'DB:(\d+)/(\d+)'
@@ -105,45 +381,52 @@ def scrape_console_db(html):
         }
 
 
-def scrape_console_monitor(html, monitor_id):
-    """ Scrapes monitor connectivity status from Console page HTML """
+def detect_console_variant(html):
+    """ Returns the monitor ID prefix used by a Console page's layout """
+    for variant in console_variants:
+        if variant in html:
+            return variant
+    return ''
+
+
+def is_login_page(html):
+    """ Returns whether HTML is the login form rather than what was asked """
+    return bool(re.search(login_form_regex, html))
+
+
+def scrape_console_monitors(html, variant=None):
+    """ Scrapes every monitor's connectivity status from Console page HTML
+        in one pass, by monitor ID
+    """
     online_regex = r'<td class="colSource">.*<span class="(\w+)Text">'
     online_map = {
         'error': 0,
         'info': 1,
         }
-    output = ''
-
-    # 1.30
-    if 'zmWatch' in html:
-        watch_prefix = 'zmWatch'
-        watch_offset = 2
-    # 1.34
-    elif 'zmMonitor' in html:
-        watch_prefix = 'zmMonitor'
-        watch_offset = 0
-    # 1.32
-    elif 'monitor_id-' in html:
-        watch_prefix = 'monitor_id-'
-        watch_offset = 9
-    else:
-        watch_prefix = ''
-
-    watch_id = watch_prefix + monitor_id
-
-    if watch_id in html:
-        watch_index = -1
-        console = html.splitlines()
-        for ii in range(0, len(console) - 1):
-            if watch_id in console[ii]:
-                watch_index = ii
-                break
-        if watch_index > -1:
-            online_line = console[watch_index + watch_offset]
-            online_match = re.search(online_regex, online_line)
-            if online_match:
-                online_state = online_match.groups()[0]
-                output = online_map.get(online_state, 2)
+    output = dict()
+
+    if not variant or variant not in html:
+        variant = detect_console_variant(html)
+    if not variant:
+        return output
+    watch_regex = re.compile(re.escape(variant) + r'(\d+)\b')
+    watch_offset = console_variants.get(variant, 0)
+
+    console = html.splitlines()
+    for (index, line) in enumerate(console):
+        for monitor_id in watch_regex.findall(line):
+            # A monitor's first line wins, as its ID may appear again
+            if monitor_id in output:
+                continue
+            output[monitor_id] = ''
+            if index + watch_offset < len(console):
+                online_match = re.search(
+                    online_regex,
+                    console[index + watch_offset]
+                    )
+                if online_match:
+                    online_state = online_match.groups()[0]
+                    output[monitor_id] = online_map.get(online_state, 2)
 
     return output
 
@@ -0,0 +1,51 @@
+"""Keeps history of datapoints moved to the DaemonStatus and MonitorStatus
+datasources by renaming their RRD files"""
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import os
+
+from Products.ZenModel.migrate.Migrate import Version
+from Products.ZenModel.ZenPack import ZenPackMigration
+
+# Component meta_type: (old datapoint, new datapoint)
+RENAMES = {
+    'ZoneMinder': [
+        ('Daemon_result', 'DaemonStatus_result'),
+        ],
+    'ZMMonitor': [
+        ('Monitor_status', 'MonitorStatus_status'),
+        ('Monitor_enabled', 'MonitorStatus_enabled'),
+        ],
+    }
+
+
+class RenameStatusDatapoints(ZenPackMigration):
+    """Renames RRD files on this host from the old datapoint names"""
+
+    version = Version(0, 9, 2)
+
+    def migrate(self, pack):
+        renamed = 0
+        for device in pack.dmd.Devices.getSubDevicesGen():
+            for component in device.getDeviceComponents():
+                renames = RENAMES.get(component.meta_type)
+                if not renames:
+                    continue
+                path = component.fullRRDPath()
+                for (old, new) in renames:
+                    old_file = os.path.join(path, '{0}.rrd'.format(old))
+                    new_file = os.path.join(path, '{0}.rrd'.format(new))
+                    if (not os.path.exists(old_file)
+                            or os.path.exists(new_file)):
+                        continue
+                    try:
+                        os.rename(old_file, new_file)
+                        renamed += 1
+                    except OSError as e:
+                        LOG.warn('Could not rename %s: %s', old_file, e)
+        LOG.info('Renamed %s ZoneMinder status RRD files', renamed)
+
+
+RenameStatusDatapoints()
@@ -1,11 +1,9 @@
 """ Models the ZoneMinder daemon """
 
-import json
 import re
-import urllib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from twisted.web import error
 
 from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 from Products.DataCollector.plugins.DataMaps import (
@@ -14,7 +12,13 @@ from Products.DataCollector.plugins.DataMaps import (
     ObjectMap
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmDb,
+    zmParse,
+    zmSession,
+    zmTransport,
+    zmUtil
+    )
 
 
 class ZoneMinder(PythonPlugin):
@@ -34,6 +38,19 @@ class ZoneMinder(PythonPlugin):
         'zZoneMinderIgnoreStorageId',
         'zZoneMinderIgnoreStorageName',
         'zZoneMinderIgnoreStoragePath',
+        'zZoneMinderCaptureDir',
+        'zZoneMinderReplayDir',
+        'zZoneMinderReplayRealtime',
+        'zZoneMinderParseThreshold',
+        'zZoneMinderRateLimit',
+        'zZoneMinderRateBurst',
+        'zZoneMinderCacheDir',
+        'zZoneMinderDbHost',
+        'zZoneMinderDbPort',
+        'zZoneMinderDbUser',
+        'zZoneMinderDbPassword',
+        'zZoneMinderDbName',
+        'zZoneMinderDbModule',
         )
 
     deviceProperties = PythonPlugin.deviceProperties + requiredProperties
@@ -68,132 +85,136 @@ class ZoneMinder(PythonPlugin):
             returnValue(None)
 
         log.info('%s: using base ZoneMinder URL %s', device.id, base_url)
-        # Pre-1.32 compatibility
-        login_params = urllib.urlencode({
-            'action': 'login',
-            'view': 'login',
-            'username': username,
-            'password': password,
-            # 1.34+ requires OPT_USE_LEGACY_API_AUTH
-            'stateful': 1,
-            })
-        login_url = '{0}index.php?{1}'.format(base_url, login_params)
-        api_url = '{0}api/'.format(base_url)
-        # log.debug('%s: ZoneMinder URL:%s', device.id, login_url)
-
-        cookies = dict()
-        try:
-            # Attempt login
-            response = yield getPage(login_url, method='POST', cookies=cookies)
-
-            if 'Invalid username or password' in response:
-                log.error(
-                    '%s: ZoneMinder login credentials invalid',
-                    device.id
-                    )
-                returnValue(None)
-            elif not cookies:
-                log.error('%s: No cookies received', device.id)
-                returnValue(None)
 
-            log.debug('%s: ZoneMinder cookies\n%s', device.id, cookies)
+        transport = zmTransport.get_transport(
+            device.id,
+            self.__class__.__name__,
+            capture_dir=getattr(device, 'zZoneMinderCaptureDir', None),
+            replay_dir=getattr(device, 'zZoneMinderReplayDir', None),
+            realtime=getattr(device, 'zZoneMinderReplayRealtime', False),
+            rate=getattr(device, 'zZoneMinderRateLimit', 0),
+            burst=getattr(device, 'zZoneMinderRateBurst', 0)
+            )
+        parser = zmParse.Parser(
+            device.id,
+            getattr(device, 'zZoneMinderParseThreshold', None)
+            )
+        session = zmSession.get_session(
+            device.id,
+            base_url,
+            username,
+            password,
+            cache_dir=getattr(device, 'zZoneMinderCacheDir', None),
+            db=zmDb.get_backend(
+                getattr(device, 'zZoneMinderDbHost', None),
+                getattr(device, 'zZoneMinderDbPort', 3306),
+                getattr(device, 'zZoneMinderDbUser', 'zmuser'),
+                getattr(device, 'zZoneMinderDbPassword', None),
+                getattr(device, 'zZoneMinderDbName', 'zm'),
+                getattr(device, 'zZoneMinderDbModule', None)
+                )
+            )
 
+        try:
             output = dict()
             output['url'] = base_url
 
             # Versions
+            # Always refreshed when modeling, in case of an upgrade
             log.debug('%s: ZoneMinder URL: host/getVersion.json', device.id)
-            response = yield getPage(
-                api_url + 'host/getVersion.json',
-                method='GET',
-                cookies=cookies
-                )
-            version_json = json.loads(response)
-            versions = zmUtil.dissect_versions(version_json)
-            output.update(version_json)
+            output.update((yield session.get_versions(
+                transport,
+                parser,
+                refresh=True
+                )))
 
             # Config
             log.debug('%s: ZoneMinder URL: configs.json', device.id)
-            response = yield getPage(
-                api_url + 'configs.json',
-                method='GET',
-                cookies=cookies
-                )
-            output.update(json.loads(response))
+            output.update((yield session.fetch(
+                transport,
+                parser,
+                'configs.json'
+                )))
 
             # Monitors
             log.debug('%s: ZoneMinder URL: monitors.json', device.id)
-            response = yield getPage(
-                api_url + 'monitors.json',
-                method='GET',
-                cookies=cookies
-                )
-            output.update(json.loads(response))
+            output.update((yield session.fetch(
+                transport,
+                parser,
+                'monitors.json'
+                )))
 
             # Monitor PTZ Types
             log.debug('%s: ZoneMinder URL: controls.json', device.id)
-            response = yield getPage(
-                api_url + 'controls.json',
-                method='GET',
-                cookies=cookies
-                )
-            output.update(json.loads(response))
+            output.update((yield session.fetch(
+                transport,
+                parser,
+                'controls.json'
+                )))
 
             # Storage Volumes
             log.debug('%s: ZoneMinder URL: index.php?view=console', device.id)
-            response = yield getPage(
-                '{0}index.php?view=console'.format(base_url),
-                method='GET',
-                cookies=cookies
+            response = yield session.console(transport)
+            session.set_console_variant(
+                zmUtil.detect_console_variant(response)
+                )
+            output['volumes'] = yield parser.parse(
+                zmUtil.scrape_console_volumes,
+                response
                 )
-            output['volumes'] = zmUtil.scrape_console_volumes(response)
 
-            # Servers
-            # response = yield getPage(
-            #     api_url + 'servers.json',
-            #     method='GET',
-            #     cookies=cookies
-            #     )
-            # output.update(json.loads(response))
+            # Servers, which older versions and users without System
+            # View can't list. Monitors and storage are modeled regardless.
+            log.debug('%s: ZoneMinder URL: servers.json', device.id)
+            try:
+                output.update((yield session.fetch(
+                    transport,
+                    parser,
+                    'servers.json'
+                    )))
+            except zmSession.LoginError:
+                raise
+            except error.Error as e:
+                log.info(
+                    '%s: servers.json unavailable, not modeling servers: %s',
+                    device.id,
+                    e
+                    )
+                output['servers'] = list()
+            except Exception as e:
+                # Servers already modeled are kept
+                log.warn(
+                    '%s: failed to get servers, not remodeling them: %s',
+                    device.id,
+                    e
+                    )
 
             # Version-specific API calls
             # 1.32+ required for storage.json
-            if (versions['daemon']['major'] >= 1
-                    and versions['daemon']['minor'] >= 32):
+            if (yield session.supports(transport, parser, 1, 32)):
                 # Storage
                 log.debug('%s: ZoneMinder URL: storage.json', device.id)
-                response = yield getPage(
-                    api_url + 'storage.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-                # API logout
-                log.debug('%s: ZoneMinder URL: host/logout.json', device.id)
-                yield getPage(
-                    api_url + 'host/logout.json',
-                    method='GET',
-                    cookies=cookies
-                    )
+                output.update((yield session.fetch(
+                    transport,
+                    parser,
+                    'storage.json'
+                    )))
 
-            else:
-                # Browser-style log out
-                # Doesn't work with 1.34.21
-                log.debug(
-                    '%s: ZoneMinder URL: index.php?action=logout',
-                    device.id
-                    )
-                yield getPage(
-                    base_url + 'index.php?action=logout',
-                    method='POST',
-                    cookies=cookies
-                    )
+            # The session is kept for the datasource plugins to reuse
 
-        except Exception, e:
+        except zmSession.LoginError as e:
+            log.error('%s: %s', device.id, e)
+            returnValue(None)
+        except Exception as e:
             log.error('%s: %s', device.id, e)
             returnValue(None)
 
+        log.debug(
+            '%s: %.3fs spent parsing on the reactor thread',
+            device.id,
+            zmParse.pop_blocking(device.id)
+            )
+
         returnValue(output)
 
     def process(self, device, results, log):
@@ -233,6 +254,42 @@ class ZoneMinder(PythonPlugin):
         log.debug('%s ZoneMinder daemon:\n%s', device.id, rm)
         maps.append(rm)
 
+        # Servers
+        # Mapped before monitors and storage so they can be linked
+        rm = RelationshipMap(
+            compname='zoneMinder/ZoneMinder',
+            relname='zmServers',
+            modname='ZenPacks.daviswr.ZoneMinder.ZMServer'
+            )
+
+        # Server component IDs by ServerId
+        servers = dict()
+        for item in results.get('servers', list()):
+            server = item['Server']
+            server_id = str(server.get('Id', ''))
+            if not server_id:
+                continue
+            server['id'] = self.prepId('zmServer{0}'.format(server_id))
+            server['title'] = server.get('Name') or server.get('Hostname') \
+                or server_id
+            server['ServerId'] = int(server_id)
+            server['Hostname'] = server.get('Hostname') or server.get('Name')
+            server['url'] = zmUtil.generate_server_url(
+                server,
+                results.get('url')
+                )
+            for key in ['zmstats', 'zmaudit', 'zmtrigger']:
+                server[key] = True if server.get(key) in ['1', 1] else False
+            servers[server_id] = server['id']
+
+            rm.append(ObjectMap(
+                modname='ZenPacks.daviswr.ZoneMinder.ZMServer',
+                data=server
+                ))
+            log.debug('%s ZoneMinder server:\n%s', device.id, rm)
+        if 'servers' in results:
+            maps.append(rm)
+
         # Monitors
         rm = RelationshipMap(
             compname='zoneMinder/ZoneMinder',
@@ -426,6 +483,13 @@ class ZoneMinder(PythonPlugin):
             else:
                 monitor['ControlId'] = 'None'
 
+            # Recording server, if this is a multi-server cluster,
+            # left as it was if servers couldn't be listed
+            if 'servers' in results:
+                monitor['set_zmServer'] = servers.get(
+                    str(monitor['ServerId'])
+                    )
+
             rm.append(ObjectMap(
                 modname='ZenPacks.daviswr.ZoneMinder.ZMMonitor',
                 data=monitor
@@ -485,6 +549,10 @@ class ZoneMinder(PythonPlugin):
 
             store['StorageType'] = store.get('Type', None)
 
+            store['ServerId'] = int(store.get('ServerId') or 0)
+            if 'servers' in results:
+                store['set_zmServer'] = servers.get(str(store['ServerId']))
+
             rm.append(ObjectMap(
                 modname='ZenPacks.daviswr.ZoneMinder.ZMStorage',
                 data=store
@@ -0,0 +1,183 @@
+""" Tests reading ZoneMinder's database through a stand-in DB-API module """
+
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import types
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmDb
+
+MODULE_NAME = 'zm_standin_dbapi'
+
+SCHEMA = [
+    'CREATE TABLE Config (Name TEXT, Value TEXT)',
+    'CREATE TABLE Controls (Id INTEGER, Name TEXT, Type TEXT)',
+    'CREATE TABLE Monitors (Id INTEGER, Name TEXT, Sequence INTEGER, '
+    'Enabled INTEGER)',
+    'CREATE TABLE Monitor_Status (MonitorId INTEGER, Status TEXT)',
+    'CREATE TABLE States (Id INTEGER, Name TEXT, IsActive INTEGER)',
+    'CREATE TABLE Servers (Id INTEGER, Name TEXT)',
+    'CREATE TABLE Storage (Id INTEGER, Name TEXT, DiskSpace INTEGER)',
+    # 1.30's Events, without StorageId and DiskSpace
+    'CREATE TABLE Events (Id INTEGER, MonitorId INTEGER, StartTime TEXT, '
+    'EndTime TEXT, AlarmFrames INTEGER, Length REAL)',
+    ]
+
+
+class StandInCursor(object):
+    """ sqlite3 with MySQL's placeholders and SHOW COLUMNS """
+
+    def __init__(self, connection):
+        self.cursor = connection.cursor()
+        self.rows = None
+        self.description = None
+
+    def execute(self, query, args=None):
+        match = re.match(r'SHOW COLUMNS FROM (\w+)$', query)
+        if match:
+            self.cursor.execute('PRAGMA table_info({0})'.format(
+                match.group(1)
+                ))
+            self.rows = [(row[1],) for row in self.cursor.fetchall()]
+            self.description = [('Field',)]
+        else:
+            self.cursor.execute(query.replace('%s', '?'), args or ())
+            self.rows = self.cursor.fetchall()
+            self.description = self.cursor.description
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        self.cursor.close()
+
+
+class StandInConnection(object):
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self):
+        return StandInCursor(self.connection)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+def standin_module(path):
+    """ Returns a DB-API module taking the DB-API 2.0 suggested connect()
+        arguments, recording them
+    """
+    module = types.ModuleType(MODULE_NAME)
+    module.apilevel = '2.0'
+    module.threadsafety = 1
+    module.connected = list()
+
+    def connect(host, port, user, password, database):
+        module.connected.append((host, port, user, password, database))
+        return StandInConnection(path)
+
+    module.connect = connect
+    return module
+
+
+class TestConnectArgs(unittest.TestCase):
+
+    def test_modules(self):
+        self.assertEqual(
+            zmDb.connect_kwargs('MySQLdb', 'db', 3306, 'zm', 'pw', 'zm'),
+            {'host': 'db', 'port': 3306, 'user': 'zm', 'passwd': 'pw',
+             'db': 'zm', 'connect_timeout': zmDb.CONNECT_TIMEOUT}
+            )
+        self.assertEqual(
+            zmDb.connect_kwargs('other', 'db', 3306, 'zm', 'pw', 'zm'),
+            {'host': 'db', 'port': 3306, 'user': 'zm', 'password': 'pw',
+             'database': 'zm'}
+            )
+
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        path = os.path.join(self.tmp, 'zm.sqlite')
+        connection = sqlite3.connect(path)
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.executemany(
+            'INSERT INTO Monitors VALUES (?, ?, ?, ?)',
+            [(2, 'Back', 2, 0), (1, 'Front', 1, 1)]
+            )
+        connection.execute("INSERT INTO Monitor_Status VALUES (1, "
+                           "'Connected')")
+        connection.execute("INSERT INTO Storage VALUES (0, 'Default', 5)")
+        connection.executemany(
+            'INSERT INTO Events VALUES (?, ?, ?, ?, ?, ?)',
+            [(event_id, 1, '2020-01-01 00:00:00', '2020-01-01 00:01:00',
+              event_id, 60.0) for event_id in range(1, 6)]
+            )
+        connection.commit()
+        connection.close()
+
+        self.module = standin_module(path)
+        sys.modules[MODULE_NAME] = self.module
+        self.backend = zmDb.Backend(MODULE_NAME, 'db', 3306, 'zm', 'pw', 'zm')
+
+    def tearDown(self):
+        self.backend.pool.close()
+        del sys.modules[MODULE_NAME]
+        shutil.rmtree(self.tmp)
+
+    @defer.inlineCallbacks
+    def test_paths(self):
+        # Each path answered from the database has a method giving the
+        # API's top-level key
+        for (path, method) in zmDb.PATHS.items():
+            output = yield getattr(self.backend, method)()
+            self.assertEqual(list(output), [path.replace('.json', '')])
+        self.assertEqual(self.module.connected[0],
+                         ('db', 3306, 'zm', 'pw', 'zm'))
+
+    @defer.inlineCallbacks
+    def test_monitors(self):
+        output = yield self.backend.monitors()
+        self.assertEqual(
+            [item['Monitor']['Name'] for item in output['monitors']],
+            [u'Front', u'Back']
+            )
+        self.assertEqual(output['monitors'][0]['Monitor_Status'], {
+            'MonitorId': '1',
+            'Status': u'Connected',
+            })
+        self.assertEqual(output['monitors'][1]['Monitor_Status'], None)
+
+    @defer.inlineCallbacks
+    def test_events_pagination(self):
+        seen = list()
+        for page in range(1, 4):
+            output = yield self.backend.events(
+                'Id > %s', (1,), 'Id', 2, (page - 1) * 2
+                )
+            seen.extend(int(x['Event']['Id']) for x in output['events'])
+            self.assertEqual(output['pagination']['nextPage'], page < 2)
+            if not output['pagination']['nextPage']:
+                break
+        self.assertEqual(seen, [2, 3, 4, 5])
+        # Only the columns this schema has
+        self.assertEqual(
+            sorted(output['events'][0]['Event']),
+            ['AlarmFrames', 'EndTime', 'Id', 'Length', 'MonitorId',
+             'StartTime']
+            )
@@ -0,0 +1,102 @@
+""" Tests incremental event accounting against an in-memory Events table """
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmEvents
+
+
+class FakeEventsDb(object):
+    """ Answers zmEvents' queries like zmDb.Backend.events() """
+
+    def __init__(self):
+        self.rows = dict()
+
+    def add(self, event_id, end='', disk=0):
+        self.rows[event_id] = {
+            'Id': str(event_id),
+            'MonitorId': '1',
+            'StartTime': '2020-01-01 00:00:{0:02d}'.format(event_id),
+            'EndTime': end or None,
+            'AlarmFrames': '0',
+            'Length': '0.00',
+            'StorageId': '0',
+            'DiskSpace': str(disk) if end else None,
+            }
+
+    def end(self, event_id, disk):
+        self.rows[event_id]['EndTime'] = '2020-01-01 00:01:00'
+        self.rows[event_id]['DiskSpace'] = str(disk)
+
+    def events(self, where, args, order, limit, offset=0):
+        rows = [self.rows[x] for x in sorted(self.rows)]
+        if where == '1 = 1':
+            rows.reverse()
+        elif where == 'Id > %s':
+            rows = [x for x in rows if int(x['Id']) > args[0]]
+        elif where == 'Id > %s AND Id <= %s':
+            rows = [x for x in rows if args[0] < int(x['Id']) <= args[1]]
+        else:
+            rows = [x for x in rows
+                    if args[0] <= int(x['Id']) <= args[1]
+                    and (x['EndTime'] or '') >= args[2]]
+        page = rows[offset:offset + limit + 1]
+        return defer.succeed({
+            'events': [{'Event': row} for row in page[:limit]],
+            'pagination': {'nextPage': len(page) > limit},
+            })
+
+
+class FakeSession(object):
+
+    def __init__(self, db):
+        self.key = 'test'
+        self.state = dict()
+        self.db = db
+
+    def set_states(self, states):
+        self.state.update(states)
+
+
+class TestReconcile(unittest.TestCase):
+
+    def setUp(self):
+        # One page of two events per update, so a recount spans several
+        self.patch(zmEvents, 'PAGE_SIZE', 2)
+        self.patch(zmEvents, 'MAX_PAGES', 1)
+        self.db = FakeEventsDb()
+        for event_id in range(1, 7):
+            self.db.add(event_id, end='2020-01-01 00:00:59', disk=10)
+        self.tracker = zmEvents.Tracker('nvr', FakeSession(self.db))
+
+    def update(self, reconcile=zmEvents.RECONCILE_INTERVAL):
+        self.tracker.updated = 0
+        return self.tracker.update(None, None, reconcile=reconcile)
+
+    @defer.inlineCallbacks
+    def test_event_ending_mid_scan(self):
+        # Counting starts after event 6
+        yield self.update()
+        self.assertEqual(self.tracker.origin, 6)
+
+        # Event 7 ends and event 8 starts before the first recount
+        self.db.add(7, end='2020-01-01 00:00:59', disk=100)
+        self.db.add(8)
+        yield self.update(reconcile=0)
+        self.assertEqual(self.tracker.disk, {'1:0': 100})
+        self.assertEqual(sorted(self.tracker.open), [8])
+
+        # Events 1 and 2 recounted
+        yield self.update()
+        self.assertEqual(self.tracker.disk_usage('1'), ({'0': 120}, True))
+
+        # Event 8 ends mid-scan, events 3 and 4 recounted
+        self.db.end(8, 1000)
+        yield self.update()
+        self.assertEqual(self.tracker.disk_usage('1'), ({'0': 1140}, True))
+
+        # Events 5 and 6 recounted, and the recount finishes with every
+        # event counted once
+        yield self.update()
+        self.assertEqual(self.tracker.scan, None)
+        self.assertEqual(self.tracker.disk_usage('1'), ({'0': 1160}, False))
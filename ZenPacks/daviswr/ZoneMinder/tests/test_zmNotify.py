@@ -0,0 +1,243 @@
+""" Tests the Event Notification Server client against a local stand-in """
+
+import base64
+import hashlib
+import json
+import struct
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmEvents, zmNotify
+
+
+def server_frame(opcode, payload):
+    """ Returns an unmasked server websocket frame """
+    length = len(payload)
+    if length < 126:
+        header = chr(0x80 | opcode) + chr(length)
+    else:
+        header = chr(0x80 | opcode) + chr(126) + struct.pack('!H', length)
+    return header + payload
+
+
+class StandInProtocol(Protocol):
+    """ Just enough of zmeventnotification to log in and push alarms """
+
+    def __init__(self):
+        self.buffer = ''
+        self.upgraded = False
+
+    def connectionMade(self):
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.clients.remove(self)
+        (lost, self.factory.lost) = (self.factory.lost, defer.Deferred())
+        lost.callback(None)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        if not self.upgraded:
+            if '\r\n\r\n' not in self.buffer:
+                return
+            (request, self.buffer) = self.buffer.split('\r\n\r\n', 1)
+            key = [line.split(':', 1)[1].strip()
+                   for line in request.split('\r\n')
+                   if line.lower().startswith('sec-websocket-key:')][0]
+            self.transport.write(
+                'HTTP/1.1 101 Switching Protocols\r\n'
+                'Upgrade: websocket\r\n'
+                'Connection: Upgrade\r\n'
+                'Sec-WebSocket-Accept: {0}\r\n'
+                '\r\n'.format(base64.b64encode(hashlib.sha1(
+                    key + zmNotify.WEBSOCKET_GUID
+                    ).digest()))
+                )
+            self.upgraded = True
+
+        while True:
+            frame = zmNotify.decode_frame(self.buffer)
+            if frame is None:
+                break
+            (_, opcode, payload, used) = frame
+            self.buffer = self.buffer[used:]
+            if opcode == zmNotify.OPCODE_TEXT:
+                self.factory.received.append(json.loads(payload))
+                self.login(json.loads(payload))
+            elif opcode == zmNotify.OPCODE_CLOSE:
+                self.transport.loseConnection()
+
+    def login(self, message):
+        if message.get('event') != 'auth':
+            return
+        data = message.get('data', dict())
+        if (data.get('user'), data.get('password')) == self.factory.login:
+            self.send({'event': 'auth', 'type': '', 'status': 'Success',
+                       'reason': '', 'version': '6.1.0'})
+        else:
+            self.send({'event': 'auth', 'type': '', 'status': 'Fail',
+                       'reason': 'BADAUTH'})
+
+    def send(self, message):
+        self.transport.write(server_frame(
+            zmNotify.OPCODE_TEXT,
+            json.dumps(message)
+            ))
+
+
+class StandInFactory(Factory):
+
+    protocol = StandInProtocol
+
+    def __init__(self, login):
+        self.login = login
+        self.clients = list()
+        self.received = list()
+        self.lost = defer.Deferred()
+
+
+def alarm(event_id, monitor_id):
+    return {
+        'EventId': event_id,
+        'MonitorId': monitor_id,
+        'Name': 'Camera {0}'.format(monitor_id),
+        'Cause': 'Motion',
+        }
+
+
+def wait_for(condition, timeout=5.0):
+    """ Returns a deferred firing once condition() is true """
+    d = defer.Deferred()
+    started = reactor.seconds()
+
+    def check():
+        if condition():
+            d.callback(None)
+        elif reactor.seconds() - started > timeout:
+            d.errback(AssertionError('Timed out waiting'))
+        else:
+            reactor.callLater(0.01, check)
+
+    check()
+    return d
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.key = 'test'
+        self.state = dict()
+
+    def set_states(self, states):
+        self.state.update(states)
+
+
+class TestListener(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInFactory(('admin', 'secret'))
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.listener = None
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        if self.listener is not None:
+            self.listener.stop()
+        if self.server.clients:
+            yield self.server.lost
+        yield self.port.stopListening()
+
+    def connect(self, password='secret'):
+        self.listener = zmNotify.Listener(
+            'nvr',
+            'ws://127.0.0.1:{0}/'.format(self.port.getHost().port),
+            'admin',
+            password
+            )
+        self.listener.start()
+        return self.listener
+
+    @defer.inlineCallbacks
+    def test_login_and_alarms(self):
+        listener = self.connect()
+        yield wait_for(lambda: listener.connected_since > 0)
+        self.assertEqual(self.server.received[0], {
+            'event': 'auth',
+            'data': {'user': 'admin', 'password': 'secret'},
+            })
+
+        # The same event pushed twice is only reported once. The last
+        # alarm shows the duplicate before it has been handled.
+        self.server.clients[0].send({
+            'event': 'alarm',
+            'type': '',
+            'events': [alarm(101, 1), alarm(102, 2)],
+            })
+        self.server.clients[0].send({
+            'event': 'alarm',
+            'type': '',
+            'events': [alarm(102, 2), alarm(104, 4)],
+            })
+        yield wait_for(lambda: len(listener.pending) >= 3)
+
+        self.assertEqual(
+            [x['EventId'] for x in listener.pop_alarms()],
+            [101, 102, 104]
+            )
+        self.assertEqual(listener.pop_alarms(), list())
+        self.assertEqual(
+            [x['EventId'] for x in listener.pop_pushed()],
+            [101, 102, 104]
+            )
+
+        event = zmNotify.alarm_event('nvr', alarm(103, 3))
+        self.assertEqual(event['component'], 'zmMonitor3')
+        self.assertEqual(event['summary'], 'ZM monitor Camera 3 alarm: Motion')
+
+    @defer.inlineCallbacks
+    def test_refused_login(self):
+        listener = self.connect(password='wrong')
+        yield wait_for(lambda: not listener.factory.continueTrying)
+        self.assertEqual(listener.connected_since, 0)
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        listener = self.connect()
+        # Retry quickly rather than after INITIAL_DELAY
+        listener.factory.initialDelay = listener.factory.delay = 0.1
+        yield wait_for(lambda: listener.connected_since > 0)
+        lost = self.server.lost
+        self.server.clients[0].transport.loseConnection()
+        yield lost
+        yield wait_for(lambda: listener.connected_since > 0
+                       and len(self.server.received) == 2)
+
+
+class TestPushedCounts(unittest.TestCase):
+
+    def test_pushed_counted_once(self):
+        tracker = zmEvents.Tracker('nvr', FakeSession())
+        tracker.hwm = 100
+        tracker.push([alarm(101, 1), alarm(101, 1), alarm(99, 1)])
+        self.assertEqual(tracker.delta('nvr/Monitor', '1')['events'], 1)
+
+        # The query finds the pushed event and one from a monitor that
+        # doesn't alarm, such as on Record
+        for (event_id, monitor_id) in [(101, '1'), (102, '2')]:
+            tracker.account({
+                'id': event_id,
+                'monitor': monitor_id,
+                'start': '2020-01-01 00:00:00',
+                'end': '',
+                'storage': '0',
+                'alarm_frames': 0,
+                'length': 0.0,
+                'disk': 0,
+                })
+        self.assertEqual(tracker.delta('nvr/Monitor', '1')['events'], 0)
+        self.assertEqual(tracker.delta('nvr/Monitor', '2')['events'], 1)
+        self.assertEqual(tracker.delta('nvr/Daemon', 'daemon')['events'], 2)
+        self.assertEqual(tracker.pushed, set())
+        self.assertEqual(sorted(tracker.open), [101, 102])
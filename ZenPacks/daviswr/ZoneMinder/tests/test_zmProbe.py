@@ -0,0 +1,105 @@
+""" Tests camera source probes against local stand-ins """
+
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.protocol import Factory, Protocol
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmProbe
+
+
+class StandInRtsp(Protocol):
+    """ Answers any RTSP request as a camera wanting credentials """
+
+    def connectionMade(self):
+        self.factory.connections += 1
+
+    def dataReceived(self, data):
+        self.factory.received.append(data)
+        if data.endswith('\r\n\r\n'):
+            self.transport.write('RTSP/1.0 401 Unauthorized\r\nCSeq: 1\r\n\r\n')
+
+
+class StandInFactory(Factory):
+
+    protocol = StandInRtsp
+
+    def __init__(self):
+        self.connections = 0
+        self.received = list()
+
+
+class TestProbe(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.server = StandInFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.port_number = self.port.getHost().port
+        # A port nothing listens on
+        closed = reactor.listenTCP(0, Factory(), interface='127.0.0.1')
+        self.closed_number = closed.getHost().port
+        yield closed.stopListening()
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def source(self, port, protocol='RTSP'):
+        return {
+            'Host': '127.0.0.1',
+            'Port': port,
+            'Protocol': protocol,
+            'Path': 'rtsp://127.0.0.1:{0}/stream'.format(port),
+            }
+
+    @defer.inlineCallbacks
+    def test_tcp(self):
+        (connect, line, response) = yield zmProbe.probe(
+            '127.0.0.1',
+            self.port_number
+            )
+        self.assertTrue(connect >= 0)
+        self.assertEqual((line, response), (None, None))
+
+    @defer.inlineCallbacks
+    def test_rtsp(self):
+        (connect, line, response) = yield zmProbe.probe(
+            'localhost',
+            self.port_number,
+            zmProbe.options_request('rtsp://127.0.0.1/')
+            )
+        self.assertEqual(line, 'RTSP/1.0 401 Unauthorized')
+        self.assertTrue(connect >= 0 and response >= 0)
+        self.assertTrue(self.server.received[0].startswith('OPTIONS '))
+
+    def test_closed(self):
+        return self.assertFailure(
+            zmProbe.probe('127.0.0.1', self.closed_number),
+            ConnectionRefusedError
+            )
+
+    @defer.inlineCallbacks
+    def test_probe_sources(self):
+        results = yield zmProbe.probe_sources(
+            {
+                'zmMonitor1': self.source(self.port_number),
+                'zmMonitor2': self.source(self.closed_number),
+                'zmMonitor3': self.source(self.port_number, 'HTTP'),
+                'zmMonitor4': {'Host': '', 'Protocol': 'File'},
+                },
+            zmProbe.MODE_RTSP,
+            2,
+            0,
+            5
+            )
+        self.assertEqual(sorted(results), ['zmMonitor1', 'zmMonitor2',
+                                           'zmMonitor3'])
+        self.assertEqual(results['zmMonitor1']['reachable'], 1)
+        self.assertEqual(results['zmMonitor1']['rtsp-status'], 401)
+        self.assertTrue('response-latency' in results['zmMonitor1'])
+        self.assertEqual(results['zmMonitor2'], {'reachable': 0})
+        # Only RTSP sources get a request in rtsp mode
+        self.assertEqual(results['zmMonitor3']['reachable'], 1)
+        self.assertFalse('response-latency' in results['zmMonitor3'])
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.received), 1)
@@ -0,0 +1,66 @@
+""" Tests coalescing remodels requested by run state changes """
+
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmRemodel
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.state = dict()
+
+    def set_state(self, name, value):
+        self.state[name] = value
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 10000.0
+
+    def time(self):
+        return self.now
+
+
+class TestCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.patch(zmRemodel, 'time', self.clock)
+        self.session = FakeSession()
+
+    def check(self, run_state, interval=900, modeled=0):
+        return zmRemodel.check(
+            self.session,
+            'nvr',
+            run_state,
+            interval,
+            modeled
+            )
+
+    def test_changes_coalesced(self):
+        # The first state seen isn't a change
+        self.assertEqual(self.check('1'), None)
+        remodel = self.check('2')
+        self.assertEqual(remodel.setRemodel, self.clock.now)
+
+        # Changes within the interval wait for its end
+        self.clock.now += 60
+        self.assertEqual(self.check('1'), None)
+        self.clock.now += 60
+        self.assertEqual(self.check('2'), None)
+        self.clock.now += 900
+        self.assertNotEqual(self.check('2'), None)
+        self.assertEqual(self.check('2'), None)
+
+    def test_recently_modeled(self):
+        self.check('1')
+        self.assertEqual(self.check('2', modeled=self.clock.now - 60), None)
+        self.clock.now += 900
+        self.assertNotEqual(self.check('2'), None)
+
+    def test_disabled(self):
+        self.check('1', interval=0)
+        self.assertEqual(self.check('2', interval=0), None)
+        self.assertEqual(self.check('2'), None)
@@ -0,0 +1,91 @@
+""" Tests sharing, keying and releasing ZoneMinder sessions """
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmSession
+
+BASE_URL = 'http://zm.example.com/zm/'
+
+
+class FakeBackend(object):
+
+    def __init__(self, *key):
+        self.key = key
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.patch(zmSession, 'sessions', dict())
+        self.patch(zmSession, 'device_keys', dict())
+        self.patch(zmSession, 'device_seen', dict())
+        self.patch(zmSession, 'secrets', dict())
+        self.released = list()
+        self.patch(zmSession, 'release_observers', [
+            lambda device_id, session, idle: self.released.append(
+                (device_id, session is not None, idle)
+                )
+            ])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get(self, device_id, password='pw', db=None):
+        return zmSession.get_session(
+            device_id,
+            BASE_URL,
+            'zenoss',
+            password,
+            self.cache_dir,
+            db
+            )
+
+    def test_cache_name(self):
+        session = self.get('nvr')
+        secret_path = os.path.join(self.cache_dir, zmSession.SECRET_FILE)
+        self.assertEqual(os.stat(secret_path).st_mode & 0o777, 0o600)
+        # Neither name reveals a plain digest of the credentials
+        digest = hashlib.sha1('zenoss\0pw').hexdigest()[:12]
+        self.assertFalse(digest in session.key)
+        self.assertFalse(digest in session.cache_path)
+
+        # The secret outlives the process, so the cache is found again
+        zmSession.secrets.clear()
+        zmSession.sessions.clear()
+        self.assertEqual(self.get('nvr').cache_path, session.cache_path)
+
+    def test_shared(self):
+        self.assertTrue(self.get('nvr1') is self.get('nvr2'))
+        self.assertFalse(self.get('nvr1') is self.get('nvr3', 'other'))
+
+    def test_db(self):
+        # Each database's devices get their own session
+        db1 = FakeBackend('db1')
+        db2 = FakeBackend('db2')
+        session = self.get('nvr1', db=db1)
+        self.assertTrue(session.db is db1)
+        self.assertTrue(self.get('nvr2', db=db1) is session)
+        other = self.get('nvr3', db=db2)
+        self.assertTrue(other.db is db2)
+        self.assertTrue(session.db is db1)
+
+    def test_credentials_changed(self):
+        session = self.get('nvr')
+        self.assertFalse(self.get('nvr', 'other') is session)
+        self.assertEqual(self.released, [('nvr', True, False)])
+        self.assertFalse(session.key in zmSession.sessions)
+
+    def test_idle(self):
+        self.get('nvr1')
+        self.get('nvr2')
+        zmSession.device_seen['nvr1'] -= zmSession.IDLE_LIFETIME + 1
+        self.get('nvr2')
+        self.assertEqual(self.released, [('nvr1', False, True)])
+        self.assertEqual(zmSession.sessions.values()[0].devices,
+                         set(['nvr2']))
@@ -0,0 +1,191 @@
+""" Tests decoding ZoneMinder shared memory against synthetic segments """
+
+import re
+import shutil
+import struct
+import tempfile
+import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmShm
+
+# SharedData from each version's zm_monitor.h, field by field, so the
+# offsets in zmShm.LAYOUTS are checked against the C structs rather than
+# themselves. time_t is padded to 64 bits by unions in every version.
+STRUCTS = {
+    # size, last_write_index, last_read_index, state, last_event, action,
+    # brightness, hue, colour, contrast, alarm_x, alarm_y,
+    # valid, active, signal, format, imagesize, epadding1, epadding2,
+    # startup_time, last_write_time, last_read_time, control_state
+    '1.30': (344, '<IIIIIIiiiiiiBBBBIIIqqq256s', {
+        'state': 3,
+        'last_event': 4,
+        'valid': 12,
+        'active': 13,
+        'signal': 14,
+        'startup_time': 19,
+        'last_write_time': 20,
+        'last_read_time': 21,
+        }),
+    # size, last_write_index, last_read_index, state, last_event, action,
+    # brightness, hue, colour, contrast, alarm_x, alarm_y,
+    # valid, active, signal, format, imagesize, epadding1,
+    # startup_time, zmc_heartbeat_time, last_write_time, last_read_time,
+    # control_state, alarm_cause
+    '1.32': (608, '<IIIIQIiiiiiiBBBBIIqqqq256s256s', {
+        'state': 3,
+        'last_event': 4,
+        'valid': 12,
+        'active': 13,
+        'signal': 14,
+        'startup_time': 18,
+        'zmc_heartbeat_time': 19,
+        'last_write_time': 20,
+        'last_read_time': 21,
+        }),
+    # size, last_write_index, last_read_index, state, capture_fps,
+    # analysis_fps, last_event, action, brightness, hue, colour, contrast,
+    # alarm_x, alarm_y, valid, active, signal, format, imagesize,
+    # last_frame_score, audio_frequency, audio_channels,
+    # startup_time, zmc_heartbeat_time, last_write_time, last_read_time,
+    # control_state, alarm_cause, video_fifo_path, audio_fifo_path
+    '1.34': (760, '<IIIIddQIiiiiiiBBBBIIIIqqqq256s256s64s64s', {
+        'state': 3,
+        'capture_fps': 4,
+        'analysis_fps': 5,
+        'last_event': 6,
+        'valid': 14,
+        'active': 15,
+        'signal': 16,
+        'startup_time': 22,
+        'zmc_heartbeat_time': 23,
+        'last_write_time': 24,
+        'last_read_time': 25,
+        }),
+    }
+
+NOW = 1600000000
+
+
+def pack(version, **fields):
+    """ Returns a SharedData struct with distinct values in every field,
+        overridden by those given
+    """
+    (size, fmt, indexes) = STRUCTS[version]
+    values = list()
+    for (index, code) in enumerate(re.findall(r'\d*([a-zA-Z])', fmt)):
+        if code == 's':
+            values.append('\xff' * 8)
+        elif code == 'd':
+            values.append(index + 0.5)
+        elif code == 'B':
+            values.append(index)
+        else:
+            values.append(index + 1000)
+    values[0] = size
+    for (name, value) in fields.items():
+        values[indexes[name]] = value
+    return struct.pack(fmt, *values)
+
+
+class TestLayouts(unittest.TestCase):
+
+    def test_struct_sizes(self):
+        for (version, (size, fmt, _)) in STRUCTS.items():
+            self.assertEqual(struct.calcsize(fmt), size, version)
+            self.assertTrue(size in zmShm.LAYOUTS, version)
+
+    def test_decode(self):
+        for (version, (size, fmt, indexes)) in STRUCTS.items():
+            values = struct.unpack(fmt, pack(version))
+            shared = zmShm.decode(pack(version))
+            self.assertEqual(shared['size'], size)
+            self.assertEqual(
+                sorted(shared),
+                sorted(list(indexes) + ['size']),
+                version
+                )
+            for (name, index) in indexes.items():
+                self.assertEqual(
+                    shared[name],
+                    values[index],
+                    '{0} {1}'.format(version, name)
+                    )
+
+    def test_unknown_size(self):
+        data = pack('1.34')
+        self.assertEqual(zmShm.decode(struct.pack('<I', 700) + data[4:]),
+                         None)
+        self.assertTrue(700 in zmShm.unknown_sizes)
+
+    def test_truncated(self):
+        self.assertEqual(zmShm.decode(pack('1.32')[:80]), None)
+        self.assertEqual(zmShm.decode('\x00\x00'), None)
+
+
+class TestMonitorStats(unittest.TestCase):
+
+    def test_online(self):
+        stats = zmShm.monitor_stats(zmShm.decode(pack(
+            '1.32',
+            valid=1,
+            signal=1,
+            state=2,
+            last_write_time=NOW - 3
+            )), now=NOW)
+        self.assertEqual(stats, {
+            'online': 1,
+            'alarm-state': 2,
+            'write-age': 3,
+            })
+
+    def test_framerates(self):
+        stats = zmShm.monitor_stats(zmShm.decode(pack(
+            '1.34',
+            valid=1,
+            signal=0,
+            capture_fps=9.5,
+            analysis_fps=4.25,
+            last_write_time=0
+            )), now=NOW)
+        self.assertEqual(stats['online'], 0)
+        self.assertEqual(stats['CaptureFPS'], 9.5)
+        self.assertEqual(stats['AnalysisFPS'], 4.25)
+        self.assertFalse('write-age' in stats)
+
+    def test_missing_and_unknown(self):
+        # No segment means zmc isn't running, an unknown one tells nothing
+        self.assertEqual(zmShm.monitor_stats(None), {'online': 0})
+        self.assertEqual(zmShm.monitor_stats(dict()), dict())
+
+
+class TestRead(unittest.TestCase):
+
+    def setUp(self):
+        self.shm_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.shm_path)
+
+    def write(self, monitor_id, data):
+        with open(zmShm.segment_path(self.shm_path, monitor_id), 'wb') as f:
+            # Image buffers follow SharedData in a real segment
+            f.write(data + '\x00' * 4096)
+
+    def test_read(self):
+        self.write(1, pack('1.34', state=4))
+        self.assertEqual(zmShm.read(self.shm_path, 1)['state'], 4)
+
+    def test_read_missing(self):
+        self.assertEqual(zmShm.read(self.shm_path, 2), None)
+
+    def test_read_unknown(self):
+        self.write(3, struct.pack('<I', 123) + '\x00' * 1000)
+        self.assertEqual(zmShm.read(self.shm_path, 3), dict())
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(TestLayouts),
+        unittest.makeSuite(TestMonitorStats),
+        unittest.makeSuite(TestRead),
+        ])
@@ -21,11 +21,35 @@ if evt.eventKey.endswith('Daemon-Status'):
         }
 
 elif evt.eventKey.endswith('Daemon-RunState'):
-    # Run State has changed, remodel to get new monitor functions
-    # Model in background so transform isn't delayed
-    device.collectDevice(background=True)
+    # Run State has changed. The Daemon datasource requests a remodel
+    # through zenhub, at most once per zZoneMinderRemodelInterval.
     evt._action = 'history'
 
+elif evt.eventKey.endswith('Server-Status'):
+    server_id = evt.component.replace('zmServer', '')
+    evt.summary = 'ZM server {0} daemon {1}'.format(server_id, state)
+    severities = {
+        0: SEVERITY_ERROR,
+        1: SEVERITY_CLEAR,
+        }
+
+elif evt.eventKey.endswith('Monitor-Health'):
+    # Composite of zmUtil.HEALTH_* bits
+    monitor_id = evt.component.replace('zmMonitor', '')
+    health_map = [
+        (1, 'disabled'),
+        (2, 'offline'),
+        (4, 'not capturing'),
+        ]
+    causes = [cause for (bit, cause) in health_map if current & bit]
+    evt.summary = 'ZM monitor {0} is {1}'.format(
+        monitor_id,
+        ', '.join(causes) or 'healthy'
+        )
+    severities = {
+        0: SEVERITY_CLEAR,
+        }
+
 elif 'Monitor' in evt.eventKey:
     monitor_id = evt.component.replace('zmMonitor', '')
     severities = {
@@ -48,11 +72,16 @@ elif 'Monitor' in evt.eventKey:
             }
         enabled = enabled_map.get(current, 'unknown')
         evt.summary = 'ZM monitor {0} is {1}'.format(monitor_id, enabled)
-
-        @transact
-        def updateDb():
-            component.Enabled = True if 1 == current else False
-        updateDb()
+    elif 'Source' in evt.eventKey:
+        source_map = {
+            0: 'is unreachable',
+            1: 'is reachable',
+            }
+        source = source_map.get(current, 'reachability unknown')
+        evt.summary = 'ZM monitor {0} camera source {1}'.format(
+            monitor_id,
+            source
+            )
 
 if 'Daemon-RunState' not in evt.eventKey:
     # ZPL Components look for events in /Status rather than
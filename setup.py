@@ -59,6 +59,9 @@ setup(
     # of this form.
     entry_points={
         'zenoss.zenpacks': '%s = %s' % (NAME, NAME),
+        'console_scripts': [
+            'zmcollect = ZenPacks.daviswr.ZoneMinder.lib.zmCollect:main',
+        ],
     },
 
     # All ZenPack eggs must be installed in unzipped form.